@@ -0,0 +1,281 @@
+"""Benchmark of the execution hot path.
+
+Starts the app with uvicorn against a throw-away SQLite database (in a
+temporary directory that also takes outputs and artifacts), then fires a
+weighted mix of snippets at `/execute` and `/api/v1/execute` at each
+concurrency level. The JSON report has p50/p95/p99 latency, runs/sec and the
+per-phase breakdown (auth, quota, queue, spawn, run, persist, ...) taken
+from the `Server-Timing` header of every response. Keep the reports of
+different versions to track regressions.
+
+    python benchmarks/execute_bench.py --concurrency 1,4,16 --requests 200 \\
+        --mix trivial=4,cpu=1,output=1,import=1 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPETS = {
+    "trivial": "print('ok')",
+    "cpu": "print(sum(i * i for i in range(300000)))",
+    "output": "for i in range(5000):\n    print(f'line {i:05d} ' + 'x' * 60)",
+    "import": (
+        "import asyncio, decimal, email.mime.multipart, http.server, json, sqlite3, "
+        "xml.etree.ElementTree, unittest\nprint('imported')"
+    ),
+}
+
+ENDPOINTS = ("execute", "api")
+BENCH_USER = "bench"
+BENCH_API_KEY = "bench-api-key"
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in SNIPPETS:
+            raise argparse.ArgumentTypeError(f"unknown snippet kind: {name} (known: {', '.join(SNIPPETS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 3)
+
+
+def summarize(values: list) -> dict:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": round(sum(values) / len(values), 3) if values else None,
+        "max": round(max(values), 3) if values else None,
+    }
+
+
+def parse_server_timing(header: str) -> dict:
+    phases = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "dur":
+                phases[name] = phases.get(name, 0.0) + float(value)
+    return phases
+
+
+def prepare_app(level: int, unthrottled: bool):
+    """Import the app against the scratch database and create the bench user"""
+    sys.path.insert(0, BACKEND_DIR)
+    import main
+    from models.database import SessionLocal, User, APIKey, CodeLibrary
+    from models.user_levels import USER_LEVELS
+    from services.auth import create_access_token, get_password_hash
+
+    if unthrottled:
+        # Measure the execution path, not the per-user protections around it
+        USER_LEVELS[level].update({
+            "daily_executions": -1,
+            "daily_api_calls": -1,
+            "rate_burst": 10 ** 9,
+            "rate_per_minute": 10 ** 9,
+            "max_concurrent_runs": 10 ** 6,
+            "max_queued_runs": 10 ** 6,
+        })
+
+    db = SessionLocal()
+    try:
+        user = User(username=BENCH_USER, email="bench@example.com", full_name="Benchmark",
+                    hashed_password=get_password_hash(BENCH_API_KEY), user_level=level)
+        db.add(user)
+        db.commit()
+        db.refresh(user)
+        db.add(APIKey(user_id=user.id, key_name="bench", key_value=BENCH_API_KEY))
+        code_ids = {}
+        for kind, code in SNIPPETS.items():
+            entry = CodeLibrary(user_id=user.id, title=f"bench-{kind}", description="", code=code,
+                                conda_env="base")
+            db.add(entry)
+            db.commit()
+            db.refresh(entry)
+            code_ids[kind] = entry.id
+    finally:
+        db.close()
+    return main.app, create_access_token({"sub": BENCH_USER}), code_ids
+
+
+def start_server(app):
+    import uvicorn
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning",
+                                           access_log=False))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+def run_scenario(session_factory, base_url: str, endpoint: str, concurrency: int, requests_count: int,
+                 mix: dict, token: str, code_ids: dict, seed: int) -> dict:
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=requests_count)
+    local = threading.local()
+
+    def fire(kind: str):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = session_factory()
+        if endpoint == "execute":
+            url = f"{base_url}/execute"
+            kwargs = {"json": {"code": SNIPPETS[kind]}, "headers": {"Authorization": f"Bearer {token}"}}
+        else:
+            url = f"{base_url}/api/v1/execute"
+            kwargs = {"json": {"code_id": code_ids[kind]}, "params": {"api_key": BENCH_API_KEY}}
+        start = time.perf_counter()
+        try:
+            response = session.post(url, timeout=600, **kwargs)
+        except Exception as e:
+            return kind, (time.perf_counter() - start) * 1000, False, str(e), {}
+        latency = (time.perf_counter() - start) * 1000
+        ok = response.status_code == 200 and response.json().get("status") == "success"
+        error = None if ok else f"HTTP {response.status_code}: {response.text[:200]}"
+        return kind, latency, ok, error, parse_server_timing(response.headers.get("server-timing", ""))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(fire, kinds))
+    duration = time.perf_counter() - started
+
+    latencies = [latency for _, latency, ok, _, _ in results if ok]
+    phases: dict[str, list] = {}
+    by_kind: dict[str, list] = {}
+    errors = []
+    for kind, latency, ok, error, timing in results:
+        if not ok:
+            errors.append(error)
+            continue
+        by_kind.setdefault(kind, []).append(latency)
+        for name, value in timing.items():
+            phases.setdefault(name, []).append(value)
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": requests_count,
+        "succeeded": len(latencies),
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "duration_s": round(duration, 3),
+        "runs_per_sec": round(len(latencies) / duration, 2) if duration else None,
+        "latency_ms": summarize(latencies),
+        "phases_ms": {name: summarize(values) for name, values in sorted(phases.items())},
+        "by_snippet_ms": {kind: summarize(values) for kind, values in sorted(by_kind.items())},
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /execute and /api/v1/execute")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint and concurrency level")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("trivial=4,cpu=1,output=1,import=1"),
+                        help="snippet kinds with weights, e.g. trivial=4,cpu=1,output=1,import=1")
+    parser.add_argument("--endpoints", default="execute,api", help="execute and/or api")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests per endpoint first")
+    parser.add_argument("--level", type=int, default=4, help="user level of the benchmark user")
+    parser.add_argument("--keep-limits", action="store_true",
+                        help="keep the level's quotas and rate limits instead of lifting them")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    endpoints = [name.strip() for name in args.endpoints.split(",") if name.strip()]
+    for name in endpoints:
+        if name not in ENDPOINTS:
+            parser.error(f"unknown endpoint: {name}")
+    levels = [int(value) for value in args.concurrency.split(",") if value.strip()]
+    # Relative to where the bench was started, not to the scratch directory
+    output = os.path.abspath(args.output) if args.output else None
+    cwd = os.getcwd()
+
+    workdir = tempfile.mkdtemp(prefix="coderunner-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault("EXECUTION_SCRATCH_ROOT", os.path.join(workdir, "scratch"))
+    # Relative data paths (outputs, artifacts) end up in the scratch directory too
+    os.chdir(workdir)
+
+    import requests
+
+    app, token, code_ids = prepare_app(args.level, not args.keep_limits)
+    server, thread, base_url = start_server(app)
+    try:
+        for endpoint in endpoints:
+            run_scenario(requests.Session, base_url, endpoint, 1, args.warmup, args.mix, token, code_ids, args.seed)
+        scenarios = [
+            run_scenario(requests.Session, base_url, endpoint, concurrency, args.requests, args.mix, token,
+                         code_ids, args.seed)
+            for endpoint in endpoints
+            for concurrency in levels
+        ]
+    finally:
+        server.should_exit = True
+        thread.join()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "requests": args.requests,
+            "concurrency": levels,
+            "mix": args.mix,
+            "endpoints": endpoints,
+            "level": args.level,
+            "limits_lifted": not args.keep_limits,
+            "warmup": args.warmup,
+            "seed": args.seed,
+        },
+        "scenarios": scenarios,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
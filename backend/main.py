@@ -3,7 +3,17 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from models.database import init_db
-from routers import auth, users, execution, code_library, api_keys, external_api, environments, ai, admin, profile, community, misc
+from services.jobs import job_scheduler, fail_interrupted_jobs
+from services.output_capture import cleanup_expired_outputs
+from services.rate_limit import RateLimitHeadersMiddleware
+from services.record_writer import record_writer
+from services.runners import runner_registry
+from services.scratch import cleanup_scratch
+from services.sessions import session_manager
+from services.timing import ServerTimingMiddleware
+from services.webhooks import webhook_dispatcher
+from services.worker_pool import shutdown_pools
+from routers import auth, users, execution, code_library, bundles, api_keys, external_api, environments, ai, admin, profile, community, misc, sessions
 
 app = FastAPI(title="CodeRunner API", version="1.0.0")
 
@@ -14,7 +24,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["RateLimit-Limit", "RateLimit-Remaining", "RateLimit-Reset", "RateLimit-Policy", "Retry-After",
+                    "Idempotent-Replayed", "Server-Timing"],
 )
+app.add_middleware(RateLimitHeadersMiddleware)
+# Outermost, so its total covers the other middleware too
+app.add_middleware(ServerTimingMiddleware)
 
 # Initialize database
 init_db()
@@ -24,7 +39,9 @@ app.include_router(misc.router)  # Root endpoint and misc routes
 app.include_router(auth.router)  # Authentication routes
 app.include_router(users.router)  # User management (admin)
 app.include_router(execution.router)  # Code execution
+app.include_router(sessions.router)  # Interactive sessions
 app.include_router(code_library.router)  # Code library management
+app.include_router(bundles.router)  # Multi-file bundles
 app.include_router(api_keys.router)  # API key management
 app.include_router(external_api.router)  # External API (API key auth)
 app.include_router(environments.router)  # Environment management
@@ -33,6 +50,26 @@ app.include_router(admin.router)  # Admin endpoints (logs, database)
 app.include_router(profile.router)  # User profile
 app.include_router(community.router)  # Community features
 
+
+@app.on_event("startup")
+def recover_execution_jobs():
+    fail_interrupted_jobs()
+    cleanup_expired_outputs()
+    cleanup_scratch()
+    runner_registry.start()
+
+
+@app.on_event("shutdown")
+def stop_execution_workers():
+    job_scheduler.shutdown()
+    runner_registry.shutdown()
+    session_manager.shutdown()
+    shutdown_pools()
+    webhook_dispatcher.shutdown()
+    # Last, so records of runs finished during shutdown are written too
+    record_writer.shutdown()
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,9 +1,13 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String, DateTime, Boolean, Text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+import os
+import threading
 from datetime import datetime
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./data/coderunner.db"
+# Overridable, e.g. to point the benchmark harness at a scratch database
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./data/coderunner.db")
 
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -32,19 +36,102 @@ class User(Base):
     company = Column(String, nullable=True)  # Company/organization
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+# Ids an API process reserves at a time for the records it writes
+EXECUTION_ID_BLOCK_SIZE = 100
+
+class IdBlock(Base):
+    """Next unreserved id per table, shared by all API processes"""
+    __tablename__ = "id_blocks"
+
+    name = Column(String, primary_key=True)
+    next_id = Column(Integer, nullable=False)
+
+class _ExecutionIds:
+    """Hands out CodeExecution ids before the rows are written.
+
+    Records persisted in the background are answered with their id right
+    away, so every insert takes its id from here rather than from SQLite.
+    Each process reserves blocks of `EXECUTION_ID_BLOCK_SIZE` ids in
+    `id_blocks`, in a transaction of its own, so several API workers never
+    hand out the same id. Ids left in a block when a process exits are
+    skipped.
+    """
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self._next = None
+        self._end = None
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> int:
+        """Take the next block; returns its first id"""
+        params = {"name": CodeExecution.__tablename__, "size": self.block_size}
+        for attempt in range(2):
+            try:
+                with engine.begin() as conn:
+                    # Never below ids written without a reservation, e.g. by a database import
+                    updated = conn.execute(text(
+                        "UPDATE id_blocks SET next_id = MAX(next_id, "
+                        "(SELECT COALESCE(MAX(id), 0) + 1 FROM code_executions)) + :size WHERE name = :name"
+                    ), params)
+                    if updated.rowcount == 0:
+                        conn.execute(text(
+                            "INSERT INTO id_blocks (name, next_id) "
+                            "SELECT :name, COALESCE(MAX(id), 0) + 1 + :size FROM code_executions"
+                        ), params)
+                    return conn.execute(
+                        text("SELECT next_id FROM id_blocks WHERE name = :name"), params
+                    ).scalar() - self.block_size
+            except IntegrityError:
+                if attempt:
+                    raise  # another process created the row at the same time, retried once
+
+    def __call__(self, context=None) -> int:
+        with self._lock:
+            if self._next is None or self._next >= self._end:
+                self._next = self._reserve()
+                self._end = self._next + self.block_size
+            value = self._next
+            self._next += 1
+            return value
+
+    def reset(self):
+        """Reserve a fresh block on next use, e.g. after a database import"""
+        with self._lock:
+            self._next = None
+            self._end = None
+        IdBlock.__table__.create(bind=engine, checkfirst=True)
+
+
+next_execution_id = _ExecutionIds(EXECUTION_ID_BLOCK_SIZE)
+
 class CodeExecution(Base):
     __tablename__ = "code_executions"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, index=True, default=next_execution_id)
     user_id = Column(Integer, index=True)
     code = Column(Text)
     result = Column(Text)
-    status = Column(String)  # "success", "error", "running", "timeout", "memory_exceeded"
+    status = Column(String)  # "queued", "running", "success", "error", "timeout", "memory_exceeded", "cancelled"
     created_at = Column(DateTime, default=datetime.utcnow)
     execution_time = Column(Integer)  # in milliseconds
-    memory_usage = Column(Integer)  # in MB
+    memory_usage = Column(Integer)  # peak RSS in MB
+    cpu_user_time = Column(Integer, nullable=True)  # in milliseconds
+    cpu_system_time = Column(Integer, nullable=True)  # in milliseconds
+    minor_page_faults = Column(Integer, nullable=True)
+    major_page_faults = Column(Integer, nullable=True)
+    startup_saved_ms = Column(Integer, nullable=True)  # Start-up skipped thanks to a warm worker
     is_api_call = Column(Boolean, default=False)  # Track if this was an API call
     code_library_id = Column(Integer, nullable=True)  # Reference to code library if applicable
+    output_size = Column(Integer, nullable=True)  # Total bytes of output produced
+    output_truncated = Column(Boolean, default=False)  # result holds only head and tail
+    output_path = Column(String, nullable=True)  # Spilled full output for truncated results
+    artifact_count = Column(Integer, default=0)  # Files kept from the run's scratch directory
+    artifacts_path = Column(String, nullable=True)  # Zip archive holding them
+    profile = Column(Text, nullable=True)  # JSON report of a profiled run
+    cached = Column(Boolean, default=False)  # Served from the result cache
+    session_id = Column(String, nullable=True, index=True)  # Interactive session the cell ran in
+    bundle_id = Column(String, nullable=True)  # Multi-file bundle that ran; `code` holds its entry point
 
 class CodeLibrary(Base):
     __tablename__ = "code_library"
@@ -60,9 +147,33 @@ class CodeLibrary(Base):
     conda_env = Column(String, default="base")  # Conda environment name
     is_shared_via_post = Column(Boolean, default=False)  # Track if this code is shared via a post
     shared_post_id = Column(Integer, nullable=True)  # Reference to the post that shares this code
+    cache_results = Column(Boolean, default=False)  # Serve repeated API runs from the result cache
+    cache_ttl = Column(Integer, nullable=True)  # Seconds a cached result stays valid
+    bundle_id = Column(String, nullable=True)  # Multi-file bundle run instead of `code`
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class CodeBundle(Base):
+    __tablename__ = "code_bundles"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, index=True)
+    bundle_id = Column(String, index=True)  # SHA-256 of the manifest, see services/bundles.py
+    entry_point = Column(String)  # Path of the file run as __main__
+    manifest = Column(Text)  # JSON list of {path, sha256, size}
+    file_count = Column(Integer)
+    total_size = Column(Integer)  # in bytes
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class BundleBlob(Base):
+    """A file content the user has uploaded (or got through an adopted bundle)"""
+    __tablename__ = "bundle_blobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, index=True, nullable=False)
+    sha256 = Column(String, index=True, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 class APIKey(Base):
     __tablename__ = "api_keys"
 
@@ -105,6 +216,8 @@ class UserEnvironment(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     last_used = Column(DateTime, nullable=True)
+    worker_pool_size = Column(Integer, nullable=True)  # Warm workers kept for this env, None uses the default
+    preload_modules = Column(Text, nullable=True)  # Comma-separated modules warm workers import up front
 
 class SystemLog(Base):
     __tablename__ = "system_logs"
@@ -220,8 +333,28 @@ def get_db():
     finally:
         db.close()
 
+def _add_missing_columns():
+    """Add columns introduced after a table was first created.
+
+    create_all() only creates missing tables, so existing databases would
+    otherwise fail on queries touching newer columns.
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
 
     # Check if admin user exists, create if not
     db = SessionLocal()
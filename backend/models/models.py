@@ -1,5 +1,6 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, Union
+import json
+from pydantic import BaseModel, EmailStr, field_validator
+from typing import Literal, Optional, Union
 from datetime import datetime
 
 class UserBase(BaseModel):
@@ -40,9 +41,52 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     username: Optional[str] = None
 
+# Profilers an execution can be run under
+Profiler = Literal["sampling", "cprofile"]
+
+
+def _load_profile(value):
+    """Profile reports are stored as JSON text on the execution record"""
+    return json.loads(value) if isinstance(value, str) else value
+
+
+class BundleFile(BaseModel):
+    path: str  # Relative path inside the bundle, "/" separated
+    content: Optional[str] = None  # Omitted for contents the server already has ...
+    sha256: Optional[str] = None  # ... which are referenced by hash instead
+    encoding: Optional[Literal["utf-8", "base64"]] = "utf-8"
+
+class BundleCreate(BaseModel):
+    files: list[BundleFile]
+    entry_point: Optional[str] = "main.py"  # File run as __main__
+
+class BundleFileInfo(BaseModel):
+    path: str
+    sha256: str
+    size: int
+
+class BundleResponse(BaseModel):
+    bundle_id: str
+    entry_point: str
+    files: list[BundleFileInfo]
+    file_count: int
+    total_size: int
+    created_at: datetime
+
+class BlobCheckRequest(BaseModel):
+    hashes: list[str]
+
+class BlobCheckResponse(BaseModel):
+    missing: list[str]  # Hashes whose content has to be uploaded
+
 class CodeExecutionRequest(BaseModel):
-    code: str
+    code: Optional[str] = None
+    files: Optional[list[BundleFile]] = None  # A multi-file project instead of `code` ...
+    entry_point: Optional[str] = "main.py"
+    bundle_id: Optional[str] = None  # ... or a bundle created before
     conda_env: Optional[str] = "base"
+    profile: Optional[bool] = False  # Return a profile of the run
+    profiler: Optional[Profiler] = "sampling"  # Wall-clock stack sampling or cProfile tracing
 
 class CodeExecutionResponse(BaseModel):
     id: int
@@ -50,7 +94,38 @@ class CodeExecutionResponse(BaseModel):
     status: str
     execution_time: int
     memory_usage: Optional[int] = None
+    cpu_user_time: Optional[int] = None
+    cpu_system_time: Optional[int] = None
+    minor_page_faults: Optional[int] = None
+    major_page_faults: Optional[int] = None
+    startup_saved_ms: Optional[int] = None
+    output_size: Optional[int] = None
+    output_truncated: Optional[bool] = False
+    artifact_count: Optional[int] = 0
+    profile: Optional[dict] = None
+    session_id: Optional[str] = None
+    bundle_id: Optional[str] = None
+    created_at: datetime
+
+    _parse_profile = field_validator("profile", mode="before")(_load_profile)
+
+    class Config:
+        from_attributes = True
+
+class SessionCreateRequest(BaseModel):
+    conda_env: Optional[str] = "base"
+
+class SessionRunRequest(BaseModel):
+    code: str
+
+class SessionResponse(BaseModel):
+    id: str
+    conda_env: str
     created_at: datetime
+    cells: int
+    busy: bool
+    idle_seconds: int
+    memory_usage: int  # kernel RSS in MB
 
     class Config:
         from_attributes = True
@@ -58,11 +133,14 @@ class CodeExecutionResponse(BaseModel):
 class CodeLibraryCreate(BaseModel):
     title: str
     description: Optional[str] = None
-    code: str
+    code: Optional[str] = None  # Defaults to the entry point of `bundle_id`
     language: Optional[str] = "python"
     is_public: Optional[bool] = False
     tags: Optional[str] = None
     conda_env: Optional[str] = "base"
+    cache_results: Optional[bool] = False
+    cache_ttl: Optional[int] = None
+    bundle_id: Optional[str] = None  # Run this bundle instead of `code`
 
 class CodeLibraryUpdate(BaseModel):
     title: Optional[str] = None
@@ -72,6 +150,9 @@ class CodeLibraryUpdate(BaseModel):
     is_public: Optional[bool] = None
     tags: Optional[str] = None
     conda_env: Optional[str] = None
+    cache_results: Optional[bool] = None
+    cache_ttl: Optional[int] = None
+    bundle_id: Optional[str] = None
 
 class CodeLibraryResponse(BaseModel):
     id: int
@@ -85,6 +166,9 @@ class CodeLibraryResponse(BaseModel):
     conda_env: str
     is_shared_via_post: bool
     shared_post_id: Optional[int] = None
+    cache_results: Optional[bool] = False
+    cache_ttl: Optional[int] = None
+    bundle_id: Optional[str] = None
     created_at: datetime
     updated_at: datetime
 
@@ -130,6 +214,9 @@ class APIKeyInfo(BaseModel):
 class CodeExecuteByAPIRequest(BaseModel):
     code_id: int
     parameters: Optional[dict] = None  # Optional parameters to pass to the code
+    callback_url: Optional[str] = None  # Run as a job and POST the result here when done
+    profile: Optional[bool] = False  # Return a profile of the run (never served from the cache)
+    profiler: Optional[Profiler] = "sampling"
 
 class CodeExecuteByAPIResponse(BaseModel):
     id: int
@@ -137,12 +224,44 @@ class CodeExecuteByAPIResponse(BaseModel):
     status: str
     execution_time: int
     memory_usage: Optional[int] = None
+    cpu_user_time: Optional[int] = None
+    cpu_system_time: Optional[int] = None
+    minor_page_faults: Optional[int] = None
+    major_page_faults: Optional[int] = None
+    startup_saved_ms: Optional[int] = None
+    output_size: Optional[int] = None
+    output_truncated: Optional[bool] = False
+    artifact_count: Optional[int] = 0
+    profile: Optional[dict] = None
+    cached: Optional[bool] = False
+    bundle_id: Optional[str] = None
     created_at: datetime
     code_title: str
 
+    _parse_profile = field_validator("profile", mode="before")(_load_profile)
+
     class Config:
         from_attributes = True
 
+class CodeBatchExecuteRequest(BaseModel):
+    items: Optional[list[CodeExecuteByAPIRequest]] = None  # Different code entries
+    code_id: Optional[int] = None  # Or one code entry ...
+    parameter_sets: Optional[list[dict]] = None  # ... run once per parameter set
+    stream: Optional[bool] = False  # Return NDJSON lines as items finish
+
+class CodeBatchItemResponse(CodeExecuteByAPIResponse):
+    index: int  # Position of the item in the request
+    code_id: int
+    id: Optional[int] = None  # No record for items rejected as overloaded
+    created_at: Optional[datetime] = None
+    status_code: int = 200  # 429 when the item found the scheduler overloaded
+    retry_after: Optional[int] = None  # Seconds to wait before retrying such an item
+
+class CodeBatchExecuteResponse(BaseModel):
+    results: list[CodeBatchItemResponse]
+    total: int
+    execution_time: int  # Wall time of the whole batch in milliseconds
+
 # AI Configuration Models
 class AIConfigCreate(BaseModel):
     model_config = {"protected_namespaces": ()}
@@ -205,6 +324,8 @@ class UserEnvironmentUpdate(BaseModel):
     description: Optional[str] = None
     is_public: Optional[bool] = None
     is_active: Optional[bool] = None
+    worker_pool_size: Optional[int] = None
+    preload_modules: Optional[str] = None
 
 class UserEnvironmentResponse(BaseModel):
     id: int
@@ -218,6 +339,8 @@ class UserEnvironmentResponse(BaseModel):
     created_at: datetime
     updated_at: datetime
     last_used: Optional[datetime] = None
+    worker_pool_size: Optional[int] = None
+    preload_modules: Optional[str] = None
     owner_name: Optional[str] = None  # Username of environment owner
 
     class Config:
@@ -9,6 +9,19 @@ USER_LEVELS = {
         "max_saved_codes": 5,  # codes in library
         "max_api_keys": 2,  # API keys limit
         "daily_api_calls": 20,  # API call limit per day
+        "max_output_kb": 64,  # output kept in the execution record
+        "max_output_spill_mb": 8,  # full output kept for download
+        "scheduler_weight": 1,  # share of execution slots for this level's lane
+        "max_concurrent_runs": 1,  # runs per user at the same time
+        "max_queued_runs": 2,  # runs per user waiting for a slot
+        "max_batch_size": 5,  # items per /api/v1/execute/batch call
+        "max_sessions": 1,  # interactive sessions kept at the same time
+        "rate_burst": 10,  # requests allowed in a burst (token bucket size)
+        "rate_per_minute": 10,  # sustained requests per minute (refill rate)
+        "max_scratch_mb": 16,  # per-run scratch space (largest file and all artifacts together)
+        "max_artifacts": 5,  # files kept from the scratch directory
+        "max_bundle_files": 20,  # files in one multi-file bundle
+        "max_bundle_mb": 1,  # total size of one bundle
         "color": "#ff7875"
     },
     2: {
@@ -20,6 +33,19 @@ USER_LEVELS = {
         "max_saved_codes": 20,  # codes in library
         "max_api_keys": 5,  # API keys limit
         "daily_api_calls": 100,  # API call limit per day
+        "max_output_kb": 256,  # output kept in the execution record
+        "max_output_spill_mb": 32,  # full output kept for download
+        "scheduler_weight": 2,  # share of execution slots for this level's lane
+        "max_concurrent_runs": 2,  # runs per user at the same time
+        "max_queued_runs": 4,  # runs per user waiting for a slot
+        "max_batch_size": 10,  # items per /api/v1/execute/batch call
+        "max_sessions": 2,  # interactive sessions kept at the same time
+        "rate_burst": 20,  # requests allowed in a burst (token bucket size)
+        "rate_per_minute": 30,  # sustained requests per minute (refill rate)
+        "max_scratch_mb": 64,  # per-run scratch space (largest file and all artifacts together)
+        "max_artifacts": 10,  # files kept from the scratch directory
+        "max_bundle_files": 100,  # files in one multi-file bundle
+        "max_bundle_mb": 5,  # total size of one bundle
         "color": "#ffa940"
     },
     3: {
@@ -31,6 +57,19 @@ USER_LEVELS = {
         "max_saved_codes": 100,  # codes in library
         "max_api_keys": 10,  # API keys limit
         "daily_api_calls": 500,  # API call limit per day
+        "max_output_kb": 1024,  # output kept in the execution record
+        "max_output_spill_mb": 128,  # full output kept for download
+        "scheduler_weight": 4,  # share of execution slots for this level's lane
+        "max_concurrent_runs": 4,  # runs per user at the same time
+        "max_queued_runs": 8,  # runs per user waiting for a slot
+        "max_batch_size": 25,  # items per /api/v1/execute/batch call
+        "max_sessions": 3,  # interactive sessions kept at the same time
+        "rate_burst": 50,  # requests allowed in a burst (token bucket size)
+        "rate_per_minute": 60,  # sustained requests per minute (refill rate)
+        "max_scratch_mb": 256,  # per-run scratch space (largest file and all artifacts together)
+        "max_artifacts": 20,  # files kept from the scratch directory
+        "max_bundle_files": 500,  # files in one multi-file bundle
+        "max_bundle_mb": 20,  # total size of one bundle
         "color": "#52c41a"
     },
     4: {
@@ -42,6 +81,19 @@ USER_LEVELS = {
         "max_saved_codes": -1,  # unlimited codes in library
         "max_api_keys": -1,  # unlimited API keys
         "daily_api_calls": -1,  # unlimited API calls
+        "max_output_kb": 4096,  # output kept in the execution record
+        "max_output_spill_mb": 512,  # full output kept for download
+        "scheduler_weight": 8,  # share of execution slots for this level's lane
+        "max_concurrent_runs": 8,  # runs per user at the same time
+        "max_queued_runs": 16,  # runs per user waiting for a slot
+        "max_batch_size": 50,  # items per /api/v1/execute/batch call
+        "max_sessions": 5,  # interactive sessions kept at the same time
+        "rate_burst": 100,  # requests allowed in a burst (token bucket size)
+        "rate_per_minute": 120,  # sustained requests per minute (refill rate)
+        "max_scratch_mb": 1024,  # per-run scratch space (largest file and all artifacts together)
+        "max_artifacts": 50,  # files kept from the scratch directory
+        "max_bundle_files": 2000,  # files in one multi-file bundle
+        "max_bundle_mb": 50,  # total size of one bundle
         "color": "#1890ff"
     }
 }
@@ -52,30 +104,13 @@ def get_user_level_config(level: int):
 
 def get_daily_execution_count(user_id: int, db) -> int:
     """Get today's execution count for a user"""
-    from datetime import date
-    today = date.today()
-    from .database import CodeExecution
-
-    count = db.query(CodeExecution).filter(
-        CodeExecution.user_id == user_id,
-        CodeExecution.created_at >= today
-    ).count()
-
-    return count
+    from services.quota import quota_counters
+    return quota_counters.usage(user_id, db)[0]
 
 def get_daily_api_call_count(user_id: int, db) -> int:
     """Get today's API call count for a user"""
-    from datetime import date
-    today = date.today()
-    from .database import CodeExecution
-
-    count = db.query(CodeExecution).filter(
-        CodeExecution.user_id == user_id,
-        CodeExecution.created_at >= today,
-        CodeExecution.is_api_call == True
-    ).count()
-
-    return count
+    from services.quota import quota_counters
+    return quota_counters.usage(user_id, db)[1]
 
 def can_user_make_api_call(user, db) -> tuple[bool, str]:
     """Check if user can make API calls based on their level limits"""
@@ -10,9 +10,13 @@ from fastapi.responses import FileResponse
 from sqlalchemy.orm import Session
 from sqlalchemy import func, text
 
-from models.database import get_db, User, SystemLog, CodeExecution, CodeLibrary, APIKey, AIConfig, UserEnvironment, Post, Comment, Follow
+from models.database import get_db, User, SystemLog, CodeExecution, CodeLibrary, APIKey, AIConfig, UserEnvironment, Post, Comment, Follow, next_execution_id
 from models.models import SystemLogResponse, UserLogQuery
 from services.auth import get_current_admin_user
+from services import metrics
+from services.quota import quota_counters
+from services.record_writer import record_writer
+from services.runners import runner_registry
 from utils.utils import get_client_info, log_system_event
 
 router = APIRouter(prefix="/admin", tags=["admin"])
@@ -387,7 +391,11 @@ def import_database(
 
             # Replace current database with backup
             import shutil
+            record_writer.flush()
             shutil.copy2(db_backup_path, current_db_path)
+            # In-memory state derived from the old database
+            next_execution_id.reset()
+            quota_counters.reset()
 
             # Reinitialize database connection
             from models.database import engine, SessionLocal
@@ -457,6 +465,18 @@ def import_database(
         raise HTTPException(status_code=500, detail=f"数据库导入失败: {str(e)}")
 
 
+@router.get("/metrics")
+def get_metrics(current_user: User = Depends(get_current_admin_user)):
+    """Execution runtime counters (leaked processes, reaper activity, ...)"""
+    return metrics.snapshot()
+
+
+@router.get("/runners")
+def get_runners(current_user: User = Depends(get_current_admin_user)):
+    """Runner agents with their health, capacity and current load"""
+    return runner_registry.status()
+
+
 @router.get("/database/info")
 def get_database_info(
     current_user: User = Depends(get_current_admin_user),
@@ -6,6 +6,7 @@ from sqlalchemy.orm import Session
 from models.database import get_db, User, AIConfig
 from models.models import AIConfigCreate, AIConfigUpdate, AIConfigResponse, AICodeGenerateRequest, AICodeGenerateResponse
 from services.auth import get_current_user
+from services.rate_limit import rate_limited
 from utils.utils import get_client_info, log_system_event
 
 router = APIRouter(tags=["ai"])
@@ -121,7 +122,7 @@ def delete_ai_config(
     return {"message": "AI配置已删除"}
 
 
-@router.post("/ai/generate-code", response_model=AICodeGenerateResponse)
+@router.post("/ai/generate-code", response_model=AICodeGenerateResponse, dependencies=[Depends(rate_limited("ai"))])
 def generate_code_by_ai(
     request: AICodeGenerateRequest,
     current_user: User = Depends(get_current_user),
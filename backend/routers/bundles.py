@@ -0,0 +1,110 @@
+"""Multi-file bundle routes."""
+from urllib.parse import quote
+from fastapi import APIRouter, Depends, HTTPException, Response
+from sqlalchemy.orm import Session
+
+from models.database import get_db, User, CodeBundle
+from models.models import BundleCreate, BundleResponse, BlobCheckRequest, BlobCheckResponse
+from services.auth import get_current_user
+from services.bundles import (
+    BundleError, MissingBlobsError, bundle_files, create_bundle, get_bundle, is_blob_hash, missing_blobs, read_blob
+)
+from models.user_levels import get_user_level_config
+
+router = APIRouter(prefix="/bundles", tags=["bundles"])
+
+
+def _bundle_response(bundle: CodeBundle) -> BundleResponse:
+    return BundleResponse(
+        bundle_id=bundle.bundle_id,
+        entry_point=bundle.entry_point,
+        files=bundle_files(bundle),
+        file_count=bundle.file_count,
+        total_size=bundle.total_size,
+        created_at=bundle.created_at
+    )
+
+
+def _get_bundle(bundle_id: str, user: User, db: Session) -> CodeBundle:
+    bundle = get_bundle(db, user.id, bundle_id)
+    if not bundle:
+        raise HTTPException(status_code=404, detail="代码包未找到")
+    return bundle
+
+
+@router.post("/missing", response_model=BlobCheckResponse)
+def check_bundle_blobs(
+    check: BlobCheckRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Which file contents (by sha256) still have to be uploaded"""
+    level_config = get_user_level_config(current_user.user_level)
+    if len(check.hashes) > level_config["max_bundle_files"]:
+        raise HTTPException(status_code=400, detail=f"一次最多检查 {level_config['max_bundle_files']} 个文件")
+    invalid = [value for value in check.hashes if not is_blob_hash(value)]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"无效的 sha256: {invalid[0]}")
+    return BlobCheckResponse(missing=missing_blobs(db, current_user.id, check.hashes))
+
+
+@router.post("/", response_model=BundleResponse)
+def create_code_bundle(
+    bundle_data: BundleCreate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Create a bundle from file contents and/or hashes of uploaded contents.
+
+    Answers 409 with the `missing` hashes when files reference contents the
+    server does not have; resend those files with their content.
+    """
+    level_config = get_user_level_config(current_user.user_level)
+    try:
+        bundle = create_bundle(db, current_user.id, bundle_data.entry_point, bundle_data.files, level_config)
+    except MissingBlobsError as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "missing": e.hashes})
+    except BundleError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _bundle_response(bundle)
+
+
+@router.get("/", response_model=list[BundleResponse])
+def get_code_bundles(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    limit: int = 50,
+    offset: int = 0
+):
+    bundles = db.query(CodeBundle).filter(
+        CodeBundle.user_id == current_user.id
+    ).order_by(CodeBundle.created_at.desc()).offset(offset).limit(limit).all()
+    return [_bundle_response(bundle) for bundle in bundles]
+
+
+@router.get("/{bundle_id}", response_model=BundleResponse)
+def get_code_bundle(
+    bundle_id: str,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    return _bundle_response(_get_bundle(bundle_id, current_user, db))
+
+
+@router.get("/{bundle_id}/files/{path:path}")
+def download_bundle_file(
+    bundle_id: str,
+    path: str,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    bundle = _get_bundle(bundle_id, current_user, db)
+    file = next((file for file in bundle_files(bundle) if file["path"] == path), None)
+    if file is None:
+        raise HTTPException(status_code=404, detail="文件不在代码包中")
+    filename = quote(path.rsplit("/", 1)[-1])
+    return Response(
+        content=read_blob(file["sha256"]),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
+    )
@@ -6,11 +6,20 @@ from sqlalchemy.orm import Session
 from models.database import get_db, User, CodeLibrary
 from models.models import CodeLibraryCreate, CodeLibraryUpdate, CodeLibraryResponse, CodeLibrarySaveRequest, CodeLibrarySaveResponse
 from services.auth import get_current_user
+from services.bundles import BundleNotFoundError, adopt_bundle, entry_source, get_bundle, require_bundle
 from models.user_levels import get_user_level_config
 
 router = APIRouter(prefix="/code-library", tags=["code-library"])
 
 
+def _bundle_entry_source(bundle_id: str, user: User, db: Session) -> str:
+    """Entry point of the user's bundle, kept as the entry's code"""
+    try:
+        return entry_source(require_bundle(db, user.id, bundle_id))
+    except BundleNotFoundError:
+        raise HTTPException(status_code=404, detail="代码包未找到")
+
+
 @router.post("/", response_model=CodeLibraryResponse)
 def save_code_to_library(
     code_data: CodeLibraryCreate,
@@ -29,16 +38,28 @@ def save_code_to_library(
             detail=f"代码库已满 ({max_codes} 个代码片段限制)"
         )
 
+    code = code_data.code
+    if code_data.bundle_id:
+        # Also checks that the bundle exists
+        entry_code = _bundle_entry_source(code_data.bundle_id, current_user, db)
+        if code is None:
+            code = entry_code
+    elif code is None:
+        raise HTTPException(status_code=400, detail="请提供 code 或 bundle_id")
+
     # Create new code library entry
     library_entry = CodeLibrary(
         user_id=current_user.id,
         title=code_data.title,
         description=code_data.description,
-        code=code_data.code,
+        code=code,
         language=code_data.language,
         is_public=code_data.is_public,
         tags=code_data.tags,
-        conda_env=code_data.conda_env
+        conda_env=code_data.conda_env,
+        cache_results=code_data.cache_results,
+        cache_ttl=code_data.cache_ttl,
+        bundle_id=code_data.bundle_id
     )
 
     db.add(library_entry)
@@ -95,6 +116,11 @@ def update_code_in_library(
 
     # Update fields
     update_data = code_update.model_dump(exclude_unset=True)
+    if update_data.get("bundle_id"):
+        entry_code = _bundle_entry_source(update_data["bundle_id"], current_user, db)
+        update_data.setdefault("code", entry_code)
+    if "code" in update_data and update_data["code"] is None:
+        del update_data["code"]  # the code itself cannot be cleared
     for field, value in update_data.items():
         setattr(code_entry, field, value)
 
@@ -154,6 +180,10 @@ def save_shared_code_to_library(
         tags=source_code.tags,
         conda_env=save_request.conda_env
     )
+    if source_code.bundle_id:
+        bundle = get_bundle(db, source_code.user_id, source_code.bundle_id)
+        if bundle:
+            new_code.bundle_id = adopt_bundle(db, bundle, current_user.id).bundle_id
 
     db.add(new_code)
     db.commit()
@@ -13,6 +13,9 @@ from models.models import (
     EnvironmentInfo, PackageInfo, PackageInstallRequest, PackageInstallResponse
 )
 from services.auth import get_current_user, get_current_admin_user
+from services.conda_envs import resolve_environment, invalidate_environment, EnvironmentNotFoundError
+from services.executor import parse_preload_modules
+from services.worker_pool import discard_pool
 from utils.utils import log_system_event, get_client_info
 
 router = APIRouter(tags=["environments"])
@@ -144,14 +147,14 @@ def create_user_environment(
 
         # Install additional packages if specified
         if env_data.packages:
-            pip_cmd = f"conda run -n {env_data.env_name} pip"
+            conda_env = resolve_environment(env_data.env_name)
             for package in env_data.packages:
-                install_cmd = f"{pip_cmd} install {package}".split()
                 install_result = subprocess.run(
-                    install_cmd,
+                    conda_env.command("-m", "pip", "install", package),
                     capture_output=True,
                     text=True,
-                    timeout=120  # 2 minutes per package
+                    timeout=120,  # 2 minutes per package
+                    env=conda_env.process_env()
                 )
                 if install_result.returncode != 0:
                     # Log warning but continue with environment creation
@@ -335,6 +338,11 @@ def update_user_environment(
 
     # Update fields
     update_data = env_update.model_dump(exclude_unset=True)
+    if update_data.get("preload_modules") is not None:
+        try:
+            update_data["preload_modules"] = ",".join(parse_preload_modules(update_data["preload_modules"]))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
     for field, value in update_data.items():
         setattr(env, field, value)
 
@@ -383,6 +391,9 @@ def delete_user_environment(
         raise HTTPException(status_code=403, detail="无权删除此环境")
 
     try:
+        # Stop warm workers still running inside the environment
+        discard_pool(env.env_name)
+
         # Remove conda environment
         remove_cmd = f"conda env remove -n {env.env_name} -y"
         result = subprocess.run(
@@ -396,6 +407,8 @@ def delete_user_environment(
             error_msg = result.stderr.strip() if result.stderr else "环境删除失败"
             raise HTTPException(status_code=500, detail=f"Conda环境删除失败: {error_msg}")
 
+        invalidate_environment(env.env_name)
+
         # Remove from models.database
         db.delete(env)
         db.commit()
@@ -468,6 +481,9 @@ def admin_delete_environment(
         raise HTTPException(status_code=404, detail="环境未找到")
 
     try:
+        # Stop warm workers still running inside the environment
+        discard_pool(env.env_name)
+
         # Remove conda environment
         remove_cmd = f"conda env remove -n {env.env_name} -y"
         result = subprocess.run(
@@ -481,6 +497,8 @@ def admin_delete_environment(
             error_msg = result.stderr.strip() if result.stderr else "环境删除失败"
             raise HTTPException(status_code=500, detail=f"Conda环境删除失败: {error_msg}")
 
+        invalidate_environment(env.env_name)
+
         # Remove from models.database
         db.delete(env)
         db.commit()
@@ -555,44 +573,41 @@ def get_environment_info(
                 raise HTTPException(status_code=403, detail="无权访问此环境")
     try:
         # Get Python version and environment info
-        python_cmd = f"conda run -n {env_name} python" if env_name != "base" else "python"
+        conda_env = resolve_environment(env_name)
+        process_env = conda_env.process_env()
 
         # Get Python version
         version_result = subprocess.run(
-            f"{python_cmd} --version".split(),
+            conda_env.command("--version"),
             capture_output=True,
             text=True,
-            timeout=10
+            timeout=10,
+            env=process_env
         )
 
         python_version = version_result.stdout.strip() if version_result.returncode == 0 else "Unknown"
 
-        # Get Python executable path
-        path_result = subprocess.run(
-            f"{python_cmd} -c \"import sys; print(sys.executable)\"".split(),
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-
-        python_path = path_result.stdout.strip() if path_result.returncode == 0 else "Unknown"
+        # Python executable path is known from the resolver
+        python_path = conda_env.python
 
         # Get site packages path
         site_packages_result = subprocess.run(
-            f"{python_cmd} -c \"import site; print(site.getsitepackages()[0])\"".split(),
+            conda_env.command("-c", "import site; print(site.getsitepackages()[0])"),
             capture_output=True,
             text=True,
-            timeout=10
+            timeout=10,
+            env=process_env
         )
 
         site_packages_path = site_packages_result.stdout.strip() if site_packages_result.returncode == 0 else "Unknown"
 
         # Count installed packages
         pip_list_result = subprocess.run(
-            f"{python_cmd} -m pip list".split(),
+            conda_env.command("-m", "pip", "list"),
             capture_output=True,
             text=True,
-            timeout=15
+            timeout=15,
+            env=process_env
         )
 
         package_count = 0
@@ -612,6 +627,8 @@ def get_environment_info(
             "environment_type": "系统默认" if env_name == "base" else "虚拟环境"
         }
 
+    except EnvironmentNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except subprocess.TimeoutExpired:
         raise HTTPException(status_code=408, detail="获取环境信息超时")
     except Exception as e:
@@ -649,33 +666,37 @@ def get_environment_packages(
                 raise HTTPException(status_code=403, detail="无权访问此环境")
     try:
         # Get Python version and installed packages
-        python_cmd = f"conda run -n {env_name} python" if env_name != "base" else "python"
+        conda_env = resolve_environment(env_name)
+        process_env = conda_env.process_env()
 
         # Get Python version
         version_result = subprocess.run(
-            f"{python_cmd} --version".split(),
+            conda_env.command("--version"),
             capture_output=True,
             text=True,
-            timeout=10
+            timeout=10,
+            env=process_env
         )
 
         python_version = version_result.stdout.strip() if version_result.returncode == 0 else "Unknown"
 
         # Get installed packages using pip list
         pip_list_result = subprocess.run(
-            f"{python_cmd} -m pip list --format=json".split(),
+            conda_env.command("-m", "pip", "list", "--format=json"),
             capture_output=True,
             text=True,
-            timeout=30
+            timeout=30,
+            env=process_env
         )
 
         if pip_list_result.returncode != 0:
             # Fallback to pip list without json format
             pip_list_result = subprocess.run(
-                f"{python_cmd} -m pip list".split(),
+                conda_env.command("-m", "pip", "list"),
                 capture_output=True,
                 text=True,
-                timeout=30
+                timeout=30,
+                env=process_env
             )
 
             if pip_list_result.returncode == 0:
@@ -714,6 +735,8 @@ def get_environment_packages(
 
         return packages
 
+    except EnvironmentNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except subprocess.TimeoutExpired:
         raise HTTPException(status_code=408, detail="获取包列表超时")
     except Exception as e:
@@ -763,17 +786,18 @@ def install_package(
         if not re.match(r'^[a-zA-Z0-9\-_.==>=<]+$', package_name):
             raise HTTPException(status_code=400, detail="包名格式无效")
 
-        # Determine python command
-        python_cmd = f"conda run -n {env_name} python" if env_name != "base" else "python"
-        pip_cmd = f"conda run -n {env_name} pip" if env_name != "base" else "pip"
+        # Resolve the environment's interpreter
+        conda_env = resolve_environment(env_name)
 
         # Install the package
         install_result = subprocess.run(
-            f"{pip_cmd} install {package_name}".split(),
+            conda_env.command("-m", "pip", "install", package_name),
             capture_output=True,
             text=True,
-            timeout=300  # 5 minutes timeout for installation
+            timeout=300,  # 5 minutes timeout for installation
+            env=conda_env.process_env()
         )
+        invalidate_environment(env_name)
 
         if install_result.returncode != 0:
             error_msg = install_result.stderr.strip() if install_result.stderr else "安装失败"
@@ -879,16 +903,18 @@ def uninstall_package(
         if package_name.lower() in critical_packages:
             raise HTTPException(status_code=400, detail=f"不能卸载关键包: {package_name}")
 
-        # Determine pip command
-        pip_cmd = f"conda run -n {env_name} pip" if env_name != "base" else "pip"
+        # Resolve the environment's interpreter
+        conda_env = resolve_environment(env_name)
 
         # Uninstall the package
         uninstall_result = subprocess.run(
-            f"{pip_cmd} uninstall -y {package_name}".split(),
+            conda_env.command("-m", "pip", "uninstall", "-y", package_name),
             capture_output=True,
             text=True,
-            timeout=120  # 2 minutes timeout for uninstallation
+            timeout=120,  # 2 minutes timeout for uninstallation
+            env=conda_env.process_env()
         )
+        invalidate_environment(env_name)
 
         if uninstall_result.returncode != 0:
             error_msg = uninstall_result.stderr.strip() if uninstall_result.stderr else "卸载失败"
@@ -989,16 +1015,18 @@ def upgrade_package(
         if not re.match(r'^[a-zA-Z0-9\-_.]+$', package_name):
             raise HTTPException(status_code=400, detail="包名格式无效")
 
-        # Determine pip command
-        pip_cmd = f"conda run -n {env_name} pip" if env_name != "base" else "pip"
+        # Resolve the environment's interpreter
+        conda_env = resolve_environment(env_name)
 
         # Upgrade the package
         upgrade_result = subprocess.run(
-            f"{pip_cmd} install --upgrade {package_name}".split(),
+            conda_env.command("-m", "pip", "install", "--upgrade", package_name),
             capture_output=True,
             text=True,
-            timeout=300  # 5 minutes timeout for upgrade
+            timeout=300,  # 5 minutes timeout for upgrade
+            env=conda_env.process_env()
         )
+        invalidate_environment(env_name)
 
         if upgrade_result.returncode != 0:
             error_msg = upgrade_result.stderr.strip() if upgrade_result.stderr else "升级失败"
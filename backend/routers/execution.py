@@ -1,21 +1,64 @@
 """Code execution routes."""
-import subprocess
-import tempfile
+import json
+import mimetypes
 import os
-import time
-from fastapi import APIRouter, Depends, HTTPException
+import queue
+import re
+import threading
+from typing import Optional
+from urllib.parse import quote
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
 from sqlalchemy.orm import Session
 
 from models.database import get_db, User, CodeExecution
 from models.models import CodeExecutionRequest, CodeExecutionResponse
 from services.auth import get_current_user, get_current_admin_user
-from models.user_levels import get_user_level_config, can_user_execute, get_daily_execution_count
-from utils.utils import log_system_event, get_client_info
+from services.bundles import BundleError, MissingBlobsError, bundle_payload, create_bundle, entry_source, get_bundle
+from services.executor import get_environment_workers, format_execution_output, stored_profile
+from services.jobs import job_scheduler, JobQueueFullError
+from services.output_capture import read_output_range
+from services.quota import quota_counters
+from services.rate_limit import rate_limited
+from services.record_writer import record_writer
+from services.runners import dispatch_code
+from services.scratch import list_artifacts, artifact_chunks
+from services.scheduler import execution_scheduler, ExecutionOverloadedError
+from services.timing import timed
+from services.worker_pool import CancelToken
+from models.user_levels import get_user_level_config, can_user_execute
+from utils.utils import system_log_entry, get_client_info
 
 router = APIRouter(tags=["execution"])
 
 
-@router.post("/execute", response_model=CodeExecutionResponse)
+def _profile_mode(code_request: CodeExecutionRequest):
+    """Profiler to run the request under, None when it did not ask for one"""
+    return code_request.profiler if code_request.profile else None
+
+
+def _resolve_payload(code_request: CodeExecutionRequest, user: User, db: Session,
+                     level_config: dict) -> tuple[str, Optional[str], Optional[dict]]:
+    """Code to record, plus the bundle id and run payload of multi-file requests"""
+    if code_request.files:
+        try:
+            bundle = create_bundle(db, user.id, code_request.entry_point, code_request.files, level_config)
+        except MissingBlobsError as e:
+            raise HTTPException(status_code=409, detail={"message": str(e), "missing": e.hashes})
+        except BundleError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    elif code_request.bundle_id:
+        bundle = get_bundle(db, user.id, code_request.bundle_id)
+        if not bundle:
+            raise HTTPException(status_code=404, detail="代码包未找到")
+    elif code_request.code is not None:
+        return code_request.code, None, None
+    else:
+        raise HTTPException(status_code=400, detail="请提供 code、files 或 bundle_id")
+    return entry_source(bundle), bundle.bundle_id, bundle_payload(bundle)
+
+
+@router.post("/execute", response_model=CodeExecutionResponse, dependencies=[Depends(rate_limited("execute"))])
 def execute_code(
     code_request: CodeExecutionRequest,
     current_user: User = Depends(get_current_user),
@@ -23,120 +66,429 @@ def execute_code(
     client_info: dict = Depends(get_client_info)
 ):
     # Check if user can execute code based on their level
-    can_execute, message = can_user_execute(current_user, db)
+    with timed("quota"):
+        can_execute, message = can_user_execute(current_user, db)
     if not can_execute:
         raise HTTPException(status_code=429, detail=message)
 
     # Get user level configuration
     level_config = get_user_level_config(current_user.user_level)
-
-    # Check daily execution count
-    if level_config["daily_executions"] > 0:
-        today_count = get_daily_execution_count(current_user.id, db)
-        remaining = level_config["daily_executions"] - today_count
-        if remaining <= 0:
-            raise HTTPException(
-                status_code=429,
-                detail=f"今日执行次数已达上限 ({level_config['daily_executions']} 次)"
-            )
-
-    # Create a temporary file for the Python code
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-        f.write(code_request.code)
-        temp_file = f.name
+    code, bundle_id, bundle = _resolve_payload(code_request, current_user, db, level_config)
 
     try:
-        start_time = time.time()
-
-        # Determine which python executable to use based on conda_env
-        if code_request.conda_env and code_request.conda_env != "base":
-            python_executable = f"conda run -n {code_request.conda_env} python"
-        else:
-            python_executable = "python"
-
-        # Execute the Python code with user level limits
-        result = subprocess.run(
-            python_executable.split() + [temp_file],
-            capture_output=True,
-            text=True,
-            timeout=level_config["max_execution_time"]
-        )
-
-        execution_time = int((time.time() - start_time) * 1000)  # in milliseconds
-
-        if result.returncode == 0:
-            output = result.stdout
-            status = "success"
-        else:
-            output = result.stderr
-            status = "error"
+        with execution_scheduler.slot(current_user.id, current_user.user_level):
+            result = dispatch_code(
+                code,
+                code_request.conda_env,
+                level_config,
+                workers=get_environment_workers(db, code_request.conda_env),
+                profile=_profile_mode(code_request),
+                bundle=bundle
+            )
+        output = format_execution_output(result, level_config)
+        status = result.status
 
-        # Save execution record with memory usage (placeholder for now)
+        # Save execution record with measured resource usage
         execution = CodeExecution(
             user_id=current_user.id,
-            code=code_request.code,
+            code=code,
             result=output,
             status=status,
-            execution_time=execution_time,
-            memory_usage=None  # Could be implemented with psutil in the future
+            execution_time=result.execution_time,
+            memory_usage=result.memory_usage,
+            cpu_user_time=result.cpu_user_time,
+            cpu_system_time=result.cpu_system_time,
+            minor_page_faults=result.minor_page_faults,
+            major_page_faults=result.major_page_faults,
+            startup_saved_ms=result.startup_saved_ms,
+            output_size=result.output_size,
+            output_truncated=result.output_truncated,
+            output_path=result.output_path,
+            artifact_count=result.artifact_count,
+            artifacts_path=result.artifacts_path,
+            profile=stored_profile(result),
+            bundle_id=bundle_id
         )
-        db.add(execution)
-        db.commit()
-        db.refresh(execution)
-
-        # Log code execution
-        log_system_event(
-            db=db,
+        # Written in the background; add() assigns the id right away
+        record_writer.add(execution)
+        quota_counters.record(current_user.id)
+        record_writer.add(system_log_entry(
             user_id=current_user.id,
             action="code_execute",
             resource_type="code_execution",
             resource_id=execution.id,
             details={
                 "status": status,
-                "execution_time": execution_time,
-                "code_length": len(code_request.code),
+                "execution_time": result.execution_time,
+                "code_length": len(code),
                 "user_level": current_user.user_level
             },
             ip_address=client_info["ip_address"],
             user_agent=client_info["user_agent"],
             status="success" if status == "success" else "error"
-        )
+        ))
 
         return execution
 
-    except subprocess.TimeoutExpired:
-        output = f"执行超时 ({level_config['max_execution_time']} 秒限制)"
-        status = "timeout"
-        execution = CodeExecution(
-            user_id=current_user.id,
-            code=code_request.code,
-            result=output,
-            status=status,
-            execution_time=level_config["max_execution_time"] * 1000
-        )
-        db.add(execution)
-        db.commit()
-        db.refresh(execution)
-        return execution
-
+    except ExecutionOverloadedError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         output = f"执行错误: {str(e)}"
         status = "error"
         execution = CodeExecution(
             user_id=current_user.id,
-            code=code_request.code,
+            code=code,
             result=output,
             status=status,
-            execution_time=0
+            execution_time=0,
+            bundle_id=bundle_id
         )
-        db.add(execution)
+        record_writer.add(execution)
+        quota_counters.record(current_user.id)
+        return execution
+
+
+@router.post("/execute/stream", dependencies=[Depends(rate_limited("execute"))])
+def execute_code_stream(
+    code_request: CodeExecutionRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    client_info: dict = Depends(get_client_info)
+):
+    """Execute code and stream stdout/stderr as server-sent events.
+
+    Emits `stdout` and `stderr` events while the snippet runs and a final
+    `done` event carrying the persisted CodeExecution. Past the level's
+    output cap a single `truncated` event is sent instead of further chunks.
+    """
+    with timed("quota"):
+        can_execute, message = can_user_execute(current_user, db)
+    if not can_execute:
+        raise HTTPException(status_code=429, detail=message)
+
+    level_config = get_user_level_config(current_user.user_level)
+    code, bundle_id, bundle = _resolve_payload(code_request, current_user, db, level_config)
+    workers = get_environment_workers(db, code_request.conda_env)
+    user_id = current_user.id
+    user_level = current_user.user_level
+    try:
+        ticket = execution_scheduler.submit(user_id, user_level)
+    except ExecutionOverloadedError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    events: queue.Queue = queue.Queue()
+    cancel_token = CancelToken()
+    stream_limit = level_config["max_output_kb"] * 1024
+    streamed = {"bytes": 0, "truncated": False}
+
+    def forward_output(stream, text):
+        if streamed["truncated"]:
+            return
+        streamed["bytes"] += len(text.encode("utf-8", errors="replace"))
+        if streamed["bytes"] > stream_limit:
+            streamed["truncated"] = True
+            events.put(("truncated", {"limit_bytes": stream_limit}))
+            return
+        events.put((stream, text))
+
+    def run_and_persist():
+        try:
+            try:
+                cancel_token.bind(lambda: execution_scheduler.withdraw(ticket))
+                try:
+                    granted = execution_scheduler.wait(ticket)
+                finally:
+                    cancel_token.unbind()
+                if not granted:
+                    # The client left while the run was still queued
+                    events.put(("done", {"status": "cancelled", "result": "执行已取消"}))
+                    return
+                try:
+                    result = dispatch_code(
+                        code,
+                        code_request.conda_env,
+                        level_config,
+                        workers=workers,
+                        cancel_token=cancel_token,
+                        on_output=forward_output,
+                        profile=_profile_mode(code_request),
+                        bundle=bundle
+                    )
+                finally:
+                    execution_scheduler.release(ticket)
+                execution = CodeExecution(
+                    user_id=user_id,
+                    code=code,
+                    result=format_execution_output(result, level_config),
+                    status=result.status,
+                    execution_time=result.execution_time,
+                    memory_usage=result.memory_usage,
+                    cpu_user_time=result.cpu_user_time,
+                    cpu_system_time=result.cpu_system_time,
+                    minor_page_faults=result.minor_page_faults,
+                    major_page_faults=result.major_page_faults,
+                    startup_saved_ms=result.startup_saved_ms,
+                    output_size=result.output_size,
+                    output_truncated=result.output_truncated,
+                    output_path=result.output_path,
+                    artifact_count=result.artifact_count,
+                    artifacts_path=result.artifacts_path,
+                    profile=stored_profile(result),
+                    bundle_id=bundle_id
+                )
+            except ExecutionOverloadedError as e:
+                events.put(("done", {"status": "error", "result": str(e), "retry_after": e.retry_after}))
+                return
+            except Exception as e:
+                execution = CodeExecution(
+                    user_id=user_id,
+                    code=code,
+                    result=f"执行错误: {str(e)}",
+                    status="error",
+                    execution_time=0,
+                    bundle_id=bundle_id
+                )
+            record_writer.add(execution)
+            quota_counters.record(user_id)
+            record_writer.add(system_log_entry(
+                user_id=user_id,
+                action="code_execute",
+                resource_type="code_execution",
+                resource_id=execution.id,
+                details={
+                    "status": execution.status,
+                    "execution_time": execution.execution_time,
+                    "code_length": len(code),
+                    "user_level": user_level,
+                    "streamed": True
+                },
+                ip_address=client_info["ip_address"],
+                user_agent=client_info["user_agent"],
+                status="success" if execution.status == "success" else "error"
+            ))
+            events.put(("done", CodeExecutionResponse.model_validate(execution).model_dump(mode="json")))
+        except Exception as e:
+            events.put(("done", {"status": "error", "result": f"执行错误: {str(e)}"}))
+
+    def event_stream():
+        finished = False
+        try:
+            while not finished:
+                event, data = events.get()
+                finished = event == "done"
+                yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        finally:
+            if not finished:
+                # The client went away, stop the run; it is still recorded
+                cancel_token.cancel()
+
+    threading.Thread(target=run_and_persist, daemon=True).start()
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def _get_execution(execution_id: int, user: User, db: Session) -> CodeExecution:
+    """An execution of the user (any execution for admins), or 404"""
+    query = db.query(CodeExecution).filter(CodeExecution.id == execution_id)
+    if not user.is_admin:
+        query = query.filter(CodeExecution.user_id == user.id)
+    execution = query.first()
+    if not execution:
+        raise HTTPException(status_code=404, detail="执行记录未找到")
+    return execution
+
+
+@router.get("/executions/{execution_id}/output")
+def download_execution_output(
+    execution_id: int,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Download the full output of an execution, supporting byte ranges"""
+    execution = _get_execution(execution_id, current_user, db)
+
+    media_type = "text/plain; charset=utf-8"
+    if not execution.output_path or not os.path.exists(execution.output_path):
+        if execution.output_truncated:
+            raise HTTPException(status_code=410, detail="完整输出已过期")
+        return Response(content=execution.result or "", media_type=media_type)
+
+    range_header = request.headers.get("Range")
+    if not range_header:
+        return FileResponse(
+            execution.output_path,
+            media_type=media_type,
+            filename=f"execution_{execution.id}_output.log",
+            headers={"Accept-Ranges": "bytes"}
+        )
+
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    total = os.path.getsize(execution.output_path)
+    if not match or (not match.group(1) and not match.group(2)):
+        raise HTTPException(status_code=416, detail="无效的Range请求", headers={"Content-Range": f"bytes */{total}"})
+    if match.group(1):
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else None
+    else:
+        # Suffix range: the last N bytes
+        start = max(0, total - int(match.group(2)))
+        end = None
+    if start >= total or (end is not None and end < start):
+        raise HTTPException(status_code=416, detail="Range超出范围", headers={"Content-Range": f"bytes */{total}"})
+
+    data, total = read_output_range(execution.output_path, start, end)
+    return Response(
+        content=data,
+        status_code=206,
+        media_type=media_type,
+        headers={
+            "Content-Range": f"bytes {start}-{start + len(data) - 1}/{total}",
+            "Accept-Ranges": "bytes"
+        }
+    )
+
+
+def _artifacts_path(execution: CodeExecution) -> str:
+    if not execution.artifacts_path:
+        raise HTTPException(status_code=404, detail="该执行没有产出文件")
+    if not os.path.exists(execution.artifacts_path):
+        raise HTTPException(status_code=410, detail="产出文件已过期")
+    return execution.artifacts_path
+
+
+@router.get("/executions/{execution_id}/artifacts")
+def list_execution_artifacts(
+    execution_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Files the run left in its scratch directory"""
+    execution = _get_execution(execution_id, current_user, db)
+    return list_artifacts(_artifacts_path(execution))
+
+
+@router.get("/executions/{execution_id}/artifacts/{name:path}")
+def download_execution_artifact(
+    execution_id: int,
+    name: str,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    execution = _get_execution(execution_id, current_user, db)
+    try:
+        chunks = artifact_chunks(_artifacts_path(execution), name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="产出文件不存在")
+    filename = quote(name.rsplit("/", 1)[-1])
+    return StreamingResponse(
+        chunks,
+        media_type=mimetypes.guess_type(name)[0] or "application/octet-stream",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{filename}"}
+    )
+
+
+@router.post(
+    "/executions/jobs",
+    response_model=CodeExecutionResponse,
+    status_code=202,
+    dependencies=[Depends(rate_limited("execute"))]
+)
+def submit_execution_job(
+    code_request: CodeExecutionRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    client_info: dict = Depends(get_client_info)
+):
+    """Queue code for asynchronous execution and return its id immediately"""
+    with timed("quota"):
+        can_execute, message = can_user_execute(current_user, db)
+    if not can_execute:
+        raise HTTPException(status_code=429, detail=message)
+
+    level_config = get_user_level_config(current_user.user_level)
+    code, bundle_id, bundle = _resolve_payload(code_request, current_user, db, level_config)
+
+    execution = CodeExecution(
+        user_id=current_user.id,
+        code=code,
+        result="",
+        status="queued",
+        execution_time=0,
+        bundle_id=bundle_id
+    )
+    db.add(execution)
+    db.commit()
+    db.refresh(execution)
+    quota_counters.record(current_user.id)
+
+    try:
+        job_scheduler.submit(
+            execution.id,
+            code,
+            code_request.conda_env,
+            level_config,
+            get_environment_workers(db, code_request.conda_env),
+            current_user.id,
+            current_user.user_level,
+            client_info,
+            profile=_profile_mode(code_request),
+            bundle=bundle
+        )
+    except JobQueueFullError as e:
+        db.delete(execution)
+        db.commit()
+        quota_counters.record(current_user.id, amount=-1)
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return execution
+
+
+@router.get("/executions/jobs/{execution_id}", response_model=CodeExecutionResponse)
+def get_execution_job(
+    execution_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Poll the state of an execution job"""
+    execution = db.query(CodeExecution).filter(
+        CodeExecution.id == execution_id,
+        CodeExecution.user_id == current_user.id
+    ).first()
+    if not execution:
+        raise HTTPException(status_code=404, detail="执行任务未找到")
+    return execution
+
+
+@router.delete("/executions/jobs/{execution_id}", response_model=CodeExecutionResponse)
+def cancel_execution_job(
+    execution_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Cancel a queued or running execution job"""
+    execution = db.query(CodeExecution).filter(
+        CodeExecution.id == execution_id,
+        CodeExecution.user_id == current_user.id
+    ).first()
+    if not execution:
+        raise HTTPException(status_code=404, detail="执行任务未找到")
+
+    outcome = job_scheduler.cancel(execution_id)
+    if outcome is None:
+        raise HTTPException(status_code=400, detail="任务已结束，无法取消")
+
+    if outcome == "cancelled":
+        # Never started, so no scheduler thread will write the final state
+        execution.status = "cancelled"
+        execution.result = "执行已取消"
         db.commit()
         db.refresh(execution)
-        return execution
 
-    finally:
-        # Clean up the temporary file
-        os.unlink(temp_file)
+    return execution
 
 
 @router.get("/executions", response_model=list[CodeExecutionResponse])
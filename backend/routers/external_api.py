@@ -1,26 +1,161 @@
 """External API routes (API key authenticated)."""
-import subprocess
-import tempfile
-import os
 import time
-from fastapi import APIRouter, Depends, HTTPException
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
-from models.database import get_db, CodeLibrary, CodeExecution
-from models.models import CodeExecuteByAPIRequest, CodeExecuteByAPIResponse, CodeLibraryResponse
+from models.database import get_db, User, CodeLibrary, CodeExecution
+from models.models import (
+    CodeExecuteByAPIRequest, CodeExecuteByAPIResponse, CodeLibraryResponse,
+    CodeBatchExecuteRequest, CodeBatchItemResponse, CodeBatchExecuteResponse
+)
 from services.auth import get_api_key_user
-from models.user_levels import get_user_level_config, can_user_make_api_call
+from services.bundles import BundleNotFoundError, library_bundle
+from services.executor import (
+    get_environment_workers, format_execution_output, stored_profile, ExecutionResult, WorkerSettings
+)
+from services.idempotency import (
+    idempotency_store, request_fingerprint, IdempotencyConflictError, IDEMPOTENCY_MAX_KEY_LENGTH
+)
+from services.jobs import job_scheduler, JobQueueFullError
+from services.quota import quota_counters
+from services.rate_limit import enforce_rate_limit
+from services.record_writer import record_writer
+from services.result_cache import result_cache
+from services.runners import dispatch_code, runner_registry
+from services.scheduler import execution_scheduler, ExecutionOverloadedError, SCHEDULER_MAX_WAIT
+from services.timing import timed
+from services.webhooks import webhook_dispatcher, validate_callback_url, WebhookQueueFullError
+from models.user_levels import get_user_level_config, can_user_make_api_call, get_daily_api_call_count
+from utils.utils import get_client_info
 
 router = APIRouter(prefix="/api/v1", tags=["external-api"])
 
 
+def _profile_mode(request: CodeExecuteByAPIRequest) -> Optional[str]:
+    return request.profiler if request.profile else None
+
+
+def _run_library_code(code_entry: CodeLibrary, user: User, level_config: dict,
+                      workers: WorkerSettings,
+                      parameters: Optional[dict] = None,
+                      profile: Optional[str] = None,
+                      bundle: Optional[dict] = None) -> tuple[ExecutionResult, bool]:
+    """Run a code library entry; returns the result and whether it came from the cache.
+
+    Cache hits skip execution but are still recorded by the caller, so they
+    count toward the daily API call quota like any other call. Profiled runs
+    always execute and are not cached. `bundle` is the run payload of entries
+    that reference a multi-file bundle.
+    """
+    cache_key = None
+    if code_entry.cache_results and not profile:
+        # Without a known revision on the agents a cached result could be stale
+        revision = runner_registry.environment_revision(code_entry.conda_env)
+        if revision is not None:
+            # A bundle id is the hash of all its files, so it stands for the code
+            source = f"bundle:{code_entry.bundle_id}" if bundle is not None else code_entry.code
+            cache_key = result_cache.key_for(source, code_entry.conda_env, revision, user.user_level, parameters)
+            result = result_cache.get(cache_key)
+            if result is not None:
+                return result, True
+    with execution_scheduler.slot(user.id, user.user_level):
+        result = dispatch_code(
+            code_entry.code, code_entry.conda_env, level_config, workers=workers, parameters=parameters,
+            profile=profile, bundle=bundle
+        )
+    if cache_key is not None:
+        result_cache.put(cache_key, result, code_entry.cache_ttl)
+    return result, False
+
+
+def _api_execution(user: User, code_entry: CodeLibrary, level_config: dict,
+                   result: Optional[ExecutionResult] = None, cached: bool = False,
+                   error: Optional[str] = None) -> CodeExecution:
+    """Execution record of an API call, from its result or its error"""
+    if result is None:
+        return CodeExecution(
+            user_id=user.id,
+            code=code_entry.code,
+            result=f"执行错误: {error}",
+            status="error",
+            execution_time=0,
+            is_api_call=True,
+            code_library_id=code_entry.id,
+            bundle_id=code_entry.bundle_id
+        )
+    return CodeExecution(
+        user_id=user.id,
+        code=code_entry.code,
+        result=format_execution_output(result, level_config),
+        status=result.status,
+        execution_time=result.execution_time,
+        memory_usage=result.memory_usage,
+        cpu_user_time=result.cpu_user_time,
+        cpu_system_time=result.cpu_system_time,
+        minor_page_faults=result.minor_page_faults,
+        major_page_faults=result.major_page_faults,
+        startup_saved_ms=result.startup_saved_ms,
+        output_size=result.output_size,
+        output_truncated=result.output_truncated,
+        output_path=result.output_path,
+        artifact_count=result.artifact_count,
+        artifacts_path=result.artifacts_path,
+        profile=stored_profile(result),
+        cached=cached,
+        is_api_call=True,
+        code_library_id=code_entry.id,
+        bundle_id=code_entry.bundle_id
+    )
+
+
+def _api_response(execution: CodeExecution, code_entry: CodeLibrary) -> CodeExecuteByAPIResponse:
+    return CodeExecuteByAPIResponse(
+        id=execution.id,
+        result=execution.result,
+        status=execution.status,
+        execution_time=execution.execution_time,
+        memory_usage=execution.memory_usage,
+        cpu_user_time=execution.cpu_user_time,
+        cpu_system_time=execution.cpu_system_time,
+        minor_page_faults=execution.minor_page_faults,
+        major_page_faults=execution.major_page_faults,
+        startup_saved_ms=execution.startup_saved_ms,
+        output_size=execution.output_size,
+        output_truncated=execution.output_truncated,
+        artifact_count=execution.artifact_count,
+        profile=execution.profile,
+        cached=execution.cached,
+        bundle_id=execution.bundle_id,
+        created_at=execution.created_at,
+        code_title=code_entry.title
+    )
+
+
 @router.post("/execute", response_model=CodeExecuteByAPIResponse)
 def execute_code_by_api(
     request: CodeExecuteByAPIRequest,
+    http_request: Request,
+    response: Response,
     api_key: str = None,
-    db: Session = Depends(get_db)
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    db: Session = Depends(get_db),
+    client_info: dict = Depends(get_client_info)
 ):
-    """Execute code from library using API key"""
+    """Execute code from library using API key.
+
+    With an `Idempotency-Key` header, retries of a request get the first
+    attempt's response (marked `Idempotent-Replayed: true`) instead of
+    running the code, using quota and writing a record again. Retries of a
+    callback request get the job's record as it is now.
+
+    With a `callback_url` the code runs as a job: the call answers 202 with
+    the queued record right away and the finished record is POSTed to the
+    URL, signed with the API key (see services/webhooks.py).
+    """
 
     # Validate API key and get user
     try:
@@ -28,8 +163,61 @@ def execute_code_by_api(
     except Exception as e:
         raise HTTPException(status_code=401, detail=str(e))
 
+    if not idempotency_key:
+        return _execute_library_request(request, http_request, response, api_key, user, db, client_info)
+    if len(idempotency_key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key 最长 {IDEMPOTENCY_MAX_KEY_LENGTH} 个字符")
+
+    # A duplicate may have to wait for the first attempt to finish
+    wait_timeout = get_user_level_config(user.user_level)["max_execution_time"] + SCHEDULER_MAX_WAIT
+    try:
+        entry, replay = idempotency_store.claim(
+            (user.id, "execute", idempotency_key),
+            request_fingerprint(request.model_dump_json()),
+            wait_timeout
+        )
+    except IdempotencyConflictError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    if entry is None:
+        response.headers["Idempotent-Replayed"] = "true"
+        status_code, replayed = replay
+        response.status_code = status_code
+        if status_code == 202:
+            # The job has moved on since it was accepted
+            return _current_api_response(replayed.id, user, db) or replayed
+        return replayed
+
+    try:
+        api_response = _execute_library_request(request, http_request, response, api_key, user, db, client_info)
+    except BaseException:
+        idempotency_store.abandon(entry)
+        raise
+    idempotency_store.complete(entry, (response.status_code or 200, api_response))
+    return api_response
+
+
+def _current_api_response(execution_id: int, user: User, db: Session) -> Optional[CodeExecuteByAPIResponse]:
+    """Response for the user's API execution record as stored now, None if it is gone"""
+    execution = db.query(CodeExecution).filter(
+        CodeExecution.id == execution_id,
+        CodeExecution.user_id == user.id,
+        CodeExecution.is_api_call == True
+    ).first()
+    if not execution:
+        return None
+    code_entry = db.query(CodeLibrary).filter(CodeLibrary.id == execution.code_library_id).first()
+    if not code_entry:
+        return None
+    return _api_response(execution, code_entry)
+
+
+def _execute_library_request(request: CodeExecuteByAPIRequest, http_request: Request, response: Response,
+                             api_key: str, user: User, db: Session, client_info: dict) -> CodeExecuteByAPIResponse:
+    enforce_rate_limit(http_request, user, "api")
+
     # Check if user can make API calls
-    can_call, message = can_user_make_api_call(user, db)
+    with timed("quota"):
+        can_call, message = can_user_make_api_call(user, db)
     if not can_call:
         raise HTTPException(status_code=429, detail=message)
 
@@ -41,134 +229,251 @@ def execute_code_by_api(
 
     if not code_entry:
         raise HTTPException(status_code=404, detail="代码片段未找到或无权访问")
+    try:
+        bundle = library_bundle(db, code_entry)
+    except BundleNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
     # Get user level configuration
     level_config = get_user_level_config(user.user_level)
 
-    # Create a temporary file for the Python code
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-        # If parameters are provided, we could modify the code here
-        # For now, just use the code as-is
-        f.write(code_entry.code)
-        temp_file = f.name
+    if request.callback_url:
+        response.status_code = 202
+        return _submit_callback_job(request, api_key, user, code_entry, bundle, level_config, db, client_info)
 
     try:
-        start_time = time.time()
-
-        # Determine which python executable to use based on conda_env
-        if code_entry.conda_env and code_entry.conda_env != "base":
-            python_executable = f"conda run -n {code_entry.conda_env} python"
-        else:
-            python_executable = "python"
-
-        # Execute the Python code with user level limits
-        result = subprocess.run(
-            python_executable.split() + [temp_file],
-            capture_output=True,
-            text=True,
-            timeout=level_config["max_execution_time"]
+        result, cached = _run_library_code(
+            code_entry, user, level_config, get_environment_workers(db, code_entry.conda_env), request.parameters,
+            _profile_mode(request), bundle
         )
+        # Save execution record with API call tracking
+        execution = _api_execution(user, code_entry, level_config, result, cached)
+    except ExecutionOverloadedError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        execution = _api_execution(user, code_entry, level_config, error=str(e))
 
-        execution_time = int((time.time() - start_time) * 1000)  # in milliseconds
+    record_writer.add(execution)
+    quota_counters.record(user.id, api_call=True)
 
-        if result.returncode == 0:
-            output = result.stdout
-            status = "success"
-        else:
-            output = result.stderr
-            status = "error"
+    # Create response with code title
+    return _api_response(execution, code_entry)
 
-        # Save execution record with API call tracking
-        execution = CodeExecution(
-            user_id=user.id,
-            code=code_entry.code,
-            result=output,
-            status=status,
-            execution_time=execution_time,
-            memory_usage=None,  # Could be implemented with psutil in the future
-            is_api_call=True,
-            code_library_id=code_entry.id
-        )
-        db.add(execution)
-        db.commit()
-        db.refresh(execution)
-
-        # Create response with code title
-        response = CodeExecuteByAPIResponse(
-            id=execution.id,
-            result=execution.result,
-            status=execution.status,
-            execution_time=execution.execution_time,
-            memory_usage=execution.memory_usage,
-            created_at=execution.created_at,
-            code_title=code_entry.title
-        )
 
-        return response
+def _submit_callback_job(request: CodeExecuteByAPIRequest, api_key: str, user: User, code_entry: CodeLibrary,
+                         bundle: Optional[dict], level_config: dict, db: Session,
+                         client_info: dict) -> CodeExecuteByAPIResponse:
+    """Queue a library run whose result is delivered to the request's callback URL"""
+    try:
+        callback_url = validate_callback_url(request.callback_url)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if webhook_dispatcher.full:
+        raise HTTPException(status_code=503, detail="回调队列已满，请稍后重试")
+
+    execution = CodeExecution(
+        user_id=user.id,
+        code=code_entry.code,
+        result="",
+        status="queued",
+        execution_time=0,
+        is_api_call=True,
+        code_library_id=code_entry.id,
+        bundle_id=code_entry.bundle_id
+    )
+    db.add(execution)
+    db.commit()
+    db.refresh(execution)
+    quota_counters.record(user.id, api_call=True)
+    # The job thread outlives this request's session
+    db.refresh(code_entry)
+    db.expunge(code_entry)
+
+    def deliver(finished: CodeExecution):
+        try:
+            webhook_dispatcher.send(callback_url, _api_response(finished, code_entry).model_dump(mode="json"), api_key)
+        except WebhookQueueFullError:
+            print(f"Webhook for execution {finished.id} dropped, delivery queue is full")
 
-    except subprocess.TimeoutExpired:
-        output = f"执行超时 ({level_config['max_execution_time']} 秒限制)"
-        status = "timeout"
-        execution = CodeExecution(
-            user_id=user.id,
-            code=code_entry.code,
-            result=output,
-            status=status,
-            execution_time=level_config["max_execution_time"] * 1000,
-            is_api_call=True,
-            code_library_id=code_entry.id
+    try:
+        job_scheduler.submit(
+            execution.id,
+            code_entry.code,
+            code_entry.conda_env,
+            level_config,
+            get_environment_workers(db, code_entry.conda_env),
+            user.id,
+            user.user_level,
+            client_info,
+            parameters=request.parameters,
+            on_complete=deliver,
+            profile=_profile_mode(request),
+            bundle=bundle
         )
-        db.add(execution)
+    except JobQueueFullError as e:
+        db.delete(execution)
         db.commit()
-        db.refresh(execution)
-
-        response = CodeExecuteByAPIResponse(
-            id=execution.id,
-            result=execution.result,
-            status=execution.status,
-            execution_time=execution.execution_time,
-            memory_usage=execution.memory_usage,
-            created_at=execution.created_at,
-            code_title=code_entry.title
-        )
+        quota_counters.record(user.id, api_call=True, amount=-1)
+        raise HTTPException(status_code=503, detail=str(e))
+    return _api_response(execution, code_entry)
 
-        return response
 
+@router.get("/executions/{execution_id}", response_model=CodeExecuteByAPIResponse)
+def get_execution_by_api(
+    execution_id: int,
+    http_request: Request,
+    api_key: str = None,
+    db: Session = Depends(get_db)
+):
+    """State of an API execution, e.g. a job started with a callback_url"""
+    try:
+        user, api_key_obj = get_api_key_user(api_key, db)
     except Exception as e:
-        output = f"执行错误: {str(e)}"
-        status = "error"
-        execution = CodeExecution(
-            user_id=user.id,
-            code=code_entry.code,
-            result=output,
-            status=status,
-            execution_time=0,
-            is_api_call=True,
-            code_library_id=code_entry.id
-        )
-        db.add(execution)
-        db.commit()
-        db.refresh(execution)
-
-        response = CodeExecuteByAPIResponse(
-            id=execution.id,
-            result=execution.result,
-            status=execution.status,
-            execution_time=execution.execution_time,
-            memory_usage=execution.memory_usage,
-            created_at=execution.created_at,
-            code_title=code_entry.title
-        )
+        raise HTTPException(status_code=401, detail=str(e))
+    enforce_rate_limit(http_request, user, "api")
+
+    execution = db.query(CodeExecution).filter(
+        CodeExecution.id == execution_id,
+        CodeExecution.user_id == user.id,
+        CodeExecution.is_api_call == True
+    ).first()
+    if not execution:
+        raise HTTPException(status_code=404, detail="执行记录未找到")
+    code_entry = db.query(CodeLibrary).filter(CodeLibrary.id == execution.code_library_id).first()
+    if not code_entry:
+        raise HTTPException(status_code=404, detail="代码片段未找到或无权访问")
+    return _api_response(execution, code_entry)
+
+
+@router.post("/execute/batch", response_model=CodeBatchExecuteResponse)
+def execute_code_batch_by_api(
+    request: CodeBatchExecuteRequest,
+    http_request: Request,
+    response: Response,
+    api_key: str = None,
+    db: Session = Depends(get_db)
+):
+    """Execute several library entries, or one entry per parameter set, in one call.
+
+    Items run concurrently within the caller's per-user run limit. The API
+    key and the daily quota are checked once for the whole batch, while
+    every item is still recorded as an API call. Items that find the
+    scheduler overloaded are neither run nor recorded: they come back with
+    `status_code` 429 and `retry_after`, and the response carries the
+    longest `Retry-After`. With `stream` set, results are sent as NDJSON
+    lines in completion order.
+    """
+    try:
+        user, api_key_obj = get_api_key_user(api_key, db)
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=str(e))
 
-        return response
+    if request.items:
+        items = request.items
+    elif request.code_id is not None:
+        items = [
+            CodeExecuteByAPIRequest(code_id=request.code_id, parameters=parameters)
+            for parameters in (request.parameter_sets or [None])
+        ]
+    else:
+        raise HTTPException(status_code=400, detail="批量执行至少需要一个条目")
 
+    if any(item.callback_url for item in items):
+        raise HTTPException(status_code=400, detail="批量执行不支持 callback_url")
+
+    level_config = get_user_level_config(user.user_level)
+    if len(items) > level_config["max_batch_size"]:
+        raise HTTPException(status_code=400, detail=f"批量执行最多 {level_config['max_batch_size']} 个条目")
+    # Every item takes a token, so a batch cannot bypass the request rate
+    enforce_rate_limit(http_request, user, "api", cost=len(items))
+
+    # One quota query for the whole batch
+    if level_config["daily_api_calls"] > 0:  # -1 means unlimited
+        with timed("quota"):
+            remaining = level_config["daily_api_calls"] - get_daily_api_call_count(user.id, db)
+        if len(items) > remaining:
+            raise HTTPException(status_code=429, detail=f"今日API调用剩余次数不足 (剩余 {max(0, remaining)} 次)")
+
+    code_ids = {item.code_id for item in items}
+    entries = {
+        entry.id: entry for entry in db.query(CodeLibrary).filter(
+            CodeLibrary.id.in_(code_ids),
+            CodeLibrary.user_id == user.id
+        )
+    }
+    missing = code_ids - entries.keys()
+    if missing:
+        raise HTTPException(status_code=404, detail=f"代码片段未找到或无权访问: {sorted(missing)}")
+    try:
+        bundles = {entry.id: library_bundle(db, entry) for entry in entries.values()}
+    except BundleNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    workers = {env: get_environment_workers(db, env) for env in {entry.conda_env for entry in entries.values()}}
+    # Detach what the item threads read, they outlive this request's session
+    for entry in entries.values():
+        db.expunge(entry)
+    db.expunge(user)
+
+    def run_item(index: int, item: CodeExecuteByAPIRequest) -> CodeBatchItemResponse:
+        code_entry = entries[item.code_id]
+        try:
+            result, cached = _run_library_code(
+                code_entry, user, level_config, workers[code_entry.conda_env], item.parameters,
+                _profile_mode(item), bundles[code_entry.id]
+            )
+            execution = _api_execution(user, code_entry, level_config, result, cached)
+        except ExecutionOverloadedError as e:
+            # Not run: neither recorded nor counted against the quota
+            return CodeBatchItemResponse(
+                index=index,
+                code_id=code_entry.id,
+                result=str(e),
+                status="overloaded",
+                execution_time=0,
+                code_title=code_entry.title,
+                status_code=429,
+                retry_after=e.retry_after
+            )
+        except Exception as e:
+            execution = _api_execution(user, code_entry, level_config, error=str(e))
+        record_writer.add(execution)
+        quota_counters.record(user.id, api_call=True)
+        api_response = _api_response(execution, code_entry)
+        return CodeBatchItemResponse(index=index, code_id=code_entry.id, **api_response.model_dump())
+
+    start_time = time.time()
+    pool = ThreadPoolExecutor(
+        max_workers=min(len(items), level_config["max_concurrent_runs"]),
+        thread_name_prefix="api-batch"
+    )
+    futures = [pool.submit(run_item, index, item) for index, item in enumerate(items)]
+
+    if request.stream:
+        def ndjson_stream():
+            try:
+                for future in as_completed(futures):
+                    yield future.result().model_dump_json() + "\n"
+            finally:
+                pool.shutdown(wait=False)
+        return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+
+    try:
+        results = [future.result() for future in futures]
     finally:
-        # Clean up the temporary file
-        os.unlink(temp_file)
+        pool.shutdown(wait=False)
+    retry_after = [item.retry_after for item in results if item.retry_after is not None]
+    if retry_after:
+        response.headers["Retry-After"] = str(max(retry_after))
+    return CodeBatchExecuteResponse(
+        results=results,
+        total=len(results),
+        execution_time=int((time.time() - start_time) * 1000)
+    )
 
 
 @router.get("/codes", response_model=list[CodeLibraryResponse])
 def get_user_codes_by_api(
+    http_request: Request,
     api_key: str = None,
     db: Session = Depends(get_db),
     limit: int = 50,
@@ -181,9 +486,11 @@ def get_user_codes_by_api(
         user, api_key_obj = get_api_key_user(api_key, db)
     except Exception as e:
         raise HTTPException(status_code=401, detail=str(e))
+    enforce_rate_limit(http_request, user, "api")
 
     # Check if user can make API calls
-    can_call, message = can_user_make_api_call(user, db)
+    with timed("quota"):
+        can_call, message = can_user_make_api_call(user, db)
     if not can_call:
         raise HTTPException(status_code=429, detail=message)
 
@@ -196,6 +503,7 @@ def get_user_codes_by_api(
 @router.get("/codes/{code_id}", response_model=CodeLibraryResponse)
 def get_code_by_api(
     code_id: int,
+    http_request: Request,
     api_key: str = None,
     db: Session = Depends(get_db)
 ):
@@ -206,9 +514,11 @@ def get_code_by_api(
         user, api_key_obj = get_api_key_user(api_key, db)
     except Exception as e:
         raise HTTPException(status_code=401, detail=str(e))
+    enforce_rate_limit(http_request, user, "api")
 
     # Check if user can make API calls
-    can_call, message = can_user_make_api_call(user, db)
+    with timed("quota"):
+        can_call, message = can_user_make_api_call(user, db)
     if not can_call:
         raise HTTPException(status_code=429, detail=message)
 
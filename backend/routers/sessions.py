@@ -0,0 +1,144 @@
+"""Interactive session routes."""
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+
+from models.database import get_db, User, CodeExecution
+from models.models import SessionCreateRequest, SessionRunRequest, SessionResponse, CodeExecutionResponse
+from services.auth import get_current_user
+from services.conda_envs import EnvironmentNotFoundError
+from services.executor import format_execution_output
+from services.quota import quota_counters
+from services.rate_limit import rate_limited
+from services.record_writer import record_writer
+from services.scheduler import execution_scheduler, ExecutionOverloadedError
+from services.sessions import session_manager, SessionLimitError, SessionBusyError, InteractiveSession
+from services.timing import timed
+from services.worker_pool import WorkerError
+from models.user_levels import get_user_level_config, can_user_execute
+from utils.utils import log_system_event, system_log_entry, get_client_info
+
+router = APIRouter(prefix="/sessions", tags=["sessions"])
+
+
+def _get_session(session_id: str, user: User) -> InteractiveSession:
+    session = session_manager.get(session_id, user.id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="会话不存在或已过期")
+    return session
+
+
+@router.post("", response_model=SessionResponse, status_code=201)
+def create_session(
+    request: SessionCreateRequest,
+    current_user: User = Depends(get_current_user),
+    client_info: dict = Depends(get_client_info),
+    db: Session = Depends(get_db)
+):
+    """Start a kernel that keeps its globals between cells"""
+    if not current_user.is_active:
+        raise HTTPException(status_code=403, detail="用户账户已被禁用")
+    try:
+        session = session_manager.create(current_user.id, current_user.user_level, request.conda_env)
+    except SessionLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except EnvironmentNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except WorkerError as e:
+        raise HTTPException(status_code=503, detail=f"会话启动失败: {str(e)}")
+
+    log_system_event(
+        db=db,
+        user_id=current_user.id,
+        action="session_create",
+        resource_type="session",
+        details={"session_id": session.id, "conda_env": session.conda_env},
+        ip_address=client_info["ip_address"],
+        user_agent=client_info["user_agent"]
+    )
+    return session
+
+
+@router.get("", response_model=list[SessionResponse])
+def list_sessions(current_user: User = Depends(get_current_user)):
+    return session_manager.list(current_user.id)
+
+
+@router.get("/{session_id}", response_model=SessionResponse)
+def get_session(session_id: str, current_user: User = Depends(get_current_user)):
+    return _get_session(session_id, current_user)
+
+
+@router.post("/{session_id}/run", response_model=CodeExecutionResponse, dependencies=[Depends(rate_limited("execute"))])
+def run_session_cell(
+    session_id: str,
+    request: SessionRunRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    client_info: dict = Depends(get_client_info)
+):
+    """Execute a cell against the session's kept globals"""
+    session = _get_session(session_id, current_user)
+    with timed("quota"):
+        can_execute, message = can_user_execute(current_user, db)
+    if not can_execute:
+        raise HTTPException(status_code=429, detail=message)
+
+    level_config = get_user_level_config(current_user.user_level)
+    try:
+        with execution_scheduler.slot(current_user.id, current_user.user_level):
+            result = session_manager.run(session, request.code)
+        execution = CodeExecution(
+            user_id=current_user.id,
+            code=request.code,
+            result=format_execution_output(result, level_config),
+            status=result.status,
+            execution_time=result.execution_time,
+            memory_usage=result.memory_usage,
+            cpu_user_time=result.cpu_user_time,
+            cpu_system_time=result.cpu_system_time,
+            minor_page_faults=result.minor_page_faults,
+            major_page_faults=result.major_page_faults,
+            output_size=result.output_size,
+            output_truncated=result.output_truncated,
+            output_path=result.output_path,
+            session_id=session.id
+        )
+    except SessionBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ExecutionOverloadedError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        execution = CodeExecution(
+            user_id=current_user.id,
+            code=request.code,
+            result=f"执行错误: {str(e)}",
+            status="error",
+            execution_time=0,
+            session_id=session.id
+        )
+    record_writer.add(execution)
+    quota_counters.record(current_user.id)
+    record_writer.add(system_log_entry(
+        user_id=current_user.id,
+        action="code_execute",
+        resource_type="code_execution",
+        resource_id=execution.id,
+        details={
+            "status": execution.status,
+            "execution_time": execution.execution_time,
+            "code_length": len(request.code),
+            "user_level": current_user.user_level,
+            "session_id": session.id
+        },
+        ip_address=client_info["ip_address"],
+        user_agent=client_info["user_agent"],
+        status="success" if execution.status == "success" else "error"
+    ))
+    return execution
+
+
+@router.delete("/{session_id}")
+def close_session(session_id: str, current_user: User = Depends(get_current_user)):
+    session = _get_session(session_id, current_user)
+    session_manager.close(session.id)
+    return {"message": "会话已关闭"}
@@ -0,0 +1,227 @@
+"""Runner agent: executes snippets on behalf of CodeRunner API servers.
+
+Start one on every host (or several per host) that should take executions,
+with the backend code and the conda environments installed:
+
+    RUNNER_AGENT_TOKEN=... python runner_agent.py --port 8765 --capacity 8
+
+and list them in the API's `RUNNER_AGENTS`. See services/runners.py for the
+protocol.
+"""
+import argparse
+import base64
+import binascii
+import os
+import socket
+import socketserver
+import threading
+import time
+import uuid
+
+from services.conda_envs import EnvironmentNotFoundError, list_environments, resolve_environment
+from services.executor import WorkerSettings, run_code
+from services.runners import (
+    RUNNER_AGENT_TOKEN, RUNNER_DEFAULT_PORT, RunnerProtocolError,
+    check_token, read_message, send_message, result_to_dict
+)
+from services.scratch import cache_blob, cleanup_scratch, uncached_blobs
+from services.worker_pool import CancelToken, shutdown_pools
+
+# Seconds between re-reads of the installed conda environments
+ENVIRONMENTS_REFRESH_INTERVAL = 60
+
+
+class AgentState:
+    def __init__(self, capacity: int):
+        self.agent_id = uuid.uuid4().hex
+        self.capacity = capacity
+        self.slots = threading.BoundedSemaphore(capacity)
+        self.running = 0
+        self.environments: list[str] = []
+        self.revisions: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def refresh_environments(self, refresh: bool = False):
+        environments = list_environments(refresh)
+        revisions = {}
+        for name in environments:
+            try:
+                revisions[name] = resolve_environment(name).revision
+            except EnvironmentNotFoundError:
+                continue
+        self.environments, self.revisions = environments, revisions
+
+    def watch_environments(self):
+        """Keep the reported environments current without slowing down hello"""
+        while True:
+            time.sleep(ENVIRONMENTS_REFRESH_INTERVAL)
+            self.refresh_environments(refresh=True)
+
+    def hello(self) -> dict:
+        return {
+            "type": "hello",
+            "agent_id": self.agent_id,
+            "environments": self.environments,
+            "revisions": self.revisions,
+            "capacity": self.capacity,
+            "running": self.running,
+        }
+
+    def adjust_running(self, delta: int):
+        with self._lock:
+            self.running += delta
+
+
+def _worker_settings(data) -> WorkerSettings:
+    data = data or {}
+    return WorkerSettings(
+        pool_size=data.get("pool_size", WorkerSettings.pool_size),
+        preload_modules=tuple(data.get("preload_modules") or ())
+    )
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+
+    def send(self, message: dict):
+        with self.write_lock:
+            send_message(self.wfile, message)
+
+    def handle(self):
+        state: AgentState = self.server.state
+        try:
+            hello = read_message(self.rfile)
+            if hello.get("type") != "hello" or not check_token(hello.get("token")):
+                self.send({"type": "error", "message": "认证失败"})
+                return
+            self.send(state.hello())
+            while True:
+                message = read_message(self.rfile)
+                kind = message.get("type")
+                if kind == "ping":
+                    self.send({"type": "pong", "capacity": state.capacity, "running": state.running})
+                elif kind == "execute":
+                    self.execute(state, message)
+                    return
+                else:
+                    self.send({"type": "error", "message": f"未知的消息类型: {kind}"})
+                    return
+        except (OSError, RunnerProtocolError):
+            return
+
+    def receive_blobs(self, bundle: dict):
+        """Have the API send the bundle files missing from this host's cache"""
+        missing = uncached_blobs(sorted(set(bundle["files"].values())))
+        if not missing:
+            return
+        self.send({"type": "need", "hashes": missing})
+        for sha256 in missing:
+            message = read_message(self.rfile)
+            if message.get("type") != "blob" or message.get("sha256") != sha256:
+                raise RunnerProtocolError("缺少代码包文件")
+            try:
+                cache_blob(sha256, base64.b64decode(message.get("data") or "", validate=True))
+            except (binascii.Error, ValueError) as e:
+                raise RunnerProtocolError(f"无效的代码包文件: {e}")
+
+    def execute(self, state: AgentState, request: dict):
+        if request.get("bundle"):
+            try:
+                self.receive_blobs(request["bundle"])
+            except RunnerProtocolError as e:
+                self.send({"type": "error", "message": str(e)})
+                return
+
+        token = CancelToken()
+        outcome = {}
+
+        def forward_output(stream: str, text: str):
+            try:
+                self.send({"type": "output", "stream": stream, "text": text})
+            except OSError:
+                token.cancel()  # the API went away
+
+        def run():
+            state.slots.acquire()
+            state.adjust_running(1)
+            try:
+                outcome["result"] = run_code(
+                    request["code"],
+                    request.get("conda_env"),
+                    request["level_config"],
+                    workers=_worker_settings(request.get("workers")),
+                    cancel_token=token,
+                    on_output=forward_output,
+                    parameters=request.get("parameters"),
+                    profile=request.get("profile"),
+                    bundle=request.get("bundle")
+                )
+            except Exception as e:
+                outcome["error"] = e
+            finally:
+                state.adjust_running(-1)
+                state.slots.release()
+                # Unblocks the read below
+                try:
+                    self.connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+
+        runner = threading.Thread(target=run, name="agent-run", daemon=True)
+        runner.start()
+        # Meanwhile the API may ask to cancel, or disconnect
+        try:
+            while runner.is_alive():
+                message = read_message(self.rfile)
+                if message.get("type") == "cancel":
+                    token.cancel()
+        except (OSError, RunnerProtocolError):
+            pass
+        runner.join()
+        error = outcome.get("error")
+        if error is None:
+            self.send({"type": "result", "result": result_to_dict(outcome["result"])})
+        elif isinstance(error, EnvironmentNotFoundError):
+            self.send({"type": "error", "error": "environment_not_found", "message": str(error)})
+        else:
+            self.send({"type": "error", "message": str(error)})
+
+
+class AgentServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, state: AgentState):
+        super().__init__(address, AgentHandler)
+        self.state = state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CodeRunner runner agent")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=RUNNER_DEFAULT_PORT)
+    parser.add_argument("--capacity", type=int, default=max(2, os.cpu_count() or 2),
+                        help="executions run at the same time")
+    args = parser.parse_args()
+    if not RUNNER_AGENT_TOKEN:
+        parser.error("RUNNER_AGENT_TOKEN must be set")
+
+    cleanup_scratch()
+    state = AgentState(max(1, args.capacity))
+    state.refresh_environments()
+    threading.Thread(target=state.watch_environments, name="agent-environments", daemon=True).start()
+    server = AgentServer((args.host, args.port), state)
+    print(f"Runner agent {state.agent_id} listening on {args.host}:{args.port} ({state.capacity} slots)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        shutdown_pools()
+
+
+if __name__ == "__main__":
+    main()
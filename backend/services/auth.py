@@ -8,6 +8,7 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from models.database import get_db, User, APIKey
 from models.models import TokenData
+from services.timing import timed_call
 
 SECRET_KEY = "your-secret-key-here-change-in-production"
 ALGORITHM = "HS256"
@@ -47,6 +48,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+@timed_call("auth")
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -75,6 +77,7 @@ async def get_current_admin_user(current_user: User = Depends(get_current_user))
         )
     return current_user
 
+@timed_call("auth")
 def get_api_key_user(api_key: str, db: Session = Depends(get_db)):
     """Verify API key and return the associated user"""
     api_key_obj = db.query(APIKey).filter(APIKey.key_value == api_key).first()
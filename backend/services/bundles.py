@@ -0,0 +1,275 @@
+"""Content-addressed multi-file bundles.
+
+A bundle is a set of files plus the entry point run as `__main__`. File
+contents are stored once per SHA-256 under `BUNDLE_DIR`, shared by every
+bundle (and user) containing the same file. The bundle itself is only its
+manifest, identified by the SHA-256 of the canonical manifest, so the same
+files and entry point always give the same `bundle_id`. Clients ask which
+contents they still have to upload (`missing_blobs`) and upload only those;
+the other files are referenced by hash. A hash only stands for contents the
+same user has uploaded before (`BundleBlob`), so knowing another user's
+hash neither reveals nor grants their file.
+
+At run time the files are copied into the run's scratch directory from a
+per-host cache (see `ScratchDir.place_files`), so unchanged files are not
+sent to a runner agent again.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import tempfile
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from models.database import BundleBlob, CodeBundle
+from services import metrics
+
+BUNDLE_DIR = "./data/bundles"
+# Largest single file; it travels to runner agents as one protocol line
+BUNDLE_MAX_FILE_MB = 8
+BUNDLE_MAX_PATH_LENGTH = 255
+BUNDLE_DEFAULT_ENTRY_POINT = "main.py"
+
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BundleError(Exception):
+    """Raised for bundles that are invalid or exceed the level's limits"""
+
+
+class BundleNotFoundError(BundleError):
+    """Raised when a referenced bundle does not exist for the user"""
+
+
+class MissingBlobsError(BundleError):
+    """Raised when files are referenced by hashes the server does not have"""
+
+    def __init__(self, hashes: list[str]):
+        self.hashes = hashes
+        super().__init__(f"缺少 {len(hashes)} 个文件的内容，请上传后重试")
+
+
+def blob_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_blob_hash(value) -> bool:
+    return isinstance(value, str) and bool(_SHA256.match(value))
+
+
+def _blob_path(sha256: str) -> str:
+    return os.path.join(BUNDLE_DIR, "blobs", sha256[:2], sha256)
+
+
+def has_blob(sha256: str) -> bool:
+    return is_blob_hash(sha256) and os.path.exists(_blob_path(sha256))
+
+
+def read_blob(sha256: str) -> bytes:
+    with open(_blob_path(sha256), "rb") as f:
+        return f.read()
+
+
+def store_blob(data: bytes) -> str:
+    """Store a file's content once; returns its hash"""
+    sha256 = blob_hash(data)
+    path = _blob_path(sha256)
+    if os.path.exists(path):
+        return sha256
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+        raise
+    metrics.increment("bundle_blobs_stored")
+    return sha256
+
+
+def _owned_blobs(db: Session, user_id: int, hashes) -> set[str]:
+    hashes = set(hashes)
+    if not hashes:
+        return set()
+    rows = db.query(BundleBlob.sha256).filter(BundleBlob.user_id == user_id, BundleBlob.sha256.in_(hashes))
+    return {sha256 for sha256, in rows}
+
+
+def _link_blobs(db: Session, user_id: int, hashes):
+    """Record that the user may reference these contents by hash (committed by the caller)"""
+    hashes = set(hashes)
+    for sha256 in hashes - _owned_blobs(db, user_id, hashes):
+        db.add(BundleBlob(user_id=user_id, sha256=sha256))
+
+
+def missing_blobs(db: Session, user_id: int, hashes) -> list[str]:
+    """Hashes among `hashes` the user has to upload the content of"""
+    owned = _owned_blobs(db, user_id, hashes)
+    return sorted({sha256 for sha256 in hashes if sha256 not in owned or not has_blob(sha256)})
+
+
+def normalize_path(path: str) -> str:
+    """Validate a bundle file path: relative, '/'-separated, no '..'"""
+    if (not path or len(path) > BUNDLE_MAX_PATH_LENGTH or path.startswith("/")
+            or "\\" in path or "\x00" in path
+            or any(part in ("", ".", "..") for part in path.split("/"))):
+        raise BundleError(f"无效的文件路径: {path!r}")
+    return path
+
+
+def bundle_hash(entry_point: str, files: dict[str, str]) -> str:
+    """Id of a bundle: the hash of its canonical manifest"""
+    canonical = json.dumps(
+        {"entry_point": entry_point, "files": sorted(files.items())},
+        ensure_ascii=False,
+        separators=(",", ":")
+    )
+    return blob_hash(canonical.encode("utf-8"))
+
+
+def _file_content(file) -> Optional[bytes]:
+    if file.content is None:
+        return None
+    if file.encoding == "base64":
+        try:
+            return base64.b64decode(file.content, validate=True)
+        except (binascii.Error, ValueError):
+            raise BundleError(f"文件 {file.path} 不是有效的 base64 内容")
+    return file.content.encode("utf-8")
+
+
+def create_bundle(db: Session, user_id: int, entry_point: Optional[str], files: list,
+                  level_config: dict) -> CodeBundle:
+    """Store a bundle for the user and return its record.
+
+    `files` are the request's file entries (path plus either the content or
+    the sha256 of a content the user uploaded before). Creating a bundle the user
+    already has returns the existing record.
+    """
+    if not files:
+        raise BundleError("代码包至少需要一个文件")
+    if len(files) > level_config["max_bundle_files"]:
+        raise BundleError(f"代码包最多 {level_config['max_bundle_files']} 个文件")
+
+    max_file_size = BUNDLE_MAX_FILE_MB * 1024 * 1024
+    manifest: dict[str, str] = {}
+    sizes: dict[str, int] = {}
+    uploads: dict[str, bytes] = {}
+    for file in files:
+        path = normalize_path(file.path)
+        if path in manifest:
+            raise BundleError(f"重复的文件路径: {path}")
+        data = _file_content(file)
+        if data is not None:
+            sha256 = blob_hash(data)
+            if file.sha256 and file.sha256 != sha256:
+                raise BundleError(f"文件 {path} 的内容与 sha256 不符")
+            uploads[sha256] = data
+        elif is_blob_hash(file.sha256):
+            sha256 = file.sha256
+        else:
+            raise BundleError(f"文件 {path} 需要 content 或有效的 sha256")
+        manifest[path] = sha256
+
+    missing = missing_blobs(db, user_id, set(manifest.values()) - uploads.keys())
+    if missing:
+        raise MissingBlobsError(missing)
+    for path, sha256 in manifest.items():
+        data = uploads.get(sha256)
+        sizes[path] = len(data) if data is not None else os.path.getsize(_blob_path(sha256))
+        if sizes[path] > max_file_size:
+            raise BundleError(f"文件 {path} 超过 {BUNDLE_MAX_FILE_MB} MB 限制")
+    total_size = sum(sizes.values())
+    if total_size > level_config["max_bundle_mb"] * 1024 * 1024:
+        raise BundleError(f"代码包超过 {level_config['max_bundle_mb']} MB 限制")
+
+    entry_point = normalize_path(entry_point or BUNDLE_DEFAULT_ENTRY_POINT)
+    if entry_point not in manifest:
+        raise BundleError(f"入口文件不在代码包中: {entry_point}")
+
+    bundle_id = bundle_hash(entry_point, manifest)
+    existing = get_bundle(db, user_id, bundle_id)
+    if existing is not None:
+        return existing
+    for data in uploads.values():
+        store_blob(data)
+    _link_blobs(db, user_id, uploads)
+    bundle = CodeBundle(
+        user_id=user_id,
+        bundle_id=bundle_id,
+        entry_point=entry_point,
+        manifest=json.dumps(
+            [{"path": path, "sha256": manifest[path], "size": sizes[path]} for path in sorted(manifest)]
+        ),
+        file_count=len(manifest),
+        total_size=total_size
+    )
+    db.add(bundle)
+    db.commit()
+    db.refresh(bundle)
+    return bundle
+
+
+def get_bundle(db: Session, user_id: int, bundle_id: str) -> Optional[CodeBundle]:
+    return db.query(CodeBundle).filter(CodeBundle.user_id == user_id, CodeBundle.bundle_id == bundle_id).first()
+
+
+def require_bundle(db: Session, user_id: int, bundle_id: str) -> CodeBundle:
+    bundle = get_bundle(db, user_id, bundle_id)
+    if bundle is None:
+        raise BundleNotFoundError(f"代码包未找到: {bundle_id}")
+    return bundle
+
+
+def adopt_bundle(db: Session, bundle: CodeBundle, user_id: int) -> CodeBundle:
+    """The user's record of another user's bundle, e.g. for a copied library entry"""
+    existing = get_bundle(db, user_id, bundle.bundle_id)
+    if existing is not None:
+        return existing
+    _link_blobs(db, user_id, (file["sha256"] for file in bundle_files(bundle)))
+    copy = CodeBundle(
+        user_id=user_id,
+        bundle_id=bundle.bundle_id,
+        entry_point=bundle.entry_point,
+        manifest=bundle.manifest,
+        file_count=bundle.file_count,
+        total_size=bundle.total_size
+    )
+    db.add(copy)
+    db.commit()
+    db.refresh(copy)
+    return copy
+
+
+def bundle_files(bundle: CodeBundle) -> list[dict]:
+    return json.loads(bundle.manifest)
+
+
+def bundle_payload(bundle: CodeBundle) -> dict:
+    """What `run_code` needs to run the bundle; plain JSON for runner agents"""
+    return {
+        "entry_point": bundle.entry_point,
+        "files": {file["path"]: file["sha256"] for file in bundle_files(bundle)},
+    }
+
+
+def entry_source(bundle: CodeBundle) -> str:
+    """Source of the entry point, recorded as the execution's code"""
+    sha256 = next(file["sha256"] for file in bundle_files(bundle) if file["path"] == bundle.entry_point)
+    return read_blob(sha256).decode("utf-8", errors="replace")
+
+
+def library_bundle(db: Session, code_entry) -> Optional[dict]:
+    """Run payload of a code library entry that references a bundle"""
+    if not code_entry.bundle_id:
+        return None
+    return bundle_payload(require_bundle(db, code_entry.user_id, code_entry.bundle_id))
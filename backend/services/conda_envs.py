@@ -0,0 +1,209 @@
+"""Resolve conda environments to direct interpreter paths.
+
+`conda run -n <env> python` pays for a second Python start-up plus the
+activation scripts on every call. Instead, each environment is resolved once
+to its `bin/python` and the variables activation would set, and the result
+is cached until the environment's `conda-meta` or `site-packages` directory
+changes. The latter catches pip installs and removals on every host,
+including runner agents that never see the API's `invalidate_environment`.
+"""
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+# Variables that differ between any two processes and must not be copied
+# from the activation probe
+_VOLATILE_VARS = {"_", "PWD", "OLDPWD", "SHLVL", "TERM_SESSION_ID"}
+
+
+class EnvironmentNotFoundError(Exception):
+    """Raised when a conda environment does not exist on this host"""
+
+
+@dataclass
+class CondaEnvironment:
+    name: str
+    prefix: Optional[str]
+    python: str
+    revision: str
+    env_vars: dict = field(default_factory=dict)  # applied on top of os.environ
+
+    def command(self, *args: str) -> list[str]:
+        """Command line running the environment's interpreter"""
+        return [self.python, *args]
+
+    def process_env(self) -> dict:
+        """Full environment for a subprocess running inside this env"""
+        env = os.environ.copy()
+        env.update(self.env_vars)
+        return env
+
+
+_cache: dict[str, CondaEnvironment] = {}
+_generations: dict[str, int] = {}
+_site_dirs: dict[str, list[str]] = {}
+_conda_info: Optional[dict] = None
+_lock = threading.Lock()
+
+
+def _load_conda_info(refresh: bool = False) -> dict:
+    global _conda_info
+    if _conda_info is None or refresh:
+        try:
+            result = subprocess.run(
+                ["conda", "info", "--json"],
+                capture_output=True,
+                text=True,
+                timeout=30
+            )
+            _conda_info = json.loads(result.stdout) if result.returncode == 0 else {}
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            _conda_info = {}
+    return _conda_info
+
+
+def _find_prefix(env_name: str) -> Optional[str]:
+    for refresh in (False, True):
+        info = _load_conda_info(refresh)
+        candidates = [os.path.join(envs_dir, env_name) for envs_dir in info.get("envs_dirs", [])]
+        candidates += [prefix for prefix in info.get("envs", []) if os.path.basename(prefix) == env_name]
+        for prefix in candidates:
+            if os.path.isdir(os.path.join(prefix, "conda-meta")):
+                return prefix
+    return None
+
+
+def _site_packages(prefix: str) -> list[str]:
+    """site-packages directories of the environment, looked up once per prefix"""
+    with _lock:
+        dirs = _site_dirs.get(prefix)
+    if dirs is None:
+        if os.name == "nt":
+            dirs = [os.path.join(prefix, "Lib", "site-packages")]
+        else:
+            dirs = sorted(glob.glob(os.path.join(prefix, "lib", "python3*", "site-packages")))
+        with _lock:
+            _site_dirs[prefix] = dirs
+    return dirs
+
+
+def _meta_revision(prefix: Optional[str], generation: int) -> str:
+    """Revision string that changes whenever conda or pip modifies the environment"""
+    parts = []
+    if prefix:
+        meta_dir = os.path.join(prefix, "conda-meta")
+        # pip adds and removes package directories, which touches site-packages
+        for path in (meta_dir, os.path.join(meta_dir, "history"), *_site_packages(prefix)):
+            try:
+                parts.append(str(os.stat(path).st_mtime_ns))
+            except OSError:
+                parts.append("0")
+    parts.append(str(generation))
+    return ":".join(parts)
+
+
+def _python_in_prefix(prefix: str) -> str:
+    if os.name == "nt":
+        return os.path.join(prefix, "python.exe")
+    return os.path.join(prefix, "bin", "python")
+
+
+def _static_activation_vars(env_name: str, prefix: str) -> dict:
+    """Variables `conda activate` sets even without activate.d scripts"""
+    bin_dir = os.path.dirname(_python_in_prefix(prefix))
+    env_vars = {
+        "PATH": bin_dir + os.pathsep + os.environ.get("PATH", ""),
+        "CONDA_PREFIX": prefix,
+        "CONDA_DEFAULT_ENV": env_name,
+    }
+    # Variables registered with `conda env config vars set`
+    try:
+        with open(os.path.join(prefix, "conda-meta", "state")) as f:
+            env_vars.update(json.load(f).get("env_vars", {}))
+    except (OSError, ValueError):
+        pass
+    return env_vars
+
+
+def _probe_activation_vars(env_name: str, prefix: str) -> dict:
+    """Capture what a full activation sets, including activate.d scripts.
+
+    This is the only place `conda run` is still used, once per revision.
+    """
+    try:
+        result = subprocess.run(
+            ["conda", "run", "-n", env_name, "python", "-c",
+             "import json, os; print(json.dumps(dict(os.environ)))"],
+            capture_output=True,
+            text=True,
+            timeout=60
+        )
+        if result.returncode == 0:
+            activated = json.loads(result.stdout.strip().splitlines()[-1])
+            return {
+                key: value for key, value in activated.items()
+                if key not in _VOLATILE_VARS and os.environ.get(key) != value
+            }
+    except (OSError, ValueError, IndexError, subprocess.TimeoutExpired):
+        pass
+    return _static_activation_vars(env_name, prefix)
+
+
+def resolve_environment(env_name: Optional[str]) -> CondaEnvironment:
+    """Resolve an environment name to its interpreter and activation vars"""
+    env_name = env_name or "base"
+
+    with _lock:
+        generation = _generations.get(env_name, 0)
+        cached = _cache.get(env_name)
+    if cached is not None and _meta_revision(cached.prefix, generation) == cached.revision:
+        return cached
+
+    if env_name == "base":
+        # "base" means the interpreter the API itself finds on PATH
+        python = shutil.which("python") or sys.executable
+        prefix = os.path.dirname(os.path.dirname(python))
+        resolved = CondaEnvironment("base", prefix, python, _meta_revision(prefix, generation))
+    else:
+        prefix = _find_prefix(env_name)
+        if prefix is None or not os.path.exists(_python_in_prefix(prefix)):
+            with _lock:
+                _cache.pop(env_name, None)
+            raise EnvironmentNotFoundError(f"Conda环境不存在: {env_name}")
+        resolved = CondaEnvironment(
+            env_name,
+            prefix,
+            _python_in_prefix(prefix),
+            _meta_revision(prefix, generation),
+            _probe_activation_vars(env_name, prefix)
+        )
+
+    with _lock:
+        if _generations.get(env_name, 0) == generation:
+            _cache[env_name] = resolved
+    return resolved
+
+
+def invalidate_environment(env_name: Optional[str]):
+    """Force re-resolution, e.g. after pip changed the environment's packages"""
+    env_name = env_name or "base"
+    with _lock:
+        _generations[env_name] = _generations.get(env_name, 0) + 1
+        _cache.pop(env_name, None)
+
+
+def list_environments(refresh: bool = False) -> list[str]:
+    """Names of the conda environments available on this host"""
+    info = _load_conda_info(refresh)
+    names = ["base"]
+    for prefix in info.get("envs", []):
+        name = os.path.basename(prefix)
+        if prefix != info.get("root_prefix") and name not in names and os.path.isdir(os.path.join(prefix, "conda-meta")):
+            names.append(name)
+    return names
@@ -0,0 +1,494 @@
+"""Code execution dispatch shared by the web and external API routes."""
+import codecs
+import json
+import os
+import posixpath
+import re
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from sqlalchemy.orm import Session
+
+from models.database import UserEnvironment
+from services.conda_envs import CondaEnvironment, resolve_environment
+from services import metrics
+from services.import_router import select_pool
+from services.output_capture import ExecutionOutput
+from services.process_reaper import kill_process_group, finish_process_group, record_leaked
+from services.bundles import read_blob
+from services.scratch import ScratchDir
+from services.timing import record_phase, timed
+from services.worker_pool import CancelToken, Worker, get_pool, WORKER_SCRIPT, WORKER_POOL_DEFAULT_SIZE, WORKER_POOL_MAX_SIZE
+
+# Warm workers rely on fork(); other platforms always use a cold subprocess
+WARM_WORKERS_SUPPORTED = hasattr(os, "fork")
+
+# Receives (stream, text) for every stdout/stderr chunk
+OutputCallback = Callable[[str, str], None]
+
+# Delegated cgroup v2 directory (with the memory controller enabled in its
+# subtree_control) under which each run gets its own memory.max. When it is
+# missing or not writable the ceiling falls back to RLIMIT_AS.
+EXECUTION_CGROUP_ROOT = "/sys/fs/cgroup/coderunner"
+# Profilers a run can be executed under (see worker_main._Profiler)
+PROFILE_MODES = ("sampling", "cprofile")
+# Report written into the run's scratch directory by a profiled run
+PROFILE_FILE = ".coderunner-profile.json"
+
+
+@dataclass
+class ExecutionResult:
+    status: str  # "success", "error", "timeout", "memory_exceeded", "cancelled"
+    stdout: str
+    stderr: str
+    returncode: Optional[int]
+    execution_time: int  # in milliseconds
+    memory_usage: Optional[int] = None  # peak RSS in MB
+    cpu_user_time: Optional[int] = None  # in milliseconds
+    cpu_system_time: Optional[int] = None  # in milliseconds
+    minor_page_faults: Optional[int] = None
+    major_page_faults: Optional[int] = None
+    output_size: int = 0  # bytes produced on the stored stream
+    output_truncated: bool = False
+    output_path: Optional[str] = None  # spilled full output, if truncated
+    startup_saved_ms: Optional[int] = None  # interpreter start and preloads skipped by a warm run
+    artifact_count: int = 0  # files kept from the run's scratch directory
+    artifacts_path: Optional[str] = None  # zip archive holding them
+    profile: Optional[dict] = None  # report of a profiled run
+
+    @property
+    def output(self) -> str:
+        return self.stdout if self.status == "success" else self.stderr
+
+
+@dataclass
+class WorkerSettings:
+    """How the warm workers of an environment are set up"""
+    pool_size: int = WORKER_POOL_DEFAULT_SIZE
+    preload_modules: tuple[str, ...] = ()  # imported once per worker, before any fork
+
+
+_MODULE_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+
+def parse_preload_modules(value: Optional[str]) -> tuple[str, ...]:
+    """Split a comma separated module list, raising ValueError on bad names"""
+    modules = []
+    for name in re.split(r"[,\s]+", value or ""):
+        if not name:
+            continue
+        if not _MODULE_NAME.match(name):
+            raise ValueError(f"无效的模块名: {name}")
+        if name not in modules:
+            modules.append(name)
+    return tuple(modules)
+
+
+def get_environment_workers(db: Session, conda_env: Optional[str]) -> WorkerSettings:
+    """Configured warm-worker settings of an environment"""
+    settings = WorkerSettings()
+    if conda_env and conda_env != "base":
+        env = db.query(UserEnvironment).filter(UserEnvironment.env_name == conda_env).first()
+        if env and env.worker_pool_size is not None:
+            settings.pool_size = min(max(0, env.worker_pool_size), WORKER_POOL_MAX_SIZE)
+        if env and env.preload_modules:
+            try:
+                settings.preload_modules = parse_preload_modules(env.preload_modules)
+            except ValueError:
+                pass
+    return settings
+
+
+def stored_profile(result: ExecutionResult) -> Optional[str]:
+    """Profile report as stored on CodeExecution.profile"""
+    return json.dumps(result.profile) if result.profile is not None else None
+
+
+def format_execution_output(result: ExecutionResult, level_config: dict) -> str:
+    """Text stored in CodeExecution.result for a finished run"""
+    if result.status == "timeout":
+        return f"执行超时 ({level_config['max_execution_time']} 秒限制)"
+    if result.status == "cancelled":
+        return "执行已取消"
+    if result.status == "memory_exceeded":
+        message = f"内存超限 ({level_config['max_memory']} MB 限制)"
+        return f"{result.stderr}\n{message}" if result.stderr else message
+    return result.output
+
+
+class _OutputCollector:
+    """Captures streamed output within the level's bounds and forwards it"""
+
+    def __init__(self, level_config: dict, on_output: Optional[OutputCallback] = None):
+        self.on_output = on_output
+        self.output = ExecutionOutput.for_level(level_config)
+        self._lock = threading.Lock()
+
+    def __call__(self, stream: str, text: str):
+        with self._lock:
+            self.output.write(stream, text)
+        if self.on_output is not None:
+            self.on_output(stream, text)
+
+    def last_line(self, stream: str) -> str:
+        with self._lock:
+            lines = self.output.streams[stream].text().rstrip().splitlines()
+            return lines[-1] if lines else ""
+
+    def abandon(self):
+        """Drop everything captured, used when the run itself failed"""
+        with self._lock:
+            for capture in self.output.streams.values():
+                capture.discard()
+
+    def result(self, status: str, returncode: Optional[int], execution_time: int,
+               usage: Optional[dict] = None) -> ExecutionResult:
+        with self._lock:
+            self.output.close()
+            stdout = self.output.streams["stdout"]
+            stderr = self.output.streams["stderr"]
+            result = ExecutionResult(status, stdout.text(), stderr.text(), returncode, execution_time)
+            if usage:
+                _apply_usage(result, usage)
+
+            kept = None
+            if status == "success":
+                kept = stdout
+            elif status in ("error", "memory_exceeded"):
+                kept = stderr
+            for capture in (stdout, stderr):
+                if capture is not kept:
+                    capture.discard()
+            if kept is not None:
+                result.output_size = kept.total_bytes
+                result.output_truncated = kept.truncated
+                result.output_path = kept.spill_path
+            return result
+
+
+def _apply_usage(result: ExecutionResult, usage: dict):
+    """Copy resource accounting reported by a runner onto the result"""
+    if usage.get("max_rss_kb") is not None:
+        result.memory_usage = (usage["max_rss_kb"] + 1023) // 1024
+    if usage.get("user_time") is not None:
+        result.cpu_user_time = int(usage["user_time"] * 1000)
+        result.cpu_system_time = int(usage.get("system_time", 0) * 1000)
+    result.minor_page_faults = usage.get("minor_faults")
+    result.major_page_faults = usage.get("major_faults")
+
+
+def _rusage_dict(rusage) -> dict:
+    # ru_maxrss is in KB on Linux
+    return {
+        "max_rss_kb": rusage.ru_maxrss,
+        "user_time": rusage.ru_utime,
+        "system_time": rusage.ru_stime,
+        "minor_faults": rusage.ru_minflt,
+        "major_faults": rusage.ru_majflt,
+    }
+
+
+class _GroupFinisher:
+    """Finishes a run's process group; only the first call counts leaked processes.
+
+    Timeout, cancel and the end of the run all finish the group, and a
+    second count would find the processes the first one just killed.
+    """
+
+    def __init__(self, pgid: int):
+        self.pgid = pgid
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            first, self._finished = not self._finished, True
+        if first:
+            finish_process_group(self.pgid)
+        else:
+            kill_process_group(self.pgid)
+
+
+def _wait_with_usage(process: subprocess.Popen, timeout: int,
+                     finish: _GroupFinisher) -> tuple[bool, Optional[dict]]:
+    """Wait for a cold-started process and collect its rusage via wait4.
+
+    Returns whether it timed out (and was killed) and its resource usage.
+    """
+    if not hasattr(os, "wait4"):
+        try:
+            process.wait(timeout=timeout)
+            return False, None
+        except subprocess.TimeoutExpired:
+            kill_process_group(process.pid)
+            process.wait()
+            return True, None
+
+    deadline = time.monotonic() + timeout
+    delay = 0.001
+    timed_out = False
+    while True:
+        pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if time.monotonic() >= deadline:
+            timed_out = True
+            finish()
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return timed_out, _rusage_dict(rusage)
+
+
+def _pump(pipe, stream: str, collector: _OutputCollector):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for data in iter(lambda: pipe.read1(65536), b""):
+        text = decoder.decode(data)
+        if text:
+            collector(stream, text)
+    tail = decoder.decode(b"", True)
+    if tail:
+        collector(stream, tail)
+    pipe.close()
+
+
+def _run_cold(code: str, filename: str, parameters: Optional[dict], environment: CondaEnvironment,
+              level_config: dict, workdir: str, profile: Optional[dict], cancel_token: Optional[CancelToken],
+              collector: _OutputCollector) -> ExecutionResult:
+    """Start a fresh interpreter for a single run.
+
+    The code and its parameters are fed through stdin to the worker script's
+    one-shot mode, so nothing touches the disk and tracebacks still show
+    `filename`. The worker applies the memory ceiling itself once the
+    interpreter is up, on top of what start-up already mapped.
+    """
+    timeout = level_config["max_execution_time"]
+    start_time = time.time()
+    spawn_start = time.perf_counter()
+    process = subprocess.Popen(
+        environment.command(WORKER_SCRIPT, "--run", filename),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=environment.process_env(),
+        cwd=workdir,
+        start_new_session=True
+    )
+    spawn_time = time.perf_counter() - spawn_start
+    pumps = [
+        threading.Thread(target=_pump, args=(process.stdout, "stdout", collector), daemon=True),
+        threading.Thread(target=_pump, args=(process.stderr, "stderr", collector), daemon=True),
+    ]
+    for pump in pumps:
+        pump.start()
+    try:
+        process.stdin.write(json.dumps({
+            "code": code,
+            "params": parameters,
+            "workdir": workdir,
+            "file_limit_mb": level_config["max_scratch_mb"],
+            "memory_limit_mb": level_config["max_memory"],
+            "profile": profile
+        }).encode("utf-8"))
+        process.stdin.close()
+    except OSError:
+        # The interpreter died before reading its input; its stderr says why
+        pass
+
+    finish = _GroupFinisher(process.pid)
+    if cancel_token is not None:
+        cancel_token.bind(finish)
+    try:
+        timed_out, usage = _wait_with_usage(process, timeout, finish)
+    finally:
+        if cancel_token is not None:
+            cancel_token.unbind()
+    # Descendants would keep the pipes (and the pumps) open
+    finish()
+    for pump in pumps:
+        pump.join()
+    execution_time = int((time.time() - start_time) * 1000)
+    # Interpreter start-up is part of "run" here, only fork/exec is "spawn"
+    record_phase("spawn", spawn_time)
+    record_phase("run", max(0.0, execution_time / 1000 - spawn_time))
+
+    if timed_out:
+        return collector.result("timeout", None, timeout * 1000, usage)
+    if cancel_token is not None and cancel_token.cancelled:
+        return collector.result("cancelled", process.returncode, execution_time, usage)
+    if process.returncode == 0:
+        status = "success"
+    elif collector.last_line("stderr").startswith("MemoryError"):
+        status = "memory_exceeded"
+    else:
+        status = "error"
+    return collector.result(status, process.returncode, execution_time, usage)
+
+
+def _exit_result(message: dict, collector: _OutputCollector, timeout: int,
+                 execution_time: int) -> ExecutionResult:
+    """Result of a run from the exit message a worker or kernel sent"""
+    usage = message.get("usage")
+    if message.get("cancelled"):
+        return collector.result("cancelled", None, execution_time, usage)
+    if message["timed_out"]:
+        return collector.result("timeout", None, timeout * 1000, usage)
+    if message.get("memory_exceeded"):
+        return collector.result("memory_exceeded", message["returncode"], execution_time, usage)
+    status = "success" if message["returncode"] == 0 else "error"
+    return collector.result(status, message["returncode"], execution_time, usage)
+
+
+def _run_warm(code: str, filename: str, parameters: Optional[dict], environment: CondaEnvironment,
+              level_config: dict, workers: WorkerSettings, workdir: str, profile: Optional[dict],
+              cancel_token: Optional[CancelToken], collector: _OutputCollector,
+              local_modules: frozenset = frozenset()) -> ExecutionResult:
+    """Fork the run from a warm worker of the environment's pool"""
+    timeout = level_config["max_execution_time"]
+    pool = get_pool(
+        environment.name,
+        environment.command(),
+        workers.pool_size,
+        env=environment.process_env(),
+        revision=environment.revision,
+        preload=workers.preload_modules
+    )
+    pool = select_pool(environment, pool, code, local_modules)
+    start_time = time.time()
+    message = pool.execute(
+        {
+            "code": code,
+            "params": parameters,
+            "filename": filename,
+            "timeout": timeout,
+            "memory_limit_mb": level_config["max_memory"],
+            "cgroup_root": EXECUTION_CGROUP_ROOT,
+            "workdir": workdir,
+            "file_limit_mb": level_config["max_scratch_mb"],
+            "profile": profile
+        },
+        timeout,
+        cancel_token,
+        collector
+    )
+    execution_time = int((time.time() - start_time) * 1000)
+    # Everything before the child ran: pool checkout, IPC, cgroup, compile, fork
+    run_time = message.get("elapsed", 0)
+    record_phase("spawn", max(0.0, execution_time / 1000 - run_time))
+    record_phase("run", run_time)
+
+    record_leaked(message.get("leaked_processes", 0), message.get("surviving_pgid"))
+    result = _exit_result(message, collector, timeout, execution_time)
+
+    # What a cold run would have paid on top: the interpreter start plus
+    # importing the preloaded modules this snippet uses
+    saved = message.get("interpreter_startup", 0) + message.get("preload_saved", 0)
+    result.startup_saved_ms = int(saved * 1000)
+    metrics.increment("startup_saved_ms", result.startup_saved_ms)
+    return result
+
+
+def _bundle_modules(bundle: dict) -> frozenset:
+    """Top-level modules a bundle provides next to its entry point"""
+    base = posixpath.dirname(bundle["entry_point"])
+    names = set()
+    for path in bundle["files"]:
+        relative = posixpath.relpath(path, base or ".")
+        if relative.startswith(".."):
+            continue
+        head = relative.split("/")[0]
+        names.add(head[:-3] if head.endswith(".py") else head)
+    return frozenset(names)
+
+
+def _take_profile(path: str) -> Optional[dict]:
+    """Load and remove the report a profiled run wrote, if any"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            report = json.load(f)
+        os.unlink(path)
+    except (OSError, ValueError):
+        return None
+    metrics.increment("profiled_runs")
+    return report
+
+
+def run_code(code: str, conda_env: Optional[str], level_config: dict,
+             workers: Optional[WorkerSettings] = None,
+             cancel_token: Optional[CancelToken] = None,
+             on_output: Optional[OutputCallback] = None,
+             parameters: Optional[dict] = None,
+             profile: Optional[str] = None,
+             bundle: Optional[dict] = None) -> ExecutionResult:
+    """Execute a snippet with the limits of the given user level.
+
+    Dispatches into the environment's warm worker pool when possible and
+    falls back to a one-off interpreter otherwise. `cancel_token` allows
+    another thread to abort the run, and `on_output(stream, text)` receives
+    stdout/stderr chunks while the snippet is still running. `parameters`
+    reach the snippet as its `params` global and as JSON on its stdin.
+    The snippet runs in a scratch directory of its own; files it leaves
+    there are kept as the result's artifacts. `profile` ("sampling" or
+    "cprofile") runs it under that profiler and attaches the report.
+    With a `bundle` (see `bundles.bundle_payload`) its files are placed in
+    the scratch directory and `code`, the entry point's source, runs under
+    the entry point's name.
+    """
+    workers = workers or WorkerSettings()
+    environment = resolve_environment(conda_env)
+    collector = _OutputCollector(level_config, on_output)
+    scratch = ScratchDir()
+    profile_request = None
+    if profile:
+        profile_request = {
+            "mode": profile,
+            "output": os.path.join(scratch.path, PROFILE_FILE),
+            "timeout": level_config["max_execution_time"]
+        }
+    filename = "main.py"
+    try:
+        if bundle is not None:
+            with timed("bundle"):
+                scratch.place_files(bundle["files"], read_blob)
+            filename = bundle["entry_point"]
+        if not WARM_WORKERS_SUPPORTED or workers.pool_size <= 0:
+            result = _run_cold(code, filename, parameters, environment, level_config, scratch.path,
+                               profile_request, cancel_token, collector)
+        else:
+            result = _run_warm(code, filename, parameters, environment, level_config, workers, scratch.path,
+                               profile_request, cancel_token, collector,
+                               _bundle_modules(bundle) if bundle is not None else frozenset())
+        if profile_request is not None:
+            result.profile = _take_profile(profile_request["output"])
+        result.artifact_count, result.artifacts_path = scratch.collect(level_config)
+        return result
+    except Exception:
+        collector.abandon()
+        raise
+    finally:
+        scratch.remove()
+
+
+def run_session_cell(kernel: Worker, code: str, level_config: dict,
+                     cancel_token: Optional[CancelToken] = None,
+                     on_output: Optional[OutputCallback] = None) -> ExecutionResult:
+    """Execute a cell on a session kernel with the limits of the given user level.
+
+    Unlike `run_code` the cell runs inside the kernel process itself, so it
+    sees whatever earlier cells of the session defined.
+    """
+    timeout = level_config["max_execution_time"]
+    collector = _OutputCollector(level_config, on_output)
+    start_time = time.time()
+    try:
+        message = kernel.execute({"code": code, "timeout": timeout}, timeout, cancel_token, collector)
+    except Exception:
+        collector.abandon()
+        raise
+    execution_time = int((time.time() - start_time) * 1000)
+    return _exit_result(message, collector, timeout, execution_time)
@@ -0,0 +1,104 @@
+"""Idempotency keys for retried API requests.
+
+A client that timed out and retries with the same `Idempotency-Key` gets
+the stored response of the first attempt instead of a second run. A retry
+that arrives while the first attempt is still running waits for it and
+shares its response. Keys are scoped per user and route, remembered for
+`IDEMPOTENCY_TTL` and held in a bounded LRU. Only completed responses are
+stored: if the first attempt failed with an error, the key can be used again.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from services import metrics
+
+IDEMPOTENCY_TTL = 24 * 3600
+IDEMPOTENCY_MAX_ENTRIES = 10000
+IDEMPOTENCY_MAX_KEY_LENGTH = 255
+
+
+class IdempotencyConflictError(Exception):
+    """Raised when a key is reused for another request or its first run is still going"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _Entry:
+    def __init__(self, key: tuple, fingerprint: str):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.response: Any = None
+        self.expires_at: Optional[float] = None
+        self.done = threading.Event()
+
+
+def request_fingerprint(body: str) -> str:
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[tuple, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, key: tuple, fingerprint: str, timeout: float) -> tuple[Optional[_Entry], Any]:
+        """Claim a key for a request.
+
+        Returns `(entry, None)` when the caller has to run the request and
+        then `complete()` or `abandon()` the entry, and `(None, response)`
+        when an earlier attempt's response should be replayed.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry.expires_at is not None and entry.expires_at < time.monotonic():
+                    del self._entries[key]
+                    entry = None
+                if entry is None:
+                    entry = self._entries[key] = _Entry(key, fingerprint)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                    return entry, None
+                if entry.fingerprint != fingerprint:
+                    raise IdempotencyConflictError("Idempotency-Key 已用于不同的请求", 422)
+                if entry.done.is_set():
+                    self._entries.move_to_end(key)
+                    metrics.increment("idempotent_replays")
+                    return None, entry.response
+
+            # The first attempt is still running: share its outcome
+            metrics.increment("idempotent_waits")
+            if not entry.done.wait(max(0.0, deadline - time.monotonic())):
+                raise IdempotencyConflictError("相同 Idempotency-Key 的请求仍在执行", 409)
+            if entry.response is not None:
+                return None, entry.response
+            # Done now; either it left a response or it was abandoned and
+            # the next loop claims the key for this request
+
+    def complete(self, entry: _Entry, response: Any):
+        with self._lock:
+            entry.response = response
+            entry.expires_at = time.monotonic() + self.ttl
+        entry.done.set()
+
+    def abandon(self, entry: _Entry):
+        """Forget a claim whose request failed, so a retry runs again"""
+        with self._lock:
+            if self._entries.get(entry.key) is entry:
+                del self._entries[entry.key]
+        entry.done.set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL)
+metrics.register_gauge("idempotency_keys", lambda: len(idempotency_store))
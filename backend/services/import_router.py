@@ -0,0 +1,136 @@
+"""Import-aware routing of snippets to warm worker pools.
+
+Besides its configured pool, an environment may keep a few pools whose
+workers preload additional module sets. A snippet's imports are parsed with
+`ast` once per code hash, and the run goes to the warm pool that already
+has most of them loaded. Import sets that no pool covers are counted; once
+one has been asked for `IMPORT_WARM_THRESHOLD` times, a pool preloading it
+is started in the background for the following runs.
+"""
+import ast
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+
+from services import metrics
+from services.conda_envs import CondaEnvironment
+from services.worker_pool import WorkerPool, get_pool, environment_pools, close_pool
+
+# Parsed import sets kept per code hash
+IMPORT_CACHE_SIZE = 4096
+# Misses for an import set before a pool preloading it is started
+IMPORT_WARM_THRESHOLD = 5
+# Extra pools per environment on top of the configured one
+IMPORT_POOLS_PER_ENV = 3
+# Workers in each extra pool
+IMPORT_POOL_SIZE = 1
+# Import sets whose misses are tracked at the same time
+_DEMAND_TRACKED = 1024
+
+# Standard library modules are cheap to import and never worth a pool
+_STDLIB_MODULES = frozenset(getattr(sys, "stdlib_module_names", sys.builtin_module_names))
+
+_imports_cache: OrderedDict[str, frozenset] = OrderedDict()
+_demand: OrderedDict[tuple[str, frozenset], int] = OrderedDict()
+_lock = threading.Lock()
+
+
+def _parse_imports(code: str) -> frozenset:
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return frozenset()
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split(".")[0])
+    return frozenset(names - _STDLIB_MODULES)
+
+
+def snippet_imports(code: str) -> frozenset:
+    """Top-level third-party modules a snippet imports"""
+    key = hashlib.sha256(code.encode("utf-8")).hexdigest()
+    with _lock:
+        cached = _imports_cache.get(key)
+        if cached is not None:
+            _imports_cache.move_to_end(key)
+            return cached
+    imports = _parse_imports(code)
+    with _lock:
+        _imports_cache[key] = imports
+        if len(_imports_cache) > IMPORT_CACHE_SIZE:
+            _imports_cache.popitem(last=False)
+    return imports
+
+
+def _pool_modules(pool: WorkerPool) -> frozenset:
+    if pool.loaded_modules is not None:
+        return pool.loaded_modules
+    return frozenset(name.split(".")[0] for name in pool.preload)
+
+
+def _record_miss(environment: CondaEnvironment, base: WorkerPool, imports: frozenset):
+    """Count a run nobody had warmed for and start a pool once it is popular"""
+    key = (environment.name, imports)
+    with _lock:
+        count = _demand.pop(key, 0) + 1
+        if count < IMPORT_WARM_THRESHOLD:
+            _demand[key] = count
+            while len(_demand) > _DEMAND_TRACKED:
+                _demand.popitem(last=False)
+            return
+
+    extras = sorted(imports - _pool_modules(base))
+    pool = get_pool(
+        environment.name,
+        base.python_cmd,
+        IMPORT_POOL_SIZE,
+        env=base.env,
+        revision=environment.revision,
+        preload=base.preload + tuple(extras)
+    )
+    pool.prewarm()
+    metrics.increment("import_pools_started")
+
+    # Keep the number of extra pools bounded, dropping the least recently used
+    extra_pools = [p for p in environment_pools(environment.name) if p is not base]
+    extra_pools.sort(key=lambda p: p.last_used)
+    for stale in extra_pools[:max(0, len(extra_pools) - IMPORT_POOLS_PER_ENV)]:
+        if stale is not pool:
+            close_pool(stale)
+
+
+def select_pool(environment: CondaEnvironment, base: WorkerPool, code: str,
+                local_modules: frozenset = frozenset()) -> WorkerPool:
+    """The pool to run `code` on: `base` unless another one has its imports warm.
+
+    `local_modules` are provided by the run's own files (a bundle) and are
+    never preloaded.
+    """
+    imports = snippet_imports(code) - local_modules
+    if not imports:
+        return base
+    best, best_covered = base, len(imports & _pool_modules(base))
+    if best_covered < len(imports):
+        for pool in environment_pools(environment.name):
+            if pool is base:
+                continue
+            if pool.revision != environment.revision:
+                # Started before the environment changed, never reused
+                close_pool(pool)
+                continue
+            if pool.loaded_modules is None or not pool.available:
+                continue  # still warming up or busy
+            covered = len(imports & pool.loaded_modules)
+            if covered > best_covered:
+                best, best_covered = pool, covered
+
+    if best_covered < len(imports):
+        metrics.increment("import_route_misses")
+        _record_miss(environment, base, imports)
+    elif best is not base:
+        metrics.increment("import_route_hits")
+    return best
@@ -0,0 +1,235 @@
+"""Asynchronous execution jobs.
+
+`/execute` holds a request thread for the whole run. Jobs instead create the
+`CodeExecution` row up front, return its id immediately and run on a small,
+bounded set of scheduler threads. Clients poll the row and may cancel it,
+or pass an `on_complete` callback (used for API webhooks). Jobs take their
+execution slot from the same scheduler as synchronous runs, so they count
+against the user's concurrency limit and stay cancellable while they wait.
+"""
+import queue
+import threading
+from typing import Callable, Optional
+
+from models.database import SessionLocal, CodeExecution
+from services.executor import ExecutionResult, format_execution_output, stored_profile, WorkerSettings
+from services.runners import dispatch_code
+from services.scheduler import execution_scheduler
+from services.worker_pool import CancelToken
+from utils.utils import log_system_event
+
+# Number of jobs executing at the same time
+JOB_WORKERS = 4
+# Jobs waiting beyond this are rejected instead of queued
+JOB_QUEUE_LIMIT = 100
+
+# Statuses of a CodeExecution that has not finished yet
+ACTIVE_JOB_STATUSES = ("queued", "running")
+
+
+class JobQueueFullError(Exception):
+    """Raised when the job queue cannot take another job"""
+
+
+class JobScheduler:
+    """Runs submitted jobs on a fixed number of daemon threads"""
+
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = workers
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_limit)
+        self._jobs: dict[int, dict] = {}
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"job-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, execution_id: int, code: str, conda_env: Optional[str], level_config: dict,
+               workers: WorkerSettings, user_id: int, user_level: int, client_info: dict,
+               parameters: Optional[dict] = None,
+               on_complete: Optional[Callable[[CodeExecution], None]] = None,
+               profile: Optional[str] = None,
+               bundle: Optional[dict] = None):
+        """Queue a job for an already persisted CodeExecution row.
+
+        `on_complete` is called with the finished row from the job thread.
+        """
+        self._ensure_started()
+        job = {
+            "execution_id": execution_id,
+            "code": code,
+            "conda_env": conda_env,
+            "level_config": level_config,
+            "workers": workers,
+            "user_id": user_id,
+            "user_level": user_level,
+            "client_info": client_info,
+            "parameters": parameters,
+            "profile": profile,
+            "bundle": bundle,
+            "on_complete": on_complete,
+            "state": "queued",
+            "token": CancelToken(),
+        }
+        with self._lock:
+            self._jobs[execution_id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(execution_id, None)
+            raise JobQueueFullError("执行队列已满，请稍后重试")
+
+    def cancel(self, execution_id: int) -> Optional[str]:
+        """Cancel a job.
+
+        Returns "cancelled" if it never started, "cancelling" if it is
+        being killed, or None if the job is unknown or already finished.
+        """
+        with self._lock:
+            job = self._jobs.get(execution_id)
+            if job is None:
+                return None
+            if job["state"] == "queued":
+                job["state"] = "cancelled"
+                self._jobs.pop(execution_id, None)
+                return "cancelled"
+        job["token"].cancel()
+        return "cancelling"
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                if job["state"] == "cancelled":
+                    continue
+                job["state"] = "running"
+            try:
+                self._run_job(job)
+            except Exception as e:
+                print(f"Execution job {job['execution_id']} failed: {e}")
+            finally:
+                with self._lock:
+                    self._jobs.pop(job["execution_id"], None)
+
+    def _dispatch(self, job: dict, execution: CodeExecution, db) -> ExecutionResult:
+        """Run the job once it holds an execution slot; cancellable while it waits"""
+        token = job["token"]
+        ticket = execution_scheduler.submit(job["user_id"], job["user_level"])
+        token.bind(lambda: execution_scheduler.withdraw(ticket))
+        try:
+            granted = execution_scheduler.wait(ticket)
+        finally:
+            token.unbind()
+        if not granted:
+            return ExecutionResult(status="cancelled", stdout="", stderr="", returncode=None, execution_time=0)
+        try:
+            execution.status = "running"
+            db.commit()
+            return dispatch_code(
+                job["code"],
+                job["conda_env"],
+                job["level_config"],
+                workers=job["workers"],
+                cancel_token=token,
+                parameters=job["parameters"],
+                profile=job["profile"],
+                bundle=job["bundle"]
+            )
+        finally:
+            execution_scheduler.release(ticket)
+
+    def _run_job(self, job: dict):
+        db = SessionLocal()
+        try:
+            execution = db.query(CodeExecution).filter(CodeExecution.id == job["execution_id"]).first()
+            if execution is None:
+                return
+
+            level_config = job["level_config"]
+            try:
+                result = self._dispatch(job, execution, db)
+                execution.result = format_execution_output(result, level_config)
+                execution.status = result.status
+                execution.execution_time = result.execution_time
+                execution.memory_usage = result.memory_usage
+                execution.cpu_user_time = result.cpu_user_time
+                execution.cpu_system_time = result.cpu_system_time
+                execution.minor_page_faults = result.minor_page_faults
+                execution.major_page_faults = result.major_page_faults
+                execution.startup_saved_ms = result.startup_saved_ms
+                execution.output_size = result.output_size
+                execution.output_truncated = result.output_truncated
+                execution.output_path = result.output_path
+                execution.artifact_count = result.artifact_count
+                execution.artifacts_path = result.artifacts_path
+                execution.profile = stored_profile(result)
+            except Exception as e:
+                execution.result = f"执行错误: {str(e)}"
+                execution.status = "error"
+                execution.execution_time = 0
+            db.commit()
+
+            client_info = job["client_info"]
+            log_system_event(
+                db=db,
+                user_id=job["user_id"],
+                action="code_execute",
+                resource_type="code_execution",
+                resource_id=execution.id,
+                details={
+                    "status": execution.status,
+                    "execution_time": execution.execution_time,
+                    "code_length": len(job["code"]),
+                    "user_level": job["user_level"],
+                    "async_job": True
+                },
+                ip_address=client_info["ip_address"],
+                user_agent=client_info["user_agent"],
+                status="success" if execution.status == "success" else "error"
+            )
+
+            if job["on_complete"] is not None:
+                try:
+                    job["on_complete"](execution)
+                except Exception as e:
+                    print(f"Completion callback of job {execution.id} failed: {e}")
+        finally:
+            db.close()
+
+    def shutdown(self):
+        """Cancel running jobs and stop the scheduler threads"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+            threads, self._threads = self._threads, []
+        for job in jobs:
+            job["token"].cancel()
+        for _ in threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+
+
+job_scheduler = JobScheduler(JOB_WORKERS, JOB_QUEUE_LIMIT)
+
+
+def fail_interrupted_jobs():
+    """Mark jobs left unfinished by a previous process as failed"""
+    db = SessionLocal()
+    try:
+        db.query(CodeExecution).filter(CodeExecution.status.in_(ACTIVE_JOB_STATUSES)).update(
+            {"status": "error", "result": "服务重启，任务已中断", "execution_time": 0},
+            synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
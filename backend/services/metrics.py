@@ -0,0 +1,43 @@
+"""In-process operational metrics.
+
+Counters are cumulative since the API process started; gauges are read from
+registered callables when a snapshot is taken. Admins can read them through
+`GET /admin/metrics`.
+"""
+import threading
+import time
+from typing import Callable
+
+_lock = threading.Lock()
+_counters: dict[str, int] = {}
+_gauges: dict[str, Callable[[], float]] = {}
+_started_at = time.time()
+
+
+def increment(name: str, value: int = 1):
+    """Add to a counter, creating it on first use"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def register_gauge(name: str, read: Callable[[], float]):
+    """Expose a value computed on demand, e.g. a queue length"""
+    with _lock:
+        _gauges[name] = read
+
+
+def snapshot() -> dict:
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+    values = {}
+    for name, read in gauges.items():
+        try:
+            values[name] = read()
+        except Exception:
+            values[name] = None
+    return {
+        "uptime_seconds": int(time.time() - _started_at),
+        "counters": dict(sorted(counters.items())),
+        "gauges": dict(sorted(values.items())),
+    }
@@ -0,0 +1,160 @@
+"""Bounded capture of execution output.
+
+A snippet printing in a loop must not be able to push unbounded text into
+the API process or the database. Each stream keeps only a head and a tail
+buffer in memory; once the level's cap is exceeded the complete output is
+spilled to a file (itself capped) that can be downloaded in ranges, and the
+stored result carries a truncation marker.
+"""
+import os
+import time
+import uuid
+from collections import deque
+from typing import Optional
+
+OUTPUT_DIR = "./data/outputs"
+# Spilled output files older than this are removed
+OUTPUT_RETENTION_DAYS = 7
+
+
+def _byte_len(text: str) -> int:
+    return len(text.encode("utf-8", errors="replace"))
+
+
+class StreamCapture:
+    """Head/tail buffers for one stream with spill-over to disk"""
+
+    def __init__(self, name: str, limit_bytes: int, spill_limit_bytes: int):
+        self.name = name
+        self.limit_bytes = limit_bytes
+        self.spill_limit_bytes = spill_limit_bytes
+        self.half = max(1, limit_bytes // 2)
+        self.total_bytes = 0
+        self._head: list[str] = []
+        self._head_bytes = 0
+        self._tail: deque = deque()
+        self._tail_bytes = 0
+        self._spill = None
+        self._spilled_bytes = 0
+        self.spill_path: Optional[str] = None
+
+    @property
+    def truncated(self) -> bool:
+        return self.total_bytes > self.limit_bytes
+
+    def _start_spill(self):
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        self.spill_path = os.path.join(OUTPUT_DIR, f"{uuid.uuid4().hex}.{self.name}.log")
+        self._spill = open(self.spill_path, "wb")
+        for chunk in list(self._head) + list(self._tail):
+            self._write_spill(chunk)
+
+    def _write_spill(self, text: str):
+        remaining = self.spill_limit_bytes - self._spilled_bytes
+        if remaining <= 0:
+            return
+        data = text.encode("utf-8", errors="replace")[:remaining]
+        self._spill.write(data)
+        self._spilled_bytes += len(data)
+
+    def write(self, text: str):
+        size = _byte_len(text)
+        if self._spill is None and self.total_bytes + size > self.limit_bytes:
+            self._start_spill()
+        self.total_bytes += size
+        if self._spill is not None:
+            self._write_spill(text)
+
+        if self._head_bytes < self.half:
+            room = self.half - self._head_bytes
+            if size <= room:
+                self._head.append(text)
+                self._head_bytes += size
+                return
+            # Split the chunk: fill the head exactly, the rest goes to the tail
+            head_part = text.encode("utf-8", errors="replace")[:room].decode("utf-8", errors="ignore")
+            self._head.append(head_part)
+            self._head_bytes += _byte_len(head_part)
+            text = text[len(head_part):]
+            size = _byte_len(text)
+        self._tail.append(text)
+        self._tail_bytes += size
+        if self._spill is not None:
+            while len(self._tail) > 1 and self._tail_bytes - _byte_len(self._tail[0]) >= self.half:
+                self._tail_bytes -= _byte_len(self._tail.popleft())
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def discard(self):
+        """Drop the spill file, e.g. when this stream is not the stored result"""
+        self.close()
+        if self.spill_path and os.path.exists(self.spill_path):
+            os.unlink(self.spill_path)
+        self.spill_path = None
+
+    def text(self) -> str:
+        head = "".join(self._head)
+        tail = "".join(self._tail)
+        if not self.truncated:
+            return head + tail
+        tail_bytes = tail.encode("utf-8", errors="replace")
+        if len(tail_bytes) > self.half:
+            tail = tail_bytes[-self.half:].decode("utf-8", errors="ignore")
+        omitted = self.total_bytes - self._head_bytes - _byte_len(tail)
+        marker = f"\n\n... [输出过长，已省略 {omitted} 字节，共 {self.total_bytes} 字节，可下载完整输出] ...\n\n"
+        return head + marker + tail
+
+
+class ExecutionOutput:
+    """Captures for stdout and stderr of one execution"""
+
+    def __init__(self, limit_bytes: int, spill_limit_bytes: int):
+        self.streams = {
+            "stdout": StreamCapture("stdout", limit_bytes, spill_limit_bytes),
+            "stderr": StreamCapture("stderr", limit_bytes, spill_limit_bytes),
+        }
+
+    @classmethod
+    def for_level(cls, level_config: dict) -> "ExecutionOutput":
+        return cls(
+            level_config["max_output_kb"] * 1024,
+            level_config["max_output_spill_mb"] * 1024 * 1024
+        )
+
+    def write(self, stream: str, text: str):
+        self.streams[stream].write(text)
+
+    def close(self):
+        for capture in self.streams.values():
+            capture.close()
+
+
+def read_output_range(path: str, start: int, end: Optional[int]) -> tuple[bytes, int]:
+    """Read bytes [start, end] (inclusive) of a spilled output file.
+
+    Returns the data and the total file size.
+    """
+    total = os.path.getsize(path)
+    if end is None or end >= total:
+        end = total - 1
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(max(0, end - start + 1))
+    return data, total
+
+
+def cleanup_expired_outputs():
+    """Remove spilled output files past their retention period"""
+    if not os.path.isdir(OUTPUT_DIR):
+        return
+    cutoff = time.time() - OUTPUT_RETENTION_DAYS * 86400
+    for name in os.listdir(OUTPUT_DIR):
+        path = os.path.join(OUTPUT_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except OSError:
+            pass
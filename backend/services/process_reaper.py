@@ -0,0 +1,125 @@
+"""Killing and reaping the process trees of executions.
+
+Every execution leads its own session, so its whole tree can be killed as a
+process group on timeout, cancel or exit. A single SIGKILL round is not
+always enough (a fork racing the kill, uninterruptible sleep), so groups
+still alive afterwards are tracked by a background thread that keeps killing
+them until they are gone.
+"""
+import os
+import signal
+import threading
+import time
+from typing import Optional
+
+from services import metrics
+
+# Seconds between two sweeps of the background reaper
+REAPER_INTERVAL = 5
+# Stop chasing a group after this many sweeps
+REAPER_MAX_SWEEPS = 60
+
+_KILL_SIGNAL = getattr(signal, "SIGKILL", signal.SIGTERM)
+
+
+def process_group_members(pgid: int) -> set[int]:
+    """Live pids in a process group, excluding its leader (needs /proc)"""
+    members = set()
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return members
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # fields[0] is the state, fields[2] the process group
+        if fields[0] != "Z" and int(fields[2]) == pgid:
+            members.add(int(entry))
+    members.discard(pgid)
+    return members
+
+
+def kill_process_group(pgid: int):
+    """SIGKILL a whole process group (just the process where groups do not exist)"""
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(pgid, _KILL_SIGNAL)
+        else:
+            os.kill(pgid, _KILL_SIGNAL)
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+
+
+class ProcessReaper:
+    """Daemon thread that keeps killing process groups until they are empty"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._groups: dict[int, int] = {}  # pgid -> sweeps so far
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def track(self, pgid: int):
+        with self._lock:
+            self._groups.setdefault(pgid, 0)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="process-reaper", daemon=True)
+                self._thread.start()
+
+    @property
+    def tracked(self) -> int:
+        with self._lock:
+            return len(self._groups)
+
+    def sweep(self):
+        with self._lock:
+            groups = list(self._groups.items())
+        for pgid, sweeps in groups:
+            members = process_group_members(pgid)
+            if members and sweeps < REAPER_MAX_SWEEPS:
+                kill_process_group(pgid)
+                metrics.increment("reaper_kills", len(members))
+                with self._lock:
+                    self._groups[pgid] = sweeps + 1
+            else:
+                if members:
+                    metrics.increment("reaper_abandoned_groups")
+                with self._lock:
+                    self._groups.pop(pgid, None)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Process reaper sweep failed: {e}")
+
+
+reaper = ProcessReaper(REAPER_INTERVAL)
+metrics.register_gauge("reaper_tracked_groups", lambda: reaper.tracked)
+
+
+def record_leaked(count: int, surviving_pgid: Optional[int] = None):
+    """Account for processes a finished run left behind"""
+    if count:
+        metrics.increment("leaked_processes", count)
+    if surviving_pgid:
+        reaper.track(surviving_pgid)
+
+
+def finish_process_group(pgid: int) -> int:
+    """Kill whatever a finished run left in its group; returns how many were leaked"""
+    leaked = len(process_group_members(pgid))
+    kill_process_group(pgid)
+    if leaked:
+        # Give the kill a moment before handing survivors to the reaper
+        time.sleep(0.01)
+        survivors = process_group_members(pgid)
+        record_leaked(leaked, pgid if survivors else None)
+    return leaked
@@ -0,0 +1,76 @@
+"""Per-user daily quota counters.
+
+Checking the daily execution and API call limits used to run a COUNT over
+`code_executions` on every request, which grows with the table. Counters
+are now seeded from the database the first time a user is seen on a given
+day and incremented whenever an execution is recorded; all of them start
+over at day rollover.
+"""
+import threading
+from datetime import date
+
+from sqlalchemy import func, case
+
+from models.database import CodeExecution
+from services.record_writer import record_writer
+
+
+class QuotaCounters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._day = date.today()
+        self._counts: dict[int, list[int]] = {}  # user id -> [executions, api calls]
+
+    def _roll_over(self):
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._counts.clear()
+
+    def _seed(self, user_id: int, db) -> list[int]:
+        # Records still queued for writing would be missing from the count
+        record_writer.flush()
+        day = date.today()
+        executions, api_calls = db.query(
+            func.count(CodeExecution.id),
+            func.sum(case((CodeExecution.is_api_call == True, 1), else_=0))
+        ).filter(
+            CodeExecution.user_id == user_id,
+            CodeExecution.created_at >= day
+        ).one()
+        counts = [executions or 0, api_calls or 0]
+        with self._lock:
+            self._roll_over()
+            if self._day == day:
+                # Another request may have seeded meanwhile; keep its counts
+                counts = self._counts.setdefault(user_id, counts)
+        return counts
+
+    def usage(self, user_id: int, db) -> tuple[int, int]:
+        """Today's (executions, API calls) of a user"""
+        with self._lock:
+            self._roll_over()
+            counts = self._counts.get(user_id)
+            if counts is not None:
+                return counts[0], counts[1]
+        counts = self._seed(user_id, db)
+        return counts[0], counts[1]
+
+    def record(self, user_id: int, api_call: bool = False, amount: int = 1):
+        """Count an execution record (a negative amount takes one back)"""
+        with self._lock:
+            self._roll_over()
+            counts = self._counts.get(user_id)
+            if counts is None:
+                return  # not seeded yet, the seeding query will see the row
+            counts[0] += amount
+            if api_call:
+                counts[1] += amount
+
+    def reset(self):
+        """Forget every counter, e.g. after the database was replaced"""
+        with self._lock:
+            self._counts.clear()
+
+
+quota_counters = QuotaCounters()
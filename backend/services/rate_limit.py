@@ -0,0 +1,144 @@
+"""Per-user token-bucket rate limiting.
+
+Daily quotas alone let a user spend a whole day's allowance in a burst.
+Every limited scope ("execute", "api", "ai") gives each user a bucket of
+`rate_burst` tokens that refills at `rate_per_minute`; a request takes one
+token (a batch one per item) before anything is dispatched. Checks are O(1)
+in memory. Responses of limited routes carry the `RateLimit-Limit`,
+`RateLimit-Remaining`, `RateLimit-Reset` and `RateLimit-Policy` headers,
+rejections additionally `Retry-After`.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from fastapi import Depends, HTTPException, Request
+
+from models.database import User
+from models.user_levels import get_user_level_config
+from services import metrics
+from services.auth import get_current_user
+from services.timing import timed
+
+# Buckets kept at most; the least recently used (usually full) ones go first
+RATE_LIMIT_MAX_BUCKETS = 100000
+
+
+@dataclass
+class RateLimitStatus:
+    allowed: bool
+    limit: int
+    remaining: int
+    reset: int  # seconds until the bucket is full again
+    retry_after: int  # seconds until the request would have been allowed
+    window: int  # seconds to refill an empty bucket
+
+    def headers(self) -> dict:
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(self.reset),
+            "RateLimit-Policy": f"{self.limit};w={self.window}",
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+class RateLimiter:
+    def __init__(self, max_buckets: int):
+        self.max_buckets = max_buckets
+        self._buckets: OrderedDict[tuple, list[float]] = OrderedDict()  # key -> [tokens, updated]
+        self._lock = threading.Lock()
+
+    def acquire(self, key: tuple, burst: int, per_minute: float, cost: int = 1) -> RateLimitStatus:
+        """Take `cost` tokens from the key's bucket if it holds enough"""
+        rate = per_minute / 60.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(burst), now]
+                if len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            allowed = bucket[0] >= cost
+            if allowed:
+                bucket[0] -= cost
+            tokens = bucket[0]
+
+        retry_after = 0 if allowed else math.ceil((cost - tokens) / rate)
+        return RateLimitStatus(
+            allowed=allowed,
+            limit=burst,
+            remaining=int(tokens),
+            reset=math.ceil((burst - tokens) / rate),
+            retry_after=max(1, retry_after) if not allowed else 0,
+            window=math.ceil(burst / rate)
+        )
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_MAX_BUCKETS)
+metrics.register_gauge("rate_limit_buckets", lambda: len(rate_limiter))
+
+
+def enforce_rate_limit(request: Request, user: User, scope: str, cost: int = 1):
+    """Take tokens for a request or raise 429; headers are added to the response"""
+    config = get_user_level_config(user.user_level)
+    with timed("rate_limit"):
+        status = rate_limiter.acquire((scope, user.id), config["rate_burst"], config["rate_per_minute"], cost)
+    headers = status.headers()
+    request.state.rate_limit_headers = headers
+    if not status.allowed:
+        metrics.increment("rate_limit_rejections")
+        raise HTTPException(
+            status_code=429,
+            detail=f"请求过于频繁，请 {status.retry_after} 秒后重试",
+            headers=headers
+        )
+
+
+def rate_limited(scope: str):
+    """Dependency limiting a route of authenticated users to their level's rate"""
+    def dependency(request: Request, current_user: User = Depends(get_current_user)):
+        enforce_rate_limit(request, current_user, scope)
+    return dependency
+
+
+class RateLimitHeadersMiddleware:
+    """Adds the headers of a rate-limit check to whatever response the route sent.
+
+    Plain ASGI rather than BaseHTTPMiddleware so streamed responses pass
+    through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                headers = scope.get("state", {}).get("rate_limit_headers")
+                if headers:
+                    present = {name.lower() for name, _ in message.get("headers", [])}
+                    extra = [
+                        (name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in headers.items()
+                        if name.lower().encode("latin-1") not in present
+                    ]
+                    message = dict(message, headers=list(message.get("headers", [])) + extra)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
@@ -0,0 +1,161 @@
+"""Write-behind persistence of execution records and their log entries.
+
+Committing a CodeExecution and its SystemLog on the request path costs two
+synchronous SQLite commits per run. Records handed to `record_writer`
+instead get their defaults (including a pre-assigned id) applied at once,
+so the response can be built from them immediately, and are inserted by a
+background thread in batched transactions every `RECORD_FLUSH_INTERVAL`.
+Records queued at shutdown are written before the process exits.
+
+Rows become visible to queries a few milliseconds after the response; only
+write paths whose records are not updated later use the writer.
+"""
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import insert
+
+from models.database import engine
+from services import metrics
+from services.timing import timed
+
+# Seconds between two flushes of the queue
+RECORD_FLUSH_INTERVAL = 0.005
+# Rows written per transaction at most
+RECORD_BATCH_SIZE = 500
+# Callers block once this many rows wait to be written
+RECORD_QUEUE_LIMIT = 10000
+
+
+def _apply_defaults(record):
+    """Fill in column defaults the database would otherwise set on insert"""
+    for column in record.__table__.columns:
+        if getattr(record, column.key) is not None or column.default is None:
+            continue
+        default = column.default
+        if default.is_callable:
+            setattr(record, column.key, default.arg(None))
+        elif default.is_scalar:
+            setattr(record, column.key, default.arg)
+
+
+def _row(record) -> dict:
+    # Autoincrement keys that were not pre-assigned are left to the database
+    return {
+        column.key: getattr(record, column.key)
+        for column in record.__table__.columns
+        if not (column.primary_key and getattr(record, column.key) is None)
+    }
+
+
+class RecordWriter:
+    def __init__(self, flush_interval: float, batch_size: int, queue_limit: int):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue_limit = queue_limit
+        self._queue: deque = deque()
+        self._writing = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def add(self, *records):
+        """Queue ORM objects for insertion; their ids and defaults are set on return"""
+        with timed("persist"):
+            self._add(records)
+
+    def _add(self, records):
+        rows = []
+        for record in records:
+            _apply_defaults(record)
+            rows.append((record.__table__, _row(record)))
+        with self._cond:
+            if self._stopped:
+                # Shut down already: nothing would flush the queue any more
+                self._write(rows)
+                return
+            while len(self._queue) >= self.queue_limit:
+                self._cond.wait()
+            self._queue.extend(rows)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="record-writer", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _take(self) -> list:
+        with self._cond:
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            self._writing = len(batch)
+            self._cond.notify_all()
+        return batch
+
+    def _write(self, batch: list):
+        # Rows of a table with the same columns go into one executemany
+        groups: dict = {}
+        for table, row in batch:
+            groups.setdefault((table, tuple(row)), []).append(row)
+        try:
+            with engine.begin() as conn:
+                for (table, _), rows in groups.items():
+                    conn.execute(insert(table), rows)
+            metrics.increment("records_written", len(batch))
+        except Exception as e:
+            print(f"Batched record write failed, retrying row by row: {e}")
+            for table, row in batch:
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(insert(table), [row])
+                    metrics.increment("records_written")
+                except Exception as e:
+                    metrics.increment("records_dropped")
+                    print(f"Dropping {table.name} record {row.get('id')}: {e}")
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if not self._queue and self._stopped:
+                    return
+            batch = self._take()
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._writing = 0
+                    self._cond.notify_all()
+            if len(batch) < self.batch_size:
+                # Let a few more records gather before the next transaction
+                time.sleep(self.flush_interval)
+
+    def flush(self, timeout: float = None) -> bool:
+        """Block until everything queued so far is written"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queue or self._writing:
+                if self._thread is None:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def shutdown(self):
+        """Write out whatever is still queued; later records are written directly"""
+        with self._cond:
+            self._stopped = True
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
+
+    @property
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._queue) + self._writing
+
+
+record_writer = RecordWriter(RECORD_FLUSH_INTERVAL, RECORD_BATCH_SIZE, RECORD_QUEUE_LIMIT)
+metrics.register_gauge("records_pending", lambda: record_writer.pending)
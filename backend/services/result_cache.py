@@ -0,0 +1,98 @@
+"""Cache of execution results for deterministic code-library entries.
+
+Entries opt in through `CodeLibrary.cache_results`. A result is keyed by the
+hash of the code, the conda environment and the environment's package-set
+revision on the agents that run it (`RunnerRegistry.environment_revision`),
+so installing or removing packages never serves a stale result.
+The user level is part of the key as well since it decides the limits and
+output caps the result was produced under, and so are the call's parameters.
+Entries expire after their TTL and the least recently used ones are evicted
+once the cache exceeds its entry or size budget. Results with spilled output
+or artifacts are not cached, since every record owns its files.
+"""
+import dataclasses
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from services import metrics
+from services.executor import ExecutionResult
+
+RESULT_CACHE_MAX_ENTRIES = 1024
+# Upper bound for the stdout/stderr text held by the cache (bytes)
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# TTL of entries whose code-library item does not set one (seconds)
+RESULT_CACHE_DEFAULT_TTL = 3600
+RESULT_CACHE_MAX_TTL = 7 * 86400
+
+
+def _result_size(result: ExecutionResult) -> int:
+    return len(result.stdout) + len(result.stderr)
+
+
+class ResultCache:
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[float, ExecutionResult]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(code: str, conda_env: Optional[str], revision: str, user_level: int,
+                parameters: Optional[dict] = None) -> str:
+        code_hash = hashlib.sha256(code.encode("utf-8")).hexdigest()
+        key = f"{code_hash}:{conda_env or 'base'}:{revision}:{user_level}"
+        if parameters is not None:
+            encoded = json.dumps(parameters, sort_keys=True, separators=(",", ":"))
+            key += ":" + hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+        return key
+
+    def get(self, key: str) -> Optional[ExecutionResult]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                metrics.increment("result_cache_misses")
+                return None
+            self._entries.move_to_end(key)
+        metrics.increment("result_cache_hits")
+        return dataclasses.replace(entry[1])
+
+    def put(self, key: str, result: ExecutionResult, ttl: Optional[int] = None):
+        """Store a successful result; anything else may not be deterministic"""
+        if result.status != "success" or result.output_path or result.artifacts_path:
+            return
+        ttl = min(max(1, ttl or RESULT_CACHE_DEFAULT_TTL), RESULT_CACHE_MAX_TTL)
+        size = _result_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + ttl, dataclasses.replace(result))
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                metrics.increment("result_cache_evictions")
+
+    def _drop(self, key: str):
+        _, result = self._entries.pop(key)
+        self._bytes -= _result_size(result)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+result_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_BYTES)
+metrics.register_gauge("result_cache_entries", lambda: len(result_cache))
@@ -0,0 +1,420 @@
+"""Placement of executions on runner agents.
+
+A runner agent (`runner_agent.py`) executes snippets for the API over TCP,
+one JSON object per line. Every connection starts with a `hello` carrying
+the shared `RUNNER_AGENT_TOKEN`; the agent answers with its environments
+(and their package-set revisions) and capacity. A `ping` reports its current load, and an `execute` request is
+answered with "output" messages while the snippet runs and one final
+"result" (a "cancel" sent meanwhile aborts the run). For a multi-file
+bundle the agent may first answer with "need", listing the files missing
+from its cache; the API sends each as a "blob" message (base64 content), so
+files an agent has seen before are never transferred again.
+
+Agents are listed in `RUNNER_AGENTS` as "host:port,...", where "local"
+stands for the embedded agent running snippets inside the API process.
+Without the setting only the embedded agent exists, which is exactly the
+single-host behaviour. Remote agents need `RUNNER_AGENT_TOKEN`; without it
+they are left out. Remote agents are health-checked in the background,
+and each run goes to the least-loaded healthy agent that has the requested
+environment. The execution scheduler's slot count follows the total
+capacity of the healthy agents.
+"""
+import base64
+import dataclasses
+import hmac
+import json
+import os
+import socket
+import threading
+import time
+from typing import Optional
+
+from services import metrics
+from services.bundles import read_blob
+from services.conda_envs import EnvironmentNotFoundError, resolve_environment
+from services.executor import ExecutionResult, OutputCallback, WorkerSettings, run_code
+from services.scheduler import EXECUTION_SLOTS, execution_scheduler
+from services.worker_pool import CancelToken
+
+RUNNER_AGENTS = os.environ.get("RUNNER_AGENTS", "")
+RUNNER_AGENT_TOKEN = os.environ.get("RUNNER_AGENT_TOKEN", "")
+RUNNER_DEFAULT_PORT = 8765
+# Seconds between health checks of remote agents
+RUNNER_HEALTH_INTERVAL = 5
+RUNNER_CONNECT_TIMEOUT = 3
+# Seconds an agent may stay silent beyond the execution timeout before the
+# run is given up on
+RUNNER_RESPONSE_GRACE = 30
+# Longest protocol line accepted (code and parameters are sent inline)
+RUNNER_MAX_MESSAGE = 16 * 1024 * 1024
+
+_RESULT_FIELDS = {field.name for field in dataclasses.fields(ExecutionResult)}
+
+
+class RunnerUnavailableError(Exception):
+    """Raised when no runner agent can take an execution"""
+
+
+class RunnerProtocolError(Exception):
+    """Raised when an agent connection breaks or answers nonsense"""
+
+
+def send_message(stream, message: dict):
+    stream.write(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+    stream.flush()
+
+
+def read_message(stream) -> dict:
+    line = stream.readline(RUNNER_MAX_MESSAGE + 1)
+    if not line:
+        raise RunnerProtocolError("连接已关闭")
+    if len(line) > RUNNER_MAX_MESSAGE or not line.endswith(b"\n"):
+        raise RunnerProtocolError("消息过长")
+    try:
+        message = json.loads(line)
+    except ValueError:
+        raise RunnerProtocolError("无效的消息")
+    if not isinstance(message, dict):
+        raise RunnerProtocolError("无效的消息")
+    return message
+
+
+def check_token(token) -> bool:
+    # An unset token would let anyone in with an empty one
+    if not RUNNER_AGENT_TOKEN:
+        return False
+    return isinstance(token, str) and hmac.compare_digest(token.encode("utf-8"), RUNNER_AGENT_TOKEN.encode("utf-8"))
+
+
+def result_to_dict(result: ExecutionResult) -> dict:
+    return dataclasses.asdict(result)
+
+
+def result_from_dict(data: dict) -> ExecutionResult:
+    return ExecutionResult(**{name: value for name, value in data.items() if name in _RESULT_FIELDS})
+
+
+class EmbeddedAgent:
+    """Runs snippets in the API process itself"""
+
+    def __init__(self):
+        self.name = "local"
+        self.healthy = True
+        self.capacity = EXECUTION_SLOTS
+        self.running = 0
+        self.error = None
+
+    @property
+    def load(self) -> int:
+        return self.running
+
+    def has_environment(self, conda_env: Optional[str]) -> bool:
+        return True  # resolved (or rejected) by run_code
+
+    def revision(self, conda_env: Optional[str]) -> Optional[str]:
+        try:
+            return resolve_environment(conda_env).revision
+        except EnvironmentNotFoundError:
+            return None
+
+    def refresh(self):
+        pass
+
+    def execute(self, code, conda_env, level_config, workers, cancel_token, on_output, parameters,
+                profile, bundle) -> ExecutionResult:
+        return run_code(code, conda_env, level_config, workers=workers, cancel_token=cancel_token,
+                        on_output=on_output, parameters=parameters, profile=profile, bundle=bundle)
+
+    def status(self) -> dict:
+        return {"name": self.name, "healthy": True, "capacity": self.capacity, "running": self.running}
+
+
+class RemoteAgent:
+    """Client side of a runner agent reachable over TCP"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.name = f"{host}:{port}"
+        self.agent_id: Optional[str] = None
+        self.healthy = False
+        self.environments: set[str] = set()
+        self.revisions: dict[str, str] = {}
+        self.capacity = 0
+        self.running = 0  # runs this API process has on the agent
+        self.reported_running = 0  # runs the agent reported, from every API process
+        self.last_seen: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def load(self) -> int:
+        return max(self.running, self.reported_running)
+
+    def has_environment(self, conda_env: Optional[str]) -> bool:
+        return (conda_env or "base") in self.environments
+
+    def revision(self, conda_env: Optional[str]) -> Optional[str]:
+        return self.revisions.get(conda_env or "base")
+
+    def _connect(self):
+        """Open an authenticated connection; returns (socket, stream, hello reply)"""
+        sock = socket.create_connection((self.host, self.port), timeout=RUNNER_CONNECT_TIMEOUT)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            stream = sock.makefile("rwb")
+            send_message(stream, {"type": "hello", "token": RUNNER_AGENT_TOKEN})
+            reply = read_message(stream)
+            if reply.get("type") != "hello":
+                raise RunnerProtocolError(reply.get("message") or "握手失败")
+        except BaseException:
+            sock.close()
+            raise
+        self._update(reply)
+        return sock, stream, reply
+
+    def _update(self, reply: dict):
+        self.agent_id = reply.get("agent_id")
+        self.environments = set(reply.get("environments") or ())
+        self.revisions = dict(reply.get("revisions") or {})
+        self.capacity = int(reply.get("capacity") or 0)
+        self.reported_running = int(reply.get("running") or 0)
+        self.last_seen = time.time()
+
+    def refresh(self):
+        """Health check: reconnect and take over the agent's environments and load"""
+        try:
+            sock, stream, _ = self._connect()
+            sock.close()
+        except (OSError, RunnerProtocolError, ValueError) as e:
+            if self.healthy:
+                print(f"Runner agent {self.name} is unavailable: {e}")
+            self.healthy = False
+            self.error = str(e)
+            return
+        if not self.healthy:
+            print(f"Runner agent {self.name} is available ({self.capacity} slots)")
+        self.healthy = True
+        self.error = None
+
+    def execute(self, code, conda_env, level_config, workers, cancel_token, on_output, parameters,
+                profile, bundle) -> ExecutionResult:
+        try:
+            sock, stream, _ = self._connect()
+        except (OSError, RunnerProtocolError, ValueError) as e:
+            # Nothing ran yet, so the run may go to another agent
+            self.healthy = False
+            self.error = str(e)
+            raise RunnerUnavailableError(f"执行节点 {self.name} 不可用: {e}")
+
+        write_lock = threading.Lock()
+
+        def cancel():
+            with write_lock:
+                try:
+                    send_message(stream, {"type": "cancel"})
+                except OSError:
+                    pass
+
+        try:
+            sock.settimeout(level_config["max_execution_time"] + RUNNER_RESPONSE_GRACE)
+            with write_lock:
+                send_message(stream, {
+                    "type": "execute",
+                    "code": code,
+                    "conda_env": conda_env,
+                    "level_config": level_config,
+                    "workers": dataclasses.asdict(workers or WorkerSettings()),
+                    "parameters": parameters,
+                    "profile": profile,
+                    "bundle": bundle,
+                })
+            if cancel_token is not None:
+                cancel_token.bind(cancel)
+            try:
+                while True:
+                    message = read_message(stream)
+                    kind = message.get("type")
+                    if kind == "output":
+                        if on_output is not None:
+                            on_output(message["stream"], message["text"])
+                    elif kind == "need":
+                        self._send_blobs(stream, write_lock, bundle, message.get("hashes") or [])
+                    elif kind == "result":
+                        result = result_from_dict(message["result"])
+                        # Spilled output and artifacts stay on the agent's disk
+                        result.output_path = None
+                        result.artifact_count = 0
+                        result.artifacts_path = None
+                        return result
+                    elif kind == "error":
+                        if message.get("error") == "environment_not_found":
+                            raise EnvironmentNotFoundError(message.get("message"))
+                        raise RuntimeError(message.get("message") or "执行节点返回错误")
+                    else:
+                        raise RunnerProtocolError(f"未知的消息类型: {kind}")
+            finally:
+                if cancel_token is not None:
+                    cancel_token.unbind()
+        except (OSError, RunnerProtocolError) as e:
+            self.healthy = False
+            self.error = str(e)
+            metrics.increment("runner_failures")
+            raise RuntimeError(f"执行节点 {self.name} 连接中断: {e}")
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _send_blobs(stream, write_lock, bundle: Optional[dict], hashes: list):
+        """Send the bundle files an agent asked for"""
+        available = set(bundle["files"].values()) if bundle else set()
+        for sha256 in hashes:
+            if sha256 not in available:
+                raise RunnerProtocolError(f"请求了代码包之外的文件: {sha256}")
+            data = base64.b64encode(read_blob(sha256)).decode("ascii")
+            with write_lock:
+                send_message(stream, {"type": "blob", "sha256": sha256, "data": data})
+        metrics.increment("runner_blobs_sent", len(hashes))
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "agent_id": self.agent_id,
+            "healthy": self.healthy,
+            "capacity": self.capacity,
+            "running": self.load,
+            "environments": sorted(self.environments),
+            "last_seen": self.last_seen,
+            "error": self.error,
+        }
+
+
+def parse_agents(value: str) -> list:
+    agents = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if item == "local":
+            agents.append(EmbeddedAgent())
+            continue
+        if not RUNNER_AGENT_TOKEN:
+            print(f"Runner agent {item} is ignored: RUNNER_AGENT_TOKEN is not set")
+            continue
+        host, _, port = item.rpartition(":")
+        if not host:
+            host, port = item, RUNNER_DEFAULT_PORT
+        agents.append(RemoteAgent(host.strip("[]"), int(port)))
+    return agents or [EmbeddedAgent()]
+
+
+class RunnerRegistry:
+    def __init__(self, agents: list):
+        self.agents = agents
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def remote(self) -> bool:
+        return any(isinstance(agent, RemoteAgent) for agent in self.agents)
+
+    def start(self):
+        """Check remote agents once, then keep checking them in the background"""
+        if not self.remote or self._thread is not None:
+            return
+        self.check()
+        self._thread = threading.Thread(target=self._loop, name="runner-health", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stopped.wait(RUNNER_HEALTH_INTERVAL):
+            self.check()
+
+    def check(self):
+        for agent in self.agents:
+            agent.refresh()
+        capacity = sum(agent.capacity for agent in self.agents if agent.healthy)
+        # With nothing reachable, keep the default so queued runs fail fast
+        execution_scheduler.resize(capacity or EXECUTION_SLOTS)
+
+    def _place(self, conda_env: Optional[str], exclude: set):
+        """Reserve the least-loaded healthy agent with the environment"""
+        with self._lock:
+            candidates = [
+                agent for agent in self.agents
+                if agent.healthy and agent not in exclude and agent.has_environment(conda_env)
+            ]
+            if not candidates:
+                return None
+            agent = min(candidates, key=lambda a: (a.load / max(a.capacity, 1), a.load))
+            agent.running += 1
+            return agent
+
+    def _release(self, agent):
+        with self._lock:
+            agent.running -= 1
+
+    def environment_revision(self, conda_env: Optional[str]) -> Optional[str]:
+        """Package-set revision of the environment on every agent a run may go to.
+
+        None when no healthy agent has the environment or one of them did not
+        report its revision, e.g. an agent from before revisions were reported.
+        """
+        with self._lock:
+            agents = [agent for agent in self.agents if agent.healthy and agent.has_environment(conda_env)]
+        revisions = {agent.revision(conda_env) for agent in agents}
+        if not revisions or None in revisions:
+            return None
+        return "+".join(sorted(revisions))
+
+    def run(self, code: str, conda_env: Optional[str], level_config: dict,
+            workers: Optional[WorkerSettings] = None,
+            cancel_token: Optional[CancelToken] = None,
+            on_output: Optional[OutputCallback] = None,
+            parameters: Optional[dict] = None,
+            profile: Optional[str] = None,
+            bundle: Optional[dict] = None) -> ExecutionResult:
+        """`run_code` on the best available agent"""
+        tried = set()
+        while True:
+            agent = self._place(conda_env, tried)
+            if agent is None:
+                break
+            tried.add(agent)
+            try:
+                result = agent.execute(code, conda_env, level_config, workers, cancel_token, on_output, parameters,
+                                       profile, bundle)
+            except RunnerUnavailableError as e:
+                print(str(e))
+                continue
+            finally:
+                self._release(agent)
+            metrics.increment("runner_dispatches")
+            return result
+
+        if not any(agent.healthy for agent in self.agents):
+            raise RunnerUnavailableError("没有可用的执行节点")
+        # Healthy agents exist but none has the environment
+        raise EnvironmentNotFoundError(f"Conda环境不存在: {conda_env or 'base'}")
+
+    def status(self) -> list[dict]:
+        return [agent.status() for agent in self.agents]
+
+    def shutdown(self):
+        self._stopped.set()
+
+
+runner_registry = RunnerRegistry(parse_agents(RUNNER_AGENTS))
+metrics.register_gauge("runners_healthy", lambda: sum(1 for agent in runner_registry.agents if agent.healthy))
+
+
+def dispatch_code(code: str, conda_env: Optional[str], level_config: dict,
+                  workers: Optional[WorkerSettings] = None,
+                  cancel_token: Optional[CancelToken] = None,
+                  on_output: Optional[OutputCallback] = None,
+                  parameters: Optional[dict] = None,
+                  profile: Optional[str] = None,
+                  bundle: Optional[dict] = None) -> ExecutionResult:
+    """Execute a snippet like `run_code`, on whichever runner agent fits best"""
+    return runner_registry.run(code, conda_env, level_config, workers, cancel_token, on_output, parameters, profile,
+                               bundle)
@@ -0,0 +1,255 @@
+"""Fair multi-tenant scheduling of synchronous executions.
+
+Runs have to obtain one of a fixed number of execution slots. Every user
+level has its own lane and lanes are served by weighted fair queuing
+(stride scheduling), so a flood of requests from one tier only ever takes
+that tier's share. Inside a lane users are served round-robin, and nobody
+holds more slots than their level's `max_concurrent_runs`. Lane weights and
+per-user limits live in `USER_LEVELS`.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Optional
+
+from models.user_levels import get_user_level_config
+from services import metrics
+from services.timing import timed
+
+# Executions running at the same time across all users
+EXECUTION_SLOTS = max(2, os.cpu_count() or 2)
+# Requests waiting for a slot (all lanes together) beyond this are rejected
+SCHEDULER_QUEUE_LIMIT = 200
+# Seconds a request may wait for a slot before it is rejected
+SCHEDULER_MAX_WAIT = 60
+# Callers that may block a thread in `slot()` at the same time. Sync routes
+# wait on Starlette's threadpool (40 threads), which every other sync route
+# shares, so waiters beyond this are rejected instead of starving it.
+SCHEDULER_MAX_BLOCKED = 16
+# Weight of the latest run in the average duration used for Retry-After
+_DURATION_SMOOTHING = 0.2
+
+
+class ExecutionOverloadedError(Exception):
+    """Raised when a run cannot be queued or waited too long for a slot"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Lane:
+    """Queued runs of one user level, grouped per user"""
+
+    def __init__(self, level: int, weight: float):
+        self.level = level
+        self.weight = weight
+        self.pass_value = 0.0  # virtual time of the lane's next dispatch
+        self.users: OrderedDict[int, deque] = OrderedDict()
+        self.queued = 0
+
+
+class Ticket:
+    """A run's place in the scheduler, from queueing until release"""
+
+    def __init__(self, user_id: int, lane: _Lane, max_running: int):
+        self.user_id = user_id
+        self.lane = lane
+        self.max_running = max_running
+        self.granted = False
+        self.released = False
+        self.withdrawn = False
+        self.granted_at: Optional[float] = None
+        self.event = threading.Event()
+
+
+class ExecutionScheduler:
+    def __init__(self, slots: int, queue_limit: int, max_wait: float, max_blocked: int):
+        self.slots = slots
+        self.queue_limit = queue_limit
+        self.max_wait = max_wait
+        self.max_blocked = max_blocked
+        self._lock = threading.Lock()
+        self._lanes: dict[int, _Lane] = {}
+        self._running = 0
+        self._queued = 0
+        self._blocked = 0
+        self._user_running: dict[int, int] = {}
+        self._user_queued: dict[int, int] = {}
+        self._global_pass = 0.0
+        self._avg_duration = 1.0
+
+    def _retry_after(self) -> int:
+        """Seconds until the current backlog is likely worked off"""
+        return max(1, math.ceil((self._queued + 1) * self._avg_duration / self.slots))
+
+    def _reject(self, message: str):
+        metrics.increment("scheduler_rejections")
+        raise ExecutionOverloadedError(message, self._retry_after())
+
+    def submit(self, user_id: int, user_level: int) -> Ticket:
+        """Queue a run; raises ExecutionOverloadedError if it cannot be queued"""
+        config = get_user_level_config(user_level)
+        with self._lock:
+            if self._queued >= self.queue_limit:
+                self._reject("执行队列已满，请稍后重试")
+            if self._user_queued.get(user_id, 0) >= config["max_queued_runs"]:
+                self._reject(f"排队中的执行过多 (最多 {config['max_queued_runs']} 个)，请稍后重试")
+
+            lane = self._lanes.get(user_level)
+            if lane is None:
+                lane = self._lanes[user_level] = _Lane(user_level, config["scheduler_weight"])
+            if lane.queued == 0:
+                # A lane coming back from idle must not spend credit it banked
+                lane.pass_value = max(lane.pass_value, self._global_pass)
+
+            ticket = Ticket(user_id, lane, config["max_concurrent_runs"])
+            lane.users.setdefault(user_id, deque()).append(ticket)
+            lane.queued += 1
+            self._queued += 1
+            self._user_queued[user_id] = self._user_queued.get(user_id, 0) + 1
+            self._dispatch()
+        return ticket
+
+    def _next_user(self, lane: _Lane) -> Optional[int]:
+        """First user in round-robin order who may start another run"""
+        for user_id, tickets in lane.users.items():
+            if self._user_running.get(user_id, 0) < tickets[0].max_running:
+                return user_id
+        return None
+
+    def _unqueue(self, ticket: Ticket):
+        lane = ticket.lane
+        lane.queued -= 1
+        self._queued -= 1
+        self._user_queued[ticket.user_id] -= 1
+        if not self._user_queued[ticket.user_id]:
+            del self._user_queued[ticket.user_id]
+
+    def _dispatch(self):
+        """Grant free slots to the lanes with the lowest virtual time"""
+        while self._running < self.slots:
+            best = None
+            for lane in self._lanes.values():
+                if not lane.queued:
+                    continue
+                user_id = self._next_user(lane)
+                if user_id is not None and (best is None or lane.pass_value < best[0].pass_value):
+                    best = (lane, user_id)
+            if best is None:
+                return
+
+            lane, user_id = best
+            tickets = lane.users.pop(user_id)
+            ticket = tickets.popleft()
+            if tickets:
+                # Round-robin: the user just served moves to the back
+                lane.users[user_id] = tickets
+            self._unqueue(ticket)
+            self._global_pass = lane.pass_value
+            lane.pass_value += 1.0 / lane.weight
+
+            self._running += 1
+            self._user_running[user_id] = self._user_running.get(user_id, 0) + 1
+            ticket.granted = True
+            ticket.granted_at = time.monotonic()
+            ticket.event.set()
+
+    def wait(self, ticket: Ticket) -> bool:
+        """Block until the ticket holds a slot.
+
+        Returns False if the ticket was withdrawn while waiting and raises
+        ExecutionOverloadedError if no slot became free in time.
+        """
+        ticket.event.wait(self.max_wait)
+        with self._lock:
+            if ticket.granted:
+                return True
+            if ticket.withdrawn:
+                return False
+            self._remove(ticket)
+            self._reject("等待执行资源超时，请稍后重试")
+
+    def _remove(self, ticket: Ticket):
+        tickets = ticket.lane.users.get(ticket.user_id)
+        if tickets is None or ticket not in tickets:
+            return
+        tickets.remove(ticket)
+        if not tickets:
+            del ticket.lane.users[ticket.user_id]
+        self._unqueue(ticket)
+
+    def withdraw(self, ticket: Ticket):
+        """Give up a ticket, queued or running, e.g. when the client went away"""
+        with self._lock:
+            if not ticket.granted:
+                ticket.withdrawn = True
+                self._remove(ticket)
+                ticket.event.set()
+                return
+        self.release(ticket)
+
+    def release(self, ticket: Ticket):
+        with self._lock:
+            if not ticket.granted or ticket.released:
+                return
+            ticket.released = True
+            self._running -= 1
+            self._user_running[ticket.user_id] -= 1
+            if not self._user_running[ticket.user_id]:
+                del self._user_running[ticket.user_id]
+            duration = time.monotonic() - ticket.granted_at
+            self._avg_duration += _DURATION_SMOOTHING * (duration - self._avg_duration)
+            self._dispatch()
+
+    def resize(self, slots: int):
+        """Change the number of slots, e.g. when runner capacity changes"""
+        with self._lock:
+            self.slots = max(1, slots)
+            self._dispatch()
+
+    def _wait_blocked(self, ticket: Ticket):
+        """`wait()` for callers blocking their thread, at most `max_blocked` at once"""
+        with self._lock:
+            if ticket.granted:
+                return
+            if self._blocked >= self.max_blocked:
+                ticket.withdrawn = True
+                self._remove(ticket)
+                self._reject("等待执行的请求过多，请稍后重试")
+            self._blocked += 1
+        try:
+            self.wait(ticket)
+        finally:
+            with self._lock:
+                self._blocked -= 1
+
+    @contextmanager
+    def slot(self, user_id: int, user_level: int):
+        """Hold an execution slot for the duration of the block"""
+        with timed("queue"):
+            ticket = self.submit(user_id, user_level)
+            self._wait_blocked(ticket)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "slots": self.slots,
+                "running": self._running,
+                "queued": self._queued,
+                "blocked": self._blocked,
+                "lanes": {level: lane.queued for level, lane in sorted(self._lanes.items())},
+            }
+
+
+execution_scheduler = ExecutionScheduler(EXECUTION_SLOTS, SCHEDULER_QUEUE_LIMIT, SCHEDULER_MAX_WAIT,
+                                         SCHEDULER_MAX_BLOCKED)
+metrics.register_gauge("scheduler_running", lambda: execution_scheduler.stats()["running"])
+metrics.register_gauge("scheduler_queued", lambda: execution_scheduler.stats()["queued"])
@@ -0,0 +1,270 @@
+"""Per-execution scratch directories and the artifacts kept from them.
+
+Every run gets a fresh working directory (also its TMPDIR) under
+`SCRATCH_ROOT`, on tmpfs where the host has one, so snippets neither litter
+the server's directory nor contend for its disk. Single files are capped at
+the level's `max_scratch_mb` (RLIMIT_FSIZE in the run). When the run ends,
+the regular files it left are stored as one deflate-compressed zip under
+`ARTIFACT_DIR`, within the level's `max_artifacts` and `max_scratch_mb`
+budgets. The directory is then renamed into a trash directory, which is
+O(1) for the request, and deleted by a background thread.
+
+Files of multi-file bundles (services/bundles.py) are kept in a per-host
+cache under `SCRATCH_ROOT`, one file per content hash, and copied into each
+run's directory. Runs share the host's uid, so nothing keeps a snippet from
+rewriting a cached file: its content is checked against its hash every time
+it is used, and a file that no longer matches is dropped and fetched again.
+Bundle files a run leaves unchanged are not artifacts.
+"""
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from typing import Callable, Optional
+
+from services import metrics
+
+SCRATCH_ROOT = os.environ.get("EXECUTION_SCRATCH_ROOT") or (
+    "/dev/shm/coderunner" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "coderunner")
+)
+ARTIFACT_DIR = "./data/artifacts"
+# Stored artifacts older than this are removed
+ARTIFACT_RETENTION_DAYS = 7
+# Scratch directories left behind by a crashed process are purged after this
+SCRATCH_STALE_SECONDS = 24 * 3600
+# Cached bundle files no run has used for this long are removed
+BLOB_CACHE_IDLE_SECONDS = 24 * 3600
+
+_RUNS_DIR = os.path.join(SCRATCH_ROOT, "runs")
+_TRASH_DIR = os.path.join(SCRATCH_ROOT, "trash")
+_BLOBS_DIR = os.path.join(SCRATCH_ROOT, "blobs")
+
+_purge_wakeup = threading.Event()
+_purge_lock = threading.Lock()
+_purge_thread: Optional[threading.Thread] = None
+
+
+def _purge_loop():
+    pruned = time.monotonic()
+    while True:
+        _purge_wakeup.wait()
+        _purge_wakeup.clear()
+        if time.monotonic() - pruned > 3600:
+            pruned = time.monotonic()
+            _prune_blob_cache()
+        try:
+            names = os.listdir(_TRASH_DIR)
+        except OSError:
+            continue
+        for name in names:
+            shutil.rmtree(os.path.join(_TRASH_DIR, name), ignore_errors=True)
+
+
+def _schedule_purge():
+    global _purge_thread
+    with _purge_lock:
+        if _purge_thread is None:
+            _purge_thread = threading.Thread(target=_purge_loop, name="scratch-purge", daemon=True)
+            _purge_thread.start()
+    _purge_wakeup.set()
+
+
+def _cached_blob(sha256: str) -> str:
+    return os.path.join(_BLOBS_DIR, sha256)
+
+
+def _read_cached_blob(sha256: str) -> Optional[bytes]:
+    """Content of a cached bundle file, or None if missing or not intact"""
+    path = _cached_blob(sha256)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if hashlib.sha256(data).hexdigest() != sha256:
+        metrics.increment("bundle_cache_corrupted")
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    return data
+
+
+def uncached_blobs(hashes) -> list[str]:
+    """Bundle files among `hashes` this host has no intact copy of"""
+    return [sha256 for sha256 in hashes if _read_cached_blob(sha256) is None]
+
+
+def cache_blob(sha256: str, data: bytes):
+    """Add a bundle file to this host's cache"""
+    if hashlib.sha256(data).hexdigest() != sha256:
+        raise ValueError(f"文件内容与哈希不符: {sha256}")
+    os.makedirs(_BLOBS_DIR, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=_BLOBS_DIR)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temporary, _cached_blob(sha256))
+    except BaseException:
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+        raise
+
+
+def _prune_blob_cache():
+    if not os.path.isdir(_BLOBS_DIR):
+        return
+    idle = time.time() - BLOB_CACHE_IDLE_SECONDS
+    for name in os.listdir(_BLOBS_DIR):
+        path = os.path.join(_BLOBS_DIR, name)
+        try:
+            # Placing a file into a run touches its mtime
+            if os.path.getmtime(path) < idle:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+class ScratchDir:
+    """Working directory of one run"""
+
+    def __init__(self):
+        os.makedirs(_RUNS_DIR, exist_ok=True)
+        self.path = tempfile.mkdtemp(dir=_RUNS_DIR)
+        # Path of each bundle file placed -> (size, mtime_ns) right after placing it
+        self.placed: dict[str, tuple[int, int]] = {}
+
+    def place_files(self, files: dict[str, str], fetch: Callable[[str], bytes]):
+        """Copy bundle files (path -> content hash) into the directory.
+
+        Files this host has no intact copy of are loaded with `fetch(hash)`
+        and cached first, so later runs with the same files fetch nothing.
+        """
+        for path, sha256 in files.items():
+            data = _read_cached_blob(sha256)
+            if data is None:
+                data = fetch(sha256)
+                cache_blob(sha256, data)
+                metrics.increment("bundle_files_cached")
+            else:
+                try:
+                    os.utime(_cached_blob(sha256))
+                except OSError:
+                    pass
+            target = os.path.join(self.path, *path.split("/"))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as f:
+                f.write(data)
+            info = os.stat(target)
+            self.placed[target] = (info.st_size, info.st_mtime_ns)
+        metrics.increment("bundle_files_placed", len(files))
+
+    def collect(self, level_config: dict) -> tuple[int, Optional[str]]:
+        """Archive the files the run left; returns their number and the archive path"""
+        budget = level_config["max_scratch_mb"] * 1024 * 1024
+        limit = level_config["max_artifacts"]
+        files = []
+        for directory, subdirs, names in os.walk(self.path):
+            subdirs.sort()
+            for name in sorted(names):
+                path = os.path.join(directory, name)
+                try:
+                    info = os.lstat(path)
+                except OSError:
+                    continue
+                # Only regular files: a symlink could point anywhere on the host
+                if not stat.S_ISREG(info.st_mode):
+                    continue
+                if self.placed.get(path) == (info.st_size, info.st_mtime_ns):
+                    continue  # a bundle file the run left as it was
+                if info.st_size > budget:
+                    continue
+                if len(files) >= limit:
+                    break
+                budget -= info.st_size
+                files.append((path, os.path.relpath(path, self.path)))
+        if not files:
+            return 0, None
+
+        os.makedirs(ARTIFACT_DIR, exist_ok=True)
+        archive_path = os.path.join(ARTIFACT_DIR, f"{uuid.uuid4().hex}.zip")
+        stored = 0
+        with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for path, name in files:
+                try:
+                    archive.write(path, name.replace(os.sep, "/"))
+                    stored += 1
+                except OSError:
+                    pass
+        metrics.increment("artifacts_stored", stored)
+        return stored, archive_path
+
+    def remove(self):
+        """Hand the directory over to the background purge"""
+        os.makedirs(_TRASH_DIR, exist_ok=True)
+        try:
+            os.rename(self.path, os.path.join(_TRASH_DIR, os.path.basename(self.path)))
+        except OSError:
+            shutil.rmtree(self.path, ignore_errors=True)
+            return
+        _schedule_purge()
+
+
+def list_artifacts(archive_path: str) -> list[dict]:
+    with zipfile.ZipFile(archive_path) as archive:
+        return [
+            {"name": info.filename, "size": info.file_size, "compressed_size": info.compress_size}
+            for info in archive.infolist()
+        ]
+
+
+def artifact_chunks(archive_path: str, name: str, chunk_size: int = 65536):
+    """Decompressed content of one stored artifact, in chunks.
+
+    Raises KeyError right away if the archive has no such member.
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        archive.getinfo(name)
+
+    def chunks():
+        with zipfile.ZipFile(archive_path) as archive, archive.open(name) as member:
+            while True:
+                data = member.read(chunk_size)
+                if not data:
+                    return
+                yield data
+    return chunks()
+
+
+def cleanup_scratch():
+    """Remove expired artifacts, idle cached bundle files and scratch directories of crashed processes"""
+    cutoff = time.time() - ARTIFACT_RETENTION_DAYS * 86400
+    if os.path.isdir(ARTIFACT_DIR):
+        for name in os.listdir(ARTIFACT_DIR):
+            path = os.path.join(ARTIFACT_DIR, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    stale = time.time() - SCRATCH_STALE_SECONDS
+    if os.path.isdir(_RUNS_DIR):
+        for name in os.listdir(_RUNS_DIR):
+            path = os.path.join(_RUNS_DIR, name)
+            try:
+                if os.path.getmtime(path) < stale:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+    _prune_blob_cache()
+    if os.path.isdir(_TRASH_DIR):
+        _schedule_purge()
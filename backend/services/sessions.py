@@ -0,0 +1,213 @@
+"""Persistent interpreter sessions for interactive, multi-cell execution.
+
+A session is a kernel process (`worker_main.py --session`) bound to one
+conda environment. Its globals survive between cells, so data loaded and
+modules imported by one cell are there for the next. The kernel as a whole
+is capped at the owner's `max_memory`, and each user keeps at most
+`max_sessions` kernels at a time. Sessions idle for longer than
+`SESSION_IDLE_TIMEOUT` are closed by a background sweeper. Every kernel
+works in a scratch directory of its own (see services/scratch.py), capped
+at `max_scratch_mb` per file and removed when the session closes.
+"""
+import os
+import signal
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from models.user_levels import get_user_level_config
+from services import metrics
+from services.conda_envs import resolve_environment
+from services.executor import ExecutionResult, OutputCallback, run_session_cell
+from services.process_reaper import finish_process_group
+from services.scratch import ScratchDir
+from services.worker_pool import CancelToken, Worker, WorkerError
+
+# Seconds without a cell before a session is closed
+SESSION_IDLE_TIMEOUT = 15 * 60
+# Seconds between two checks for idle sessions
+SESSION_SWEEP_INTERVAL = 30
+
+
+class SessionLimitError(Exception):
+    """Raised when a user already holds as many sessions as their level allows"""
+
+
+class SessionBusyError(Exception):
+    """Raised when a cell is submitted while another one is still running"""
+
+
+class SessionKernel(Worker):
+    """Worker process running in session mode, leading its own process group"""
+
+    def __init__(self, python_cmd: list[str], env: Optional[dict], memory_limit_mb: int, workdir: str,
+                 file_limit_mb: int):
+        super().__init__(
+            python_cmd, env, mode_args=("--session", str(memory_limit_mb), workdir, str(file_limit_mb)),
+            new_session=True
+        )
+
+    def _send_cancel(self, request_id: int):
+        # The cell runs in the kernel's main thread, only a signal reaches it
+        try:
+            os.kill(self.process.pid, signal.SIGINT)
+        except OSError:
+            pass
+
+
+class InteractiveSession:
+    def __init__(self, user_id: int, user_level: int, conda_env: str, kernel: SessionKernel, scratch: ScratchDir):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.user_level = user_level
+        self.conda_env = conda_env
+        self.kernel = kernel
+        self.scratch = scratch
+        self.created_at = datetime.utcnow()
+        self.cells = 0
+        self.last_used = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self.kernel.alive
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    @property
+    def idle_seconds(self) -> int:
+        return int(time.monotonic() - self.last_used)
+
+    @property
+    def memory_usage(self) -> int:
+        """Resident size of the kernel after its last cell, in MB"""
+        return (self.kernel.rss_kb + 1023) // 1024
+
+    def run(self, code: str, cancel_token: Optional[CancelToken] = None,
+            on_output: Optional[OutputCallback] = None) -> ExecutionResult:
+        if not self._lock.acquire(blocking=False):
+            raise SessionBusyError("会话正在执行其他代码")
+        try:
+            self.cells += 1
+            return run_session_cell(
+                self.kernel, code, get_user_level_config(self.user_level), cancel_token, on_output
+            )
+        finally:
+            self.last_used = time.monotonic()
+            self._lock.release()
+
+    def close(self):
+        self.kernel.close()
+        # Background processes a cell started live in the kernel's group
+        finish_process_group(self.kernel.process.pid)
+        self.scratch.remove()
+
+
+class SessionManager:
+    def __init__(self, idle_timeout: float, sweep_interval: float):
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self._sessions: dict[str, InteractiveSession] = {}
+        self._starting: dict[int, int] = {}  # user id -> kernels being started
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _user_count(self, user_id: int) -> int:
+        owned = sum(1 for session in self._sessions.values() if session.user_id == user_id)
+        return owned + self._starting.get(user_id, 0)
+
+    def create(self, user_id: int, user_level: int, conda_env: Optional[str]) -> InteractiveSession:
+        """Start a kernel for the user; raises SessionLimitError over their quota"""
+        config = get_user_level_config(user_level)
+        environment = resolve_environment(conda_env)
+        with self._lock:
+            if self._user_count(user_id) >= config["max_sessions"]:
+                raise SessionLimitError(f"会话数量已达上限 ({config['max_sessions']} 个)")
+            self._starting[user_id] = self._starting.get(user_id, 0) + 1
+        scratch = ScratchDir()
+        try:
+            # Starting the interpreter can take a while, not under the lock
+            kernel = SessionKernel(environment.command(), environment.process_env(), config["max_memory"],
+                                   scratch.path, config["max_scratch_mb"])
+        except BaseException:
+            scratch.remove()
+            raise
+        finally:
+            with self._lock:
+                self._starting[user_id] -= 1
+                if not self._starting[user_id]:
+                    del self._starting[user_id]
+
+        session = InteractiveSession(user_id, user_level, environment.name, kernel, scratch)
+        with self._lock:
+            self._sessions[session.id] = session
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="session-sweeper", daemon=True)
+                self._thread.start()
+        metrics.increment("sessions_started")
+        return session
+
+    def get(self, session_id: str, user_id: int) -> Optional[InteractiveSession]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None or session.user_id != user_id:
+            return None
+        return session
+
+    def list(self, user_id: int) -> list[InteractiveSession]:
+        with self._lock:
+            sessions = [session for session in self._sessions.values() if session.user_id == user_id]
+        return sorted(sessions, key=lambda session: session.created_at)
+
+    def run(self, session: InteractiveSession, code: str, cancel_token: Optional[CancelToken] = None,
+            on_output: Optional[OutputCallback] = None) -> ExecutionResult:
+        """Run a cell; a kernel that died during it ends the session"""
+        try:
+            return session.run(code, cancel_token, on_output)
+        except WorkerError:
+            self.close(session.id)
+            raise WorkerError("会话内核已退出，会话已关闭")
+
+    def close(self, session_id: str) -> bool:
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.close()
+        return True
+
+    def sweep(self):
+        """Close sessions that sat idle too long or whose kernel died"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            if session.busy:
+                continue
+            if not session.alive or session.idle_seconds >= self.idle_timeout:
+                if self.close(session.id):
+                    metrics.increment("sessions_evicted")
+
+    def _loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Session sweep failed: {e}")
+
+    def shutdown(self):
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            session.close()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+session_manager = SessionManager(SESSION_IDLE_TIMEOUT, SESSION_SWEEP_INTERVAL)
+metrics.register_gauge("sessions_open", lambda: len(session_manager))
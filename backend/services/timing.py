@@ -0,0 +1,98 @@
+"""Per-request phase timings, reported in the `Server-Timing` header.
+
+`ServerTimingMiddleware` gives every HTTP request a `PhaseTimer`. Code on
+the request path marks its phases with `timed("auth")`, the `timed_call`
+decorator or `record_phase("run", seconds)` (repeated phases add up). Outside a request,
+e.g. in job threads, these calls do nothing. The benchmark harness
+(benchmarks/execute_bench.py) reads the header to break latency down into
+auth, quota, queue, spawn, run and persist.
+"""
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: dict[str, float] = {}  # name -> seconds
+
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def header(self) -> str:
+        entries = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.phases.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.3f}")
+        return ", ".join(entries)
+
+
+# Set per request; thread pool calls of sync routes copy the context, and
+# share the timer object with it
+_current: ContextVar[Optional[PhaseTimer]] = ContextVar("phase_timer", default=None)
+
+
+def record_phase(name: str, seconds: float):
+    timer = _current.get()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+@contextmanager
+def timed(name: str):
+    """Add the duration of the block to the current request's phase"""
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+
+def timed_call(name: str):
+    """Decorator form of `timed` for plain and async functions"""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with timed(name):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with timed(name):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ServerTimingMiddleware:
+    """Times each request and adds its phases as a Server-Timing header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timer = PhaseTimer()
+        token = _current.set(timer)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timer.header().encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
@@ -0,0 +1,329 @@
+"""Signed webhook deliveries for finished API executions.
+
+Deliveries go through a bounded in-memory queue served by a few sender
+threads. The body is signed with HMAC-SHA256 using the API key the run was
+requested with. The `X-CodeRunner-Signature: t=<unix time>,v1=<hex>` header
+covers `"<t>." + body`, so receivers can verify the sender and reject replays.
+Failed deliveries (connection errors, timeouts, 408/429 and 5xx responses)
+are retried with exponential backoff up to `WEBHOOK_MAX_ATTEMPTS` times.
+
+Callback URLs must resolve to public addresses: loopback, private,
+link-local and other non-global addresses are refused, as is anything in
+`WEBHOOK_DENIED_HOSTS`. `WEBHOOK_ALLOWED_HOSTS` lets chosen hosts or
+networks through anyway, e.g. a local test receiver. The check runs when
+the callback is requested and again before every attempt, since DNS
+answers may change in between, and the attempt connects to the address
+that passed the check instead of resolving the host once more.
+"""
+import functools
+import hashlib
+import heapq
+import hmac
+import ipaddress
+import itertools
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from services import metrics
+
+# Deliveries waiting or being retried at the same time
+WEBHOOK_QUEUE_LIMIT = 1000
+# Threads sending deliveries
+WEBHOOK_SENDERS = 4
+# Seconds to wait for the receiver to answer
+WEBHOOK_TIMEOUT = 10
+WEBHOOK_MAX_ATTEMPTS = 6
+# Delay before the first retry (seconds), doubled for every further one
+WEBHOOK_RETRY_BASE = 2
+WEBHOOK_RETRY_MAX = 300
+
+# Comma separated host names or networks (CIDR) that may receive callbacks
+# even when they are not public, e.g. "localhost,10.1.2.0/24"
+WEBHOOK_ALLOWED_HOSTS = os.environ.get("WEBHOOK_ALLOWED_HOSTS", "")
+# Comma separated host names or networks that never receive callbacks
+WEBHOOK_DENIED_HOSTS = os.environ.get("WEBHOOK_DENIED_HOSTS", "")
+
+SIGNATURE_HEADER = "X-CodeRunner-Signature"
+
+_RETRY_STATUSES = {408, 429}
+
+
+class WebhookQueueFullError(Exception):
+    """Raised when the delivery queue cannot take another webhook"""
+
+
+class HostRules:
+    """Host names and networks parsed from a comma separated setting"""
+
+    def __init__(self, spec: str):
+        self.names: set[str] = set()
+        self.networks: list = []
+        for item in spec.split(","):
+            item = item.strip().lower()
+            if not item:
+                continue
+            try:
+                self.networks.append(ipaddress.ip_network(item, strict=False))
+            except ValueError:
+                self.names.add(item.rstrip("."))
+
+    def match(self, host: str, address) -> bool:
+        return host in self.names or any(address in network for network in self.networks)
+
+
+_allowed_hosts = HostRules(WEBHOOK_ALLOWED_HOSTS)
+_denied_hosts = HostRules(WEBHOOK_DENIED_HOSTS)
+
+
+def _resolve(host: str, port: int) -> list:
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        raise ValueError(f"无法解析回调地址的主机: {host}")
+    addresses = []
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%", 1)[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        addresses.append(address)
+    return addresses
+
+
+def check_callback_host(url: str) -> str:
+    """Raise ValueError unless every address the URL's host resolves to may receive callbacks.
+
+    Returns the address to connect to.
+    """
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").rstrip(".")
+    if not host:
+        raise ValueError("callback_url 缺少主机名")
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    except ValueError:
+        raise ValueError("callback_url 端口无效")
+    addresses = _resolve(host, port)
+    for address in addresses:
+        if _allowed_hosts.match(host, address):
+            continue
+        if _denied_hosts.match(host, address) or not address.is_global or address.is_multicast:
+            raise ValueError(f"不允许回调到该地址: {host}")
+    return str(addresses[0])
+
+
+def validate_callback_url(url: str) -> str:
+    """Return the URL if it can be delivered to, raise ValueError otherwise"""
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.netloc:
+        raise ValueError("callback_url 必须是 http(s) 地址")
+    check_callback_host(url)
+    return url
+
+
+class _PinnedConnection:
+    """Connects to a checked address instead of resolving its host again.
+
+    The host name still goes into the Host header, SNI and certificate check.
+    """
+    address = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        self._dns_host = self.address
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+
+class _PinnedHTTPConnection(_PinnedConnection, HTTPConnection):
+    pass
+
+
+class _PinnedHTTPSConnection(_PinnedConnection, HTTPSConnection):
+    pass
+
+
+class _PinnedPool:
+    def __init__(self, *args, address: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.address = address
+
+    def _new_conn(self):
+        conn = super()._new_conn()
+        conn.address = self.address
+        return conn
+
+
+class _PinnedHTTPPool(_PinnedPool, HTTPConnectionPool):
+    ConnectionCls = _PinnedHTTPConnection
+
+
+class _PinnedHTTPSPool(_PinnedPool, HTTPSConnectionPool):
+    ConnectionCls = _PinnedHTTPSConnection
+
+
+class _PinnedAdapter(HTTPAdapter):
+    def __init__(self, address: str):
+        self.address = address
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": functools.partial(_PinnedHTTPPool, address=self.address),
+            "https": functools.partial(_PinnedHTTPSPool, address=self.address),
+        }
+
+
+def sign_payload(secret: str, timestamp: int, body: bytes) -> str:
+    message = str(timestamp).encode("ascii") + b"." + body
+    return hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+class _Delivery:
+    def __init__(self, url: str, body: bytes, secret: str, event: str):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.body = body
+        self.secret = secret
+        self.event = event
+        self.attempts = 0
+
+
+class WebhookDispatcher:
+    def __init__(self, senders: int, queue_limit: int):
+        self.senders = senders
+        self.queue_limit = queue_limit
+        self._heap: list[tuple[float, int, _Delivery]] = []  # (due, tiebreak, delivery)
+        self._order = itertools.count()
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._threads: list[threading.Thread] = []
+        self._stopped = False
+
+    @property
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._heap) + self._in_flight
+
+    @property
+    def full(self) -> bool:
+        return self.pending >= self.queue_limit
+
+    def send(self, url: str, payload: dict, secret: str, event: str = "execution.completed") -> str:
+        """Queue a delivery and return its id"""
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        delivery = _Delivery(url, body, secret, event)
+        with self._cond:
+            if len(self._heap) + self._in_flight >= self.queue_limit:
+                metrics.increment("webhooks_dropped")
+                raise WebhookQueueFullError("回调队列已满")
+            if not self._threads:
+                for index in range(self.senders):
+                    thread = threading.Thread(target=self._loop, name=f"webhook-sender-{index}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+            heapq.heappush(self._heap, (time.monotonic(), next(self._order), delivery))
+            self._cond.notify()
+        return delivery.id
+
+    def _next_due(self):
+        """Block until a delivery is due; None once stopped"""
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                if self._heap:
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        _, _, delivery = heapq.heappop(self._heap)
+                        self._in_flight += 1
+                        return delivery
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    def _attempt(self, delivery: _Delivery) -> bool:
+        """Send once; returns whether it is worth retrying on failure"""
+        try:
+            address = check_callback_host(delivery.url)
+        except ValueError as e:
+            print(f"Webhook {delivery.id} to {delivery.url} refused: {e}")
+            return False
+        timestamp = int(time.time())
+        headers = {
+            "Content-Type": "application/json",
+            "User-Agent": "CodeRunner-Webhooks/1.0",
+            "X-CodeRunner-Event": delivery.event,
+            "X-CodeRunner-Delivery": delivery.id,
+            SIGNATURE_HEADER: f"t={timestamp},v1={sign_payload(delivery.secret, timestamp, delivery.body)}",
+        }
+        with requests.Session() as session:
+            # A second DNS answer could point somewhere the check refused
+            session.mount("http://", _PinnedAdapter(address))
+            session.mount("https://", _PinnedAdapter(address))
+            response = session.post(delivery.url, data=delivery.body, headers=headers,
+                                    timeout=WEBHOOK_TIMEOUT, allow_redirects=False)
+        if 200 <= response.status_code < 300:
+            return True
+        if response.status_code in _RETRY_STATUSES or response.status_code >= 500:
+            raise requests.HTTPError(f"HTTP {response.status_code}")
+        print(f"Webhook {delivery.id} rejected by {delivery.url}: HTTP {response.status_code}")
+        return False
+
+    def _loop(self):
+        while True:
+            delivery = self._next_due()
+            if delivery is None:
+                return
+            delivery.attempts += 1
+            retry = False
+            try:
+                if self._attempt(delivery):
+                    metrics.increment("webhooks_delivered")
+                else:
+                    metrics.increment("webhooks_failed")
+            except requests.RequestException as e:
+                retry = delivery.attempts < WEBHOOK_MAX_ATTEMPTS
+                if not retry:
+                    metrics.increment("webhooks_failed")
+                    print(f"Webhook {delivery.id} to {delivery.url} failed after {delivery.attempts} attempts: {e}")
+            except Exception as e:
+                # Anything else must not take the sender thread down with it
+                metrics.increment("webhooks_failed")
+                print(f"Webhook {delivery.id} to {delivery.url} failed: {e!r}")
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    if retry:
+                        metrics.increment("webhook_retries")
+                        delay = min(WEBHOOK_RETRY_BASE * 2 ** (delivery.attempts - 1), WEBHOOK_RETRY_MAX)
+                        # Jitter keeps retries for a recovering receiver apart
+                        due = time.monotonic() + delay * random.uniform(0.8, 1.2)
+                        heapq.heappush(self._heap, (due, next(self._order), delivery))
+                        self._cond.notify()
+
+    def shutdown(self):
+        with self._cond:
+            self._stopped = True
+            dropped = len(self._heap)
+            self._heap.clear()
+            self._cond.notify_all()
+        if dropped:
+            print(f"Dropping {dropped} undelivered webhooks on shutdown")
+
+
+webhook_dispatcher = WebhookDispatcher(WEBHOOK_SENDERS, WEBHOOK_QUEUE_LIMIT)
+metrics.register_gauge("webhooks_pending", lambda: webhook_dispatcher.pending)
@@ -0,0 +1,1055 @@
+"""Warm interpreter worker for CodeRunner.
+
+This script is started once per pool slot with the target environment's
+interpreter and then serves many executions. It must only depend on the
+standard library because it runs inside user conda environments.
+
+Protocol: one JSON object per line. The API writes requests to the worker's
+stdin and reads messages from its stdout: any number of "output" chunks
+followed by one "exit" message per request. Each request forks an isolated
+child from the warmed-up interpreter, so snippets never see each other's
+state and the worker itself stays clean.
+
+Started with `--preload mod1,mod2` the worker imports those modules before
+serving requests, so every forked run finds them already loaded.
+
+Multi-file bundles are already in the run's working directory when the
+request arrives; "filename" names the entry point among them.
+
+Started as `worker_main.py --run <filename>` it is the cold-start runner
+instead: it reads one JSON request (code and parameters) from stdin and runs
+it in-process, so cold runs need no temporary source file either.
+
+A request carrying "profile" runs the snippet under cProfile or a wall-clock
+stack sampler and writes the report (top functions, collapsed stacks,
+profiler overhead) as JSON to the given path; a snapshot is written shortly
+before the timeout so killed runs still have one.
+
+Parameters of a run are available to the snippet as the `params` global and
+as JSON on its stdin. Warm workers compile each distinct snippet once and
+keep the code object, so repeated runs only pay for the parameters.
+
+Started as `worker_main.py --session <memory_mb> <workdir> <file_limit_mb>`
+it is a session kernel: cells run in-process, inside the session's scratch
+directory, against globals kept between requests, with `print()` output
+forwarded as "output" messages. A cell is interrupted by
+SIGALRM when it exceeds its timeout and by SIGINT when the API cancels it;
+the kernel itself keeps running either way.
+
+Every child leads its own session, so whatever it spawns can be killed as a
+group. A run ends when the child exits; descendants still alive at that
+point are leaked processes, reported to the API and killed with the group.
+"""
+import ast
+import codecs
+import cProfile
+import importlib
+import io
+import itertools
+import json
+import linecache
+import os
+import select
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - non-POSIX
+    resource = None
+
+READ_CHUNK = 65536
+# How often to check for the child's exit where pidfds are unavailable
+CHILD_POLL_INTERVAL = 0.05
+# Seconds to wait for a killed process group to disappear
+GROUP_EXIT_TIMEOUT = 1.0
+# prctl option making this process adopt orphaned descendants
+PR_SET_CHILD_SUBREAPER = 36
+# Compiled snippets kept by a warm worker
+COMPILE_CACHE_SIZE = 256
+# Written by the child to its status pipe when it ran out of memory
+STATUS_MEMORY_ERROR = b"M"
+# Seconds between stack samples of a profiled run
+PROFILE_INTERVAL = 0.005
+# Functions listed in a profile report, and distinct stacks kept in it
+PROFILE_TOP = 30
+PROFILE_MAX_STACKS = 1000
+# A profile snapshot is written this long before the run's timeout
+PROFILE_SNAPSHOT_MARGIN = 0.5
+
+_cgroup_ids = itertools.count(1)
+_compiled = OrderedDict()
+
+
+def _current_rss_kb():
+    """Resident set size of this worker in KB (0 if unknown)"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _current_vsz_bytes():
+    """Virtual size of this worker in bytes (0 if unknown)"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[0])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _write_file(path, value):
+    with open(path, "w") as f:
+        f.write(value)
+
+
+def _read_keyed_file(path):
+    """Parse cgroup files made of `key value` lines"""
+    values = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    values[parts[0]] = int(parts[1])
+    except (OSError, ValueError):
+        pass
+    return values
+
+
+def _create_cgroup(root, memory_limit_mb):
+    """Create a cgroup v2 child of `root` capped at the memory limit.
+
+    `root` must be a delegated cgroup with the memory controller enabled in
+    its cgroup.subtree_control. Returns None when that is not available so
+    the caller falls back to RLIMIT_AS.
+    """
+    if not root or not os.path.isdir(root) or not os.access(root, os.W_OK):
+        return None
+    path = os.path.join(root, "exec-%d-%d" % (os.getpid(), next(_cgroup_ids)))
+    try:
+        os.mkdir(path)
+        _write_file(os.path.join(path, "memory.max"), str(memory_limit_mb * 1024 * 1024))
+        try:
+            _write_file(os.path.join(path, "memory.swap.max"), "0")
+        except OSError:
+            pass
+        return path
+    except OSError:
+        _remove_cgroup(path)
+        return None
+
+
+def _cgroup_usage(path):
+    """Peak memory, CPU time and OOM kills recorded by a cgroup"""
+    usage = {}
+    try:
+        with open(os.path.join(path, "memory.peak")) as f:
+            usage["max_rss_kb"] = int(f.read().strip()) // 1024
+    except (OSError, ValueError):
+        pass
+    cpu = _read_keyed_file(os.path.join(path, "cpu.stat"))
+    if "user_usec" in cpu:
+        usage["user_time"] = cpu["user_usec"] / 1e6
+        usage["system_time"] = cpu.get("system_usec", 0) / 1e6
+    events = _read_keyed_file(os.path.join(path, "memory.events"))
+    usage["oom_kills"] = events.get("oom_kill", 0)
+    return usage
+
+
+def _remove_cgroup(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+def _limit_memory(memory_limit_mb, cgroup):
+    """Executed in the child before user code: apply the memory ceiling"""
+    if cgroup is not None:
+        try:
+            _write_file(os.path.join(cgroup, "cgroup.procs"), str(os.getpid()))
+            return
+        except OSError:
+            pass
+    if resource is not None:
+        # The forked interpreter's existing mappings do not count against
+        # the snippet, so the ceiling is on top of the current size.
+        limit = _current_vsz_bytes() + memory_limit_mb * 1024 * 1024
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ValueError, OSError):
+            pass
+
+
+def _enter_workdir(workdir, file_limit_mb):
+    """Executed before user code: move into the run's scratch directory"""
+    if workdir:
+        os.chdir(workdir)
+        os.environ["TMPDIR"] = workdir
+        tempfile.tempdir = None
+        # Imported bundle modules would leave __pycache__ among the artifacts
+        sys.dont_write_bytecode = True
+    if file_limit_mb and resource is not None:
+        # Python ignores SIGXFSZ, so oversized writes fail with EFBIG
+        limit = file_limit_mb * 1024 * 1024
+        try:
+            resource.setrlimit(resource.RLIMIT_FSIZE, (limit, limit))
+        except (ValueError, OSError):
+            pass
+
+
+def _group_members(pgid, cgroup=None):
+    """Live pids in the process group (and cgroup), excluding its leader"""
+    members = set()
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        entries = []
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # fields[0] is the state, fields[2] the process group
+        if fields[0] != "Z" and int(fields[2]) == pgid:
+            members.add(int(entry))
+    if cgroup is not None:
+        try:
+            with open(os.path.join(cgroup, "cgroup.procs")) as f:
+                members.update(int(line) for line in f if line.strip())
+        except (OSError, ValueError):
+            pass
+    members.discard(pgid)
+    return members
+
+
+def _kill_tree(pgid, cgroup=None):
+    """SIGKILL everything the run started, even processes that left the group"""
+    if cgroup is not None:
+        try:
+            _write_file(os.path.join(cgroup, "cgroup.kill"), "1")
+        except OSError:
+            pass
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _reap_orphans():
+    """Collect exited descendants adopted by this (subreaper) worker"""
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+def _wait_group_empty(pgid, cgroup):
+    """True once nothing of the killed group is left"""
+    deadline = time.monotonic() + GROUP_EXIT_TIMEOUT
+    while True:
+        _reap_orphans()
+        if not _group_members(pgid, cgroup):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+
+
+def _become_subreaper():
+    """Adopt orphaned descendants of runs so they are reaped, not left as zombies"""
+    if not sys.platform.startswith("linux"):
+        return
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _preload(modules):
+    """Import modules once so forked runs share them; returns per-module seconds"""
+    times = {}
+    errors = {}
+    for name in modules:
+        start = time.monotonic()
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            errors[name] = "%s: %s" % (type(e).__name__, e)
+            continue
+        times[name] = time.monotonic() - start
+    return times, errors
+
+
+def _imported_modules(code):
+    """Top-level names of the modules a snippet imports"""
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return set()
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split(".")[0])
+    return names
+
+
+def _open_pidfd(pid):
+    """A descriptor that becomes readable when the child exits, if supported"""
+    if hasattr(os, "pidfd_open"):
+        try:
+            return os.pidfd_open(pid)
+        except OSError:
+            pass
+    return None
+
+
+def _compile_cached(code, filename):
+    """Code object for a snippet, compiled once per distinct source.
+
+    Returns None for code that does not compile; the child then compiles it
+    itself so the error is reported like any other.
+    """
+    key = (filename, code)
+    compiled = _compiled.get(key)
+    if compiled is not None:
+        _compiled.move_to_end(key)
+        return compiled
+    try:
+        compiled = compile(code, filename, "exec")
+    except (SyntaxError, ValueError):
+        return None
+    _compiled[key] = compiled
+    if len(_compiled) > COMPILE_CACHE_SIZE:
+        _compiled.popitem(last=False)
+    return compiled
+
+
+def _system_exit_code(e):
+    """Exit code of a SystemExit, printing a non-integer message like Python does"""
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def _frame_label(code):
+    if isinstance(code, str):  # built-in function in cProfile stats
+        return code
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+def _cprofile_call_cost(calls=2000):
+    """Seconds cProfile adds to one function call on this machine"""
+    def noop():
+        pass
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        noop()
+    plain = time.perf_counter() - start
+    profiler = cProfile.Profile()
+    profiler.enable()
+    start = time.perf_counter()
+    for _ in range(calls):
+        noop()
+    profiled = time.perf_counter() - start
+    profiler.disable()
+    return max(0.0, (profiled - plain) / calls)
+
+
+class _Profiler:
+    """Profile of one snippet run, written as JSON to `output`.
+
+    A helper thread records the main thread's stack every PROFILE_INTERVAL
+    (wall-clock, so sleeps and I/O show up) for the collapsed stacks, and
+    writes a snapshot before `timeout`. "cprofile" additionally traces every
+    call for exact call counts and times in the top functions; calls still
+    running are missing from those, so a snapshot lists sampled times.
+    """
+
+    def __init__(self, mode, output, timeout=None):
+        self.mode = mode
+        self.output = output
+        self.timeout = timeout
+        self.stacks = {}
+        self.samples = 0
+        self.overhead = 0.0
+        self.started = None
+        self._profile = cProfile.Profile() if mode == "cprofile" else None
+        self._main = threading.get_ident()
+        self._stop = threading.Event()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self.compiled = None
+
+    def start(self, compiled):
+        self.compiled = compiled
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._loop, name="profiler", daemon=True)
+        self._thread.start()
+        if self._profile is not None:
+            self._profile.enable()
+
+    def stop(self):
+        if self._profile is not None:
+            self._profile.disable()
+        self._stop.set()
+        self._thread.join()
+        self._write(complete=True)
+
+    def _loop(self):
+        deadline = None
+        if self.timeout:
+            deadline = self.started + max(0.0, self.timeout - PROFILE_SNAPSHOT_MARGIN)
+        while True:
+            wait = PROFILE_INTERVAL
+            if deadline is not None:
+                wait = max(0.0, min(wait, deadline - time.perf_counter()))
+            if self._stop.wait(wait):
+                return
+            self._sample()
+            if deadline is not None and time.perf_counter() >= deadline:
+                deadline = None
+                self._write(complete=False)
+
+    def _sample(self):
+        start = time.perf_counter()
+        frame = sys._current_frames().get(self._main)
+        stack = []
+        while frame is not None and frame.f_code is not _run_source.__code__:
+            stack.append(_frame_label(frame.f_code))
+            frame = frame.f_back
+        if frame is not None and stack:
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+        self.overhead += time.perf_counter() - start
+
+    def _sampled_functions(self, per_sample):
+        cumulative, own = {}, {}
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            for label in set(frames):
+                cumulative[label] = cumulative.get(label, 0) + count
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+        return [
+            {"function": label, "calls": None,
+             "cumulative_ms": round(count * per_sample, 3), "self_ms": round(own.get(label, 0) * per_sample, 3)}
+            for label, count in cumulative.items()
+        ]
+
+    def _traced_functions(self, compiled):
+        functions, calls = [], 0
+        for entry in self._profile.getstats():
+            code = entry.code
+            if isinstance(code, str) and "_lsprof.Profiler" in code:
+                continue
+            if any(call.code is compiled for call in entry.calls or ()):
+                continue  # the exec() running the snippet
+            if not isinstance(code, str) and code.co_filename == __file__:
+                continue
+            calls += entry.callcount
+            functions.append({
+                "function": _frame_label(code),
+                "calls": entry.callcount,
+                "cumulative_ms": round(entry.totaltime * 1000, 3),
+                "self_ms": round(entry.inlinetime * 1000, 3),
+            })
+        return functions, calls
+
+    def _write(self, complete):
+        with self._write_lock:
+            duration = time.perf_counter() - self.started
+            report = {
+                "mode": self.mode,
+                "complete": complete,
+                "duration_ms": round(duration * 1000, 3),
+                "samples": self.samples,
+                "interval_ms": PROFILE_INTERVAL * 1000,
+            }
+            per_sample = duration * 1000 / self.samples if self.samples else 0.0
+            functions = self._sampled_functions(per_sample)
+            overhead = self.overhead
+            if self._profile is not None:
+                traced, calls = self._traced_functions(self.compiled)
+                overhead += calls * _cprofile_call_cost()
+                report["calls"] = calls
+                if complete:
+                    functions = traced
+            functions.sort(key=lambda item: item["cumulative_ms"], reverse=True)
+            report["top"] = functions[:PROFILE_TOP]
+            stacks = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)[:PROFILE_MAX_STACKS]
+            report["collapsed"] = [f"{stack} {count}" for stack, count in stacks]
+            report["overhead_ms"] = round(overhead * 1000, 3)
+            report["overhead_percent"] = round(overhead / duration * 100, 2) if duration else 0.0
+
+            temporary = f"{self.output}.tmp"
+            with open(temporary, "w", encoding="utf-8") as f:
+                json.dump(report, f)
+            os.replace(temporary, self.output)
+
+
+def _run_source(code, filename, params=None, compiled=None, status_w=None, profile=None):
+    """Run a snippet as __main__ and return its exit code"""
+    sys.argv = [filename]
+    # Like `python main.py`: modules next to the entry point are importable
+    # ("" is the working directory)
+    sys.path[0] = os.path.dirname(filename)
+    # Make tracebacks show the user's source lines
+    linecache.cache[filename] = (len(code), None, code.splitlines(True), filename)
+    if params is not None:
+        sys.stdin = io.StringIO(json.dumps(params))
+
+    exit_code = 0
+    profiler = _Profiler(profile["mode"], profile["output"], profile.get("timeout")) if profile else None
+    try:
+        if compiled is None:
+            compiled = compile(code, filename, "exec")
+        if profiler is not None:
+            profiler.start(compiled)
+        try:
+            exec(compiled, {
+                "__name__": "__main__",
+                "__file__": filename,
+                "__builtins__": __builtins__,
+                "params": params if params is not None else {},
+            })
+        finally:
+            if profiler is not None:
+                profiler.stop()
+    except SystemExit as e:
+        exit_code = _system_exit_code(e)
+    except BaseException:
+        etype, value, tb = sys.exc_info()
+        if isinstance(value, MemoryError) and status_w is not None:
+            os.write(status_w, STATUS_MEMORY_ERROR)
+        # Drop the worker's own frame so the output matches `python file.py`
+        traceback.print_exception(etype, value, tb.tb_next if tb is not None else None)
+        exit_code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except Exception:
+            pass
+    return exit_code
+
+
+def _close_inherited_fds(keep):
+    """Close every descriptor above stdio except `keep` (run in the forked child)"""
+    low = 3
+    for fd in sorted(keep):
+        if fd >= low:
+            os.closerange(low, fd)
+            low = fd + 1
+    os.closerange(low, os.sysconf("SC_OPEN_MAX"))
+
+
+def _forget_requests(channel):
+    """Drop what the worker kept from other runs (run in the forked child)"""
+    _compiled.clear()
+    channel.pending = []
+    channel._buffer = b""
+
+
+def _run_child(code, filename, params, compiled, out_w, err_w, status_w, profile):
+    """Executed in the forked child: run the snippet and never return"""
+    os.dup2(out_w, 1)
+    os.dup2(err_w, 2)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    for fd in (out_w, err_w, devnull):
+        os.close(fd)
+
+    # Fresh text streams over the redirected descriptors
+    sys.stdin = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", buffering=1, encoding="utf-8", errors="replace", closefd=False)
+    sys.stderr = open(2, "w", buffering=1, encoding="utf-8", errors="replace", closefd=False)
+
+    os._exit(_run_source(code, filename, params, compiled, status_w, profile) & 0xFF)
+
+
+def run_once(filename):
+    """Cold-start mode: read one request from stdin and run it in this process"""
+    request = json.loads(sys.stdin.buffer.read().decode("utf-8", errors="replace"))
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    sys.stdin = open(0, "r", closefd=False)
+    if request.get("memory_limit_mb"):
+        # Like a session kernel: the interpreter's own start-up is not charged
+        _limit_memory(request["memory_limit_mb"], None)
+    _enter_workdir(request.get("workdir"), request.get("file_limit_mb"))
+    raise SystemExit(_run_source(request["code"], filename, request.get("params"), profile=request.get("profile")))
+
+
+class Channel:
+    """Line-delimited JSON over raw file descriptors.
+
+    Raw descriptors (instead of buffered files) let the worker select() on
+    the request channel while a child runs, so a cancel can arrive mid-run.
+    """
+
+    def __init__(self, fd_in, fd_out):
+        self.fd_in = fd_in
+        self.fd_out = fd_out
+        self._buffer = b""
+        self.pending = []
+        self.closed = False
+
+    def send(self, message):
+        data = json.dumps(message).encode("utf-8") + b"\n"
+        while data:
+            written = os.write(self.fd_out, data)
+            data = data[written:]
+
+    def feed(self):
+        """Read whatever is available and queue complete messages"""
+        data = os.read(self.fd_in, READ_CHUNK)
+        if not data:
+            self.closed = True
+            return
+        self._buffer += data
+        while b"\n" in self._buffer:
+            line, self._buffer = self._buffer.split(b"\n", 1)
+            if not line.strip():
+                continue
+            try:
+                self.pending.append(json.loads(line))
+            except ValueError:
+                self.send({"type": "error", "message": "invalid request"})
+
+    def receive(self):
+        """Block until the next message arrives (None once closed)"""
+        while not self.pending:
+            if self.closed:
+                return None
+            self.feed()
+        return self.pending.pop(0)
+
+
+def _execute(request, channel, preload_times):
+    """Fork a child for one snippet and stream its output back"""
+    code = request["code"]
+    filename = request.get("filename") or "main.py"
+    timeout = request.get("timeout")
+    memory_limit_mb = request.get("memory_limit_mb")
+    cgroup = _create_cgroup(request.get("cgroup_root"), memory_limit_mb) if memory_limit_mb else None
+
+    compiled = _compile_cached(code, filename)
+
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    status_r, status_w = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        # The protocol channel and the caches carry other users' requests
+        _close_inherited_fds((out_w, err_w, status_w))
+        _forget_requests(channel)
+        os.setsid()
+        if memory_limit_mb:
+            _limit_memory(memory_limit_mb, cgroup)
+        _enter_workdir(request.get("workdir"), request.get("file_limit_mb"))
+        _run_child(code, filename, request.get("params"), compiled, out_w, err_w, status_w, request.get("profile"))
+
+    os.close(out_w)
+    os.close(err_w)
+    os.close(status_w)
+
+    start = time.monotonic()
+    deadline = start + timeout if timeout else None
+    streams = {out_r: "stdout", err_r: "stderr"}
+    decoders = {fd: codecs.getincrementaldecoder("utf-8")(errors="replace") for fd in streams}
+    open_fds = [out_r, err_r]
+    timed_out = False
+    cancelled = False
+    pidfd = _open_pidfd(pid)
+    reaped = None
+
+    def forward(fd, data, final=False):
+        text = decoders[fd].decode(data, final)
+        if text:
+            channel.send({"type": "output", "id": request.get("id"), "stream": streams[fd], "data": text})
+
+    def read_ready(ready):
+        for fd in ready:
+            data = os.read(fd, READ_CHUNK)
+            if data:
+                forward(fd, data)
+            else:
+                forward(fd, b"", final=True)
+                open_fds.remove(fd)
+                os.close(fd)
+
+    # The run ends when the child exits rather than on EOF: descendants may
+    # hold the pipes open, and the child may close them and keep running.
+    poll_delay = 0.001
+    while True:
+        wait = None
+        if deadline is not None:
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                timed_out = True
+                break
+        watched = list(open_fds)
+        if pidfd is not None:
+            watched.append(pidfd)
+        else:
+            finished, status, rusage = os.wait4(pid, os.WNOHANG)
+            if finished:
+                reaped = (status, rusage)
+                break
+            if open_fds:
+                interval = CHILD_POLL_INTERVAL
+            else:
+                # Output already closed: poll for the exit with a backoff
+                interval, poll_delay = poll_delay, min(poll_delay * 2, CHILD_POLL_INTERVAL)
+            wait = interval if wait is None else min(wait, interval)
+        if not channel.closed:
+            watched.append(channel.fd_in)
+        ready, _, _ = select.select(watched, [], [], wait)
+        child_exited = pidfd is not None and pidfd in ready
+        if child_exited:
+            ready.remove(pidfd)
+        if channel.fd_in in ready:
+            ready.remove(channel.fd_in)
+            channel.feed()
+            cancels = [m for m in channel.pending if m.get("type") == "cancel"]
+            if cancels:
+                channel.pending = [m for m in channel.pending if m.get("type") != "cancel"]
+                if any(m.get("id") == request.get("id") for m in cancels):
+                    cancelled = True
+                    break
+        read_ready(ready)
+        if child_exited:
+            break
+
+    leaked = len(_group_members(pid, cgroup))
+    if timed_out or cancelled:
+        _kill_tree(pid, cgroup)
+    if reaped is None:
+        _, status, rusage = os.wait4(pid, 0)
+    else:
+        status, rusage = reaped
+    elapsed = time.monotonic() - start
+    if pidfd is not None:
+        os.close(pidfd)
+
+    # Nothing the run started may outlive it; once the group is dead the
+    # pipes reach EOF and the remaining output can be drained.
+    _kill_tree(pid, cgroup)
+    group_gone = _wait_group_empty(pid, cgroup)
+    drain_deadline = time.monotonic() + GROUP_EXIT_TIMEOUT
+    while open_fds:
+        wait = drain_deadline - time.monotonic()
+        if wait <= 0:
+            break
+        ready, _, _ = select.select(open_fds, [], [], wait)
+        read_ready(ready)
+    for fd in open_fds:
+        os.close(fd)
+
+    if os.WIFEXITED(status):
+        returncode = os.WEXITSTATUS(status)
+    else:
+        returncode = -os.WTERMSIG(status)
+
+    os.set_blocking(status_r, False)
+    try:
+        child_status = os.read(status_r, 16)
+    except BlockingIOError:
+        child_status = b""
+    os.close(status_r)
+
+    # ru_maxrss is in KB on Linux
+    usage = {
+        "max_rss_kb": rusage.ru_maxrss,
+        "user_time": rusage.ru_utime,
+        "system_time": rusage.ru_stime,
+        "minor_faults": rusage.ru_minflt,
+        "major_faults": rusage.ru_majflt,
+        "limit": "cgroup" if cgroup else ("rlimit" if memory_limit_mb else None),
+    }
+    oom_kills = 0
+    if cgroup is not None:
+        cgroup_usage = _cgroup_usage(cgroup)
+        oom_kills = cgroup_usage.pop("oom_kills", 0)
+        usage.update(cgroup_usage)
+        _remove_cgroup(cgroup)
+
+    memory_exceeded = STATUS_MEMORY_ERROR in child_status or oom_kills > 0
+    if not memory_exceeded and memory_limit_mb and returncode < 0 and not (timed_out or cancelled):
+        # Killed by a signal close to the ceiling: allocation failures in C
+        # extensions often abort instead of raising MemoryError
+        memory_exceeded = usage["max_rss_kb"] >= memory_limit_mb * 1024 * 0.9
+
+    return {
+        "type": "exit",
+        "id": request.get("id"),
+        "returncode": returncode,
+        "timed_out": timed_out,
+        "cancelled": cancelled,
+        "memory_exceeded": memory_exceeded,
+        "usage": usage,
+        "leaked_processes": leaked,
+        "preload_saved": _preload_saved(code, preload_times),
+        # Set when killed processes were still around; the API keeps reaping them
+        "surviving_pgid": None if group_gone else pid,
+        "elapsed": elapsed,
+        "worker_rss_kb": _current_rss_kb(),
+    }
+
+
+def _preload_saved(code, preload_times):
+    """Import time the snippet would have spent on modules already preloaded"""
+    if not preload_times:
+        return 0
+    used = _imported_modules(code)
+    return sum(seconds for name, seconds in preload_times.items() if name.split(".")[0] in used)
+
+
+def main(preload=()):
+    # Keep the protocol channel private: user code and stray prints from
+    # imported modules must never be able to write into it.
+    channel = Channel(os.dup(0), os.dup(1))
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+    _become_subreaper()
+    preload_times, preload_errors = _preload(preload)
+
+    channel.send({
+        "type": "ready",
+        "pid": os.getpid(),
+        "python_version": sys.version.split()[0],
+        "worker_rss_kb": _current_rss_kb(),
+        "preload_seconds": sum(preload_times.values()),
+        "preload_errors": preload_errors,
+    })
+
+    while True:
+        request = channel.receive()
+        if request is None or request.get("type") == "shutdown":
+            break
+        if request.get("type") == "ping":
+            channel.send({"type": "pong", "worker_rss_kb": _current_rss_kb()})
+            continue
+        if request.get("type") == "cancel":
+            # Arrived after the run it targeted had already finished
+            continue
+
+        try:
+            channel.send(_execute(request, channel, preload_times))
+        except Exception as e:
+            channel.send({"type": "error", "message": str(e)})
+
+
+class _CellTimeout(BaseException):
+    """Raised inside a session cell when it exceeds its timeout"""
+
+
+class _CellWriter(io.TextIOBase):
+    """sys.stdout/sys.stderr of a session kernel, forwarding text as messages"""
+
+    def __init__(self, channel, stream):
+        self.channel = channel
+        self.stream = stream
+        self.request_id = None
+        self._pending = []
+        self._size = 0
+
+    @property
+    def encoding(self):
+        return "utf-8"
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if not isinstance(text, str):
+            raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        self._pending.append(text)
+        self._size += len(text)
+        if "\n" in text or self._size >= READ_CHUNK:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self._pending:
+            data = "".join(self._pending)
+            self._pending = []
+            self._size = 0
+            self.channel.send({"type": "output", "id": self.request_id, "stream": self.stream, "data": data})
+
+
+def _run_cell(code, filename, namespace):
+    """Run a cell against the session's globals, echoing a trailing expression"""
+    linecache.cache[filename] = (len(code), None, code.splitlines(True), filename)
+    tree = ast.parse(code, filename)
+    last = None
+    if tree.body and isinstance(tree.body[-1], ast.Expr):
+        last = ast.Expression(tree.body.pop().value)
+    exec(compile(tree, filename, "exec"), namespace)
+    if last is not None:
+        value = eval(compile(last, filename, "eval"), namespace)
+        if value is not None:
+            print(repr(value))
+
+
+def _cell_traceback(tb, filename):
+    """Skip the kernel's own frames so tracebacks start in the cell.
+
+    A cell that does not compile has no frame of its own, its SyntaxError
+    then prints without a traceback just like `python file.py` does.
+    """
+    while tb is not None and tb.tb_frame.f_code.co_filename != filename:
+        tb = tb.tb_next
+    return tb
+
+
+def _execute_cell(request, namespace, writers, cell_state):
+    """Run one session cell in this process and build its exit message"""
+    filename = f"<cell {request.get('id')}>"
+    timeout = request.get("timeout")
+    for writer in writers:
+        writer.request_id = request.get("id")
+    before = resource.getrusage(resource.RUSAGE_SELF) if resource is not None else None
+    start = time.monotonic()
+    returncode = 0
+    timed_out = cancelled = memory_exceeded = False
+
+    try:
+        cell_state["running"] = True
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            _run_cell(request["code"], filename, namespace)
+        finally:
+            # Signals arriving from here on are ignored by the handlers
+            cell_state["running"] = False
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except _CellTimeout:
+        timed_out = True
+    except KeyboardInterrupt:
+        cancelled = True
+    except SystemExit as e:
+        returncode = _system_exit_code(e)
+    except BaseException:
+        etype, value, tb = sys.exc_info()
+        memory_exceeded = isinstance(value, MemoryError)
+        traceback.print_exception(etype, value, _cell_traceback(tb, filename))
+        returncode = 1
+    finally:
+        for writer in writers:
+            writer.flush()
+            writer.request_id = None
+
+    usage = {"max_rss_kb": _current_rss_kb(), "limit": cell_state.get("limit")}
+    if before is not None:
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        usage.update({
+            "user_time": after.ru_utime - before.ru_utime,
+            "system_time": after.ru_stime - before.ru_stime,
+            "minor_faults": after.ru_minflt - before.ru_minflt,
+            "major_faults": after.ru_majflt - before.ru_majflt,
+        })
+    return {
+        "type": "exit",
+        "id": request.get("id"),
+        "returncode": returncode,
+        "timed_out": timed_out,
+        "cancelled": cancelled,
+        "memory_exceeded": memory_exceeded,
+        "usage": usage,
+        "elapsed": time.monotonic() - start,
+        "worker_rss_kb": usage["max_rss_kb"],
+    }
+
+
+def serve_session(memory_limit_mb=None, workdir=None, file_limit_mb=None):
+    """Session kernel mode: run cells in-process against persistent globals"""
+    channel = Channel(os.dup(0), os.dup(1))
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+    sys.stdin = open(0, "r", closefd=False)
+
+    cell_state = {"running": False, "limit": None}
+    if memory_limit_mb:
+        # The whole session, not a single cell, lives within the limit
+        _limit_memory(memory_limit_mb, None)
+        cell_state["limit"] = "rlimit"
+    _enter_workdir(workdir, file_limit_mb)
+    if workdir:
+        # Cells import from their directory, not from the API's services
+        sys.path[0] = workdir
+
+    def on_alarm(signum, frame):
+        if cell_state["running"]:
+            raise _CellTimeout()
+
+    def on_interrupt(signum, frame):
+        if cell_state["running"]:
+            raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGALRM, on_alarm)
+    signal.signal(signal.SIGINT, on_interrupt)
+
+    writers = (_CellWriter(channel, "stdout"), _CellWriter(channel, "stderr"))
+    sys.stdout, sys.stderr = writers
+    sys.argv = [""]
+    namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+
+    channel.send({
+        "type": "ready",
+        "pid": os.getpid(),
+        "python_version": sys.version.split()[0],
+        "worker_rss_kb": _current_rss_kb(),
+    })
+
+    while True:
+        request = channel.receive()
+        if request is None or request.get("type") == "shutdown":
+            break
+        if request.get("type") == "ping":
+            channel.send({"type": "pong", "worker_rss_kb": _current_rss_kb()})
+            continue
+        if request.get("type") == "cancel":
+            continue
+        try:
+            channel.send(_execute_cell(request, namespace, writers, cell_state))
+        except Exception as e:
+            channel.send({"type": "error", "message": str(e)})
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--run":
+        run_once(sys.argv[2])
+    elif len(sys.argv) == 5 and sys.argv[1] == "--session":
+        serve_session(int(sys.argv[2]), sys.argv[3], int(sys.argv[4]))
+    elif len(sys.argv) == 3 and sys.argv[1] == "--preload":
+        main(tuple(name for name in sys.argv[2].split(",") if name))
+    else:
+        main()
@@ -0,0 +1,346 @@
+"""Pools of pre-started interpreter workers, one pool per conda environment.
+
+Interpreter startup dominates the latency of
+short snippets. Each pool keeps a few long-lived `worker_main.py` processes
+running in the target environment; every execution is forked from one of
+them, so the per-run cost is a fork instead of a full interpreter start.
+Workers can pre-import heavy modules (numpy, pandas, ...) which the forked
+children then share copy-on-write.
+"""
+import itertools
+import json
+import os
+import select
+import subprocess
+import threading
+import time
+from typing import Callable, Optional
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker_main.py")
+
+# Default number of warm workers per environment (0 disables the pool)
+WORKER_POOL_DEFAULT_SIZE = 2
+# Upper bound for per-environment pool sizes
+WORKER_POOL_MAX_SIZE = 16
+# Recycle a worker after this many executions
+WORKER_MAX_RUNS = 200
+# Recycle a worker once its RSS grew by more than this since it started (MB)
+WORKER_MAX_RSS_GROWTH_MB = 64
+# Seconds to wait for a worker to become ready
+WORKER_START_TIMEOUT = 60
+# Extra seconds granted on top of the execution timeout before a worker is
+# considered hung and killed from the API side
+WORKER_RESPONSE_GRACE = 10
+
+
+class WorkerError(Exception):
+    """Raised when a worker dies or violates the protocol"""
+
+
+class CancelToken:
+    """Lets another thread abort an execution that may already be running"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callback = None
+        self.cancelled = False
+
+    def bind(self, callback):
+        """Register how to abort the current run; fires at once if already cancelled"""
+        with self._lock:
+            self._callback = callback
+            fire = self.cancelled
+        if fire:
+            callback()
+
+    def unbind(self):
+        with self._lock:
+            self._callback = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            callback = self._callback
+        if callback is not None:
+            callback()
+
+
+_request_ids = itertools.count(1)
+
+
+class Worker:
+    """A single warm interpreter process"""
+
+    def __init__(self, python_cmd: list[str], env: Optional[dict] = None, preload: tuple[str, ...] = (),
+                 mode_args: tuple[str, ...] = (), new_session: bool = False):
+        self.runs = 0
+        self.started_at = time.time()
+        self._buffer = b""
+        self._send_lock = threading.Lock()
+        args = list(mode_args) or (["--preload", ",".join(preload)] if preload else [])
+        started = time.monotonic()
+        self.process = subprocess.Popen(
+            python_cmd + ["-u", WORKER_SCRIPT] + args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            env=env,
+            start_new_session=new_session,
+        )
+        ready = self._read_message(WORKER_START_TIMEOUT)
+        if ready.get("type") != "ready":
+            self.close()
+            raise WorkerError(f"unexpected worker greeting: {ready}")
+        self.python_version = ready.get("python_version")
+        self.baseline_rss_kb = ready.get("worker_rss_kb") or 0
+        self.rss_kb = self.baseline_rss_kb
+        self.preload_seconds = ready.get("preload_seconds", 0)
+        self.preload_errors = ready.get("preload_errors") or {}
+        # Time a cold run spends before user code, minus the preloads
+        self.interpreter_startup = max(0.0, time.monotonic() - started - self.preload_seconds)
+        if ready.get("preload_errors"):
+            print(f"Worker could not preload modules: {ready['preload_errors']}")
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def _send(self, message: dict):
+        try:
+            with self._send_lock:
+                self.process.stdin.write(json.dumps(message).encode("utf-8") + b"\n")
+                self.process.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError) as e:
+            raise WorkerError(f"worker stdin closed: {e}")
+
+    def _read_message(self, timeout: float) -> dict:
+        deadline = time.monotonic() + timeout
+        fd = self.process.stdout.fileno()
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.close()
+                raise WorkerError("worker did not respond in time")
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                raise WorkerError("worker exited unexpectedly")
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line)
+
+    def _send_cancel(self, request_id: int):
+        try:
+            self._send({"type": "cancel", "id": request_id})
+        except WorkerError:
+            pass
+
+    def execute(self, request: dict, timeout: float, cancel_token: Optional[CancelToken] = None,
+                on_output: Optional[Callable[[str, str], None]] = None) -> dict:
+        """Run one request on this worker and return the exit message.
+
+        Output chunks are passed to `on_output(stream, text)` as they arrive.
+        """
+        request_id = next(_request_ids)
+        self._send(dict(request, id=request_id))
+        self.runs += 1
+        if cancel_token is not None:
+            cancel_token.bind(lambda: self._send_cancel(request_id))
+        try:
+            while True:
+                message = self._read_message(timeout + WORKER_RESPONSE_GRACE)
+                if message.get("type") == "output":
+                    if on_output is not None:
+                        on_output(message["stream"], message["data"])
+                    continue
+                if message.get("type") == "exit":
+                    self.rss_kb = message.get("worker_rss_kb") or self.rss_kb
+                    message["interpreter_startup"] = self.interpreter_startup
+                    return message
+                if message.get("type") == "error":
+                    raise WorkerError(message.get("message", "worker error"))
+        finally:
+            if cancel_token is not None:
+                cancel_token.unbind()
+
+    def needs_recycle(self) -> bool:
+        if not self.alive or self.runs >= WORKER_MAX_RUNS:
+            return True
+        growth_mb = (self.rss_kb - self.baseline_rss_kb) / 1024
+        return growth_mb > WORKER_MAX_RSS_GROWTH_MB
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self._send({"type": "shutdown"})
+                self.process.wait(timeout=2)
+            except (WorkerError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+class WorkerPool:
+    """A bounded set of warm workers for one environment"""
+
+    def __init__(self, env_name: str, python_cmd: list[str], size: int,
+                 env: Optional[dict] = None, revision: Optional[str] = None,
+                 preload: tuple[str, ...] = ()):
+        self.env_name = env_name
+        self.python_cmd = python_cmd
+        self.env = env
+        self.revision = revision
+        self.preload = preload
+        self.size = size
+        # Top-level modules the workers really have loaded, known once one started
+        self.loaded_modules: Optional[frozenset] = None
+        self.last_used = time.monotonic()
+        self._idle: list[Worker] = []
+        self._busy = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def available(self) -> bool:
+        """Whether a run would start without waiting for another to finish"""
+        with self._cond:
+            return bool(self._idle) or self._busy < self.size
+
+    def resize(self, size: int):
+        with self._cond:
+            self.size = size
+            while len(self._idle) + self._busy > self.size and self._idle:
+                self._idle.pop().close()
+            self._cond.notify_all()
+
+    def _acquire(self) -> Worker:
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise WorkerError("worker pool is shut down")
+                if self._idle:
+                    self._busy += 1
+                    return self._idle.pop()
+                if self._busy < self.size:
+                    self._busy += 1
+                    break
+                self._cond.wait()
+        # Start a new worker outside the lock, it can take a while
+        try:
+            worker = Worker(self.python_cmd, self.env, self.preload)
+        except Exception:
+            with self._cond:
+                self._busy -= 1
+                self._cond.notify()
+            raise
+        self.loaded_modules = frozenset(
+            name.split(".")[0] for name in self.preload if name not in worker.preload_errors
+        )
+        return worker
+
+    def _release(self, worker: Worker, broken: bool = False):
+        with self._cond:
+            self._busy -= 1
+            keep = (
+                not broken
+                and not self._closed
+                and not worker.needs_recycle()
+                and len(self._idle) + self._busy < self.size
+            )
+            if keep:
+                self._idle.append(worker)
+            self._cond.notify()
+        if not keep:
+            worker.close()
+
+    def prewarm(self):
+        """Start a worker in the background so the first run finds it ready"""
+        def start():
+            try:
+                self._release(self._acquire())
+            except Exception as e:
+                print(f"Pre-warming a worker for {self.env_name} failed: {e}")
+        threading.Thread(target=start, name=f"prewarm-{self.env_name}", daemon=True).start()
+
+    def execute(self, request: dict, timeout: float, cancel_token: Optional[CancelToken] = None,
+                on_output: Optional[Callable[[str, str], None]] = None) -> dict:
+        self.last_used = time.monotonic()
+        worker = self._acquire()
+        try:
+            result = worker.execute(request, timeout, cancel_token, on_output)
+        except Exception:
+            self._release(worker, broken=True)
+            raise
+        self._release(worker)
+        return result
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for worker in idle:
+            worker.close()
+
+
+# Keyed by (environment, preloaded modules): an environment may have pools
+# with different module sets next to its configured one
+_pools: dict[tuple[str, tuple[str, ...]], WorkerPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(env_name: str, python_cmd: list[str], size: int,
+             env: Optional[dict] = None, revision: Optional[str] = None,
+             preload: tuple[str, ...] = ()) -> WorkerPool:
+    """Get (or lazily create) the pool for an environment.
+
+    The pool is rebuilt when the environment's interpreter, revision or
+    preloaded modules changed, so workers never outlive the packages they
+    were started with.
+    """
+    with _pools_lock:
+        pool = _pools.get((env_name, preload))
+        if pool is None or pool.python_cmd != python_cmd or pool.revision != revision:
+            if pool is not None:
+                pool.close()
+            pool = WorkerPool(env_name, python_cmd, size, env, revision, preload)
+            _pools[(env_name, preload)] = pool
+    if pool.size != size:
+        pool.resize(size)
+    return pool
+
+
+def environment_pools(env_name: str) -> list[WorkerPool]:
+    """All pools currently kept for an environment"""
+    with _pools_lock:
+        return [pool for (name, _), pool in _pools.items() if name == env_name]
+
+
+def close_pool(pool: WorkerPool):
+    """Stop one pool and forget it"""
+    with _pools_lock:
+        if _pools.get((pool.env_name, pool.preload)) is pool:
+            del _pools[(pool.env_name, pool.preload)]
+    pool.close()
+
+
+def discard_pool(env_name: str):
+    """Close the pools of an environment, e.g. after it was removed"""
+    for pool in environment_pools(env_name):
+        close_pool(pool)
+
+
+def shutdown_pools():
+    """Stop every worker, called on application shutdown"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
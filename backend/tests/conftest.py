@@ -0,0 +1,64 @@
+"""Shared test setup.
+
+The database and the scratch root are chosen when their modules are first
+imported, so they are pointed at a throw-away directory before any test
+module imports the app.
+"""
+import os
+import tempfile
+
+import pytest
+
+_TEST_ROOT = tempfile.mkdtemp(prefix="coderunner-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_TEST_ROOT, 'test.db')}")
+os.environ.setdefault("EXECUTION_SCRATCH_ROOT", os.path.join(_TEST_ROOT, "scratch"))
+
+
+@pytest.fixture(scope="session")
+def database():
+    from models.database import Base, engine
+
+    Base.metadata.create_all(bind=engine)
+    return engine
+
+
+@pytest.fixture
+def db(database):
+    from models.database import SessionLocal
+
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture(scope="session")
+def client(database):
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def make_user(db):
+    """Factory for users with an API key; returns (user, api_key)"""
+    import uuid
+
+    from models.database import APIKey, User
+    from services.auth import get_password_hash
+
+    def make(user_level: int = 2):
+        name = f"user-{uuid.uuid4().hex[:12]}"
+        user = User(username=name, email=f"{name}@example.com", hashed_password=get_password_hash("secret"),
+                    user_level=user_level)
+        db.add(user)
+        db.commit()
+        api_key = f"key-{uuid.uuid4().hex}"
+        db.add(APIKey(user_id=user.id, key_name="tests", key_value=api_key))
+        db.commit()
+        return user, api_key
+    return make
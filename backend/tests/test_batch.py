@@ -0,0 +1,68 @@
+import pytest
+
+from models.database import CodeExecution, CodeLibrary
+from services.quota import quota_counters
+from services.record_writer import record_writer
+from services.scheduler import execution_scheduler
+
+
+@pytest.fixture
+def library_entry(db, make_user):
+    user, api_key = make_user()
+    entry = CodeLibrary(user_id=user.id, title="echo", description="", code="print(params['n'] * 2)",
+                        conda_env="base")
+    db.add(entry)
+    db.commit()
+    return user, api_key, entry
+
+
+@pytest.fixture
+def saturated_scheduler():
+    """No free slot and no room left in the queue"""
+    slots, queue_limit = execution_scheduler.slots, execution_scheduler.queue_limit
+    execution_scheduler.resize(1)
+    holder = execution_scheduler.submit(999, 4)
+    assert execution_scheduler.wait(holder)
+    execution_scheduler.queue_limit = 0
+    yield
+    execution_scheduler.release(holder)
+    execution_scheduler.queue_limit = queue_limit
+    execution_scheduler.resize(slots)
+
+
+def _records(db, user_id: int) -> int:
+    record_writer.flush()
+    db.expire_all()
+    return db.query(CodeExecution).filter(CodeExecution.user_id == user_id).count()
+
+
+def test_parameter_sets_run_as_items(client, db, library_entry):
+    user, api_key, entry = library_entry
+    response = client.post("/api/v1/execute/batch", params={"api_key": api_key},
+                           json={"code_id": entry.id, "parameter_sets": [{"n": 1}, {"n": 2}, {"n": 3}]})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total"] == 3
+    assert [item["index"] for item in body["results"]] == [0, 1, 2]
+    assert [item["result"].strip() for item in body["results"]] == ["2", "4", "6"]
+    assert all(item["status_code"] == 200 and item["id"] for item in body["results"])
+    assert _records(db, user.id) == 3
+
+
+def test_overloaded_items_are_429_and_not_counted(client, db, library_entry, saturated_scheduler):
+    user, api_key, entry = library_entry
+    used = quota_counters.usage(user.id, db)
+
+    response = client.post("/api/v1/execute/batch", params={"api_key": api_key},
+                           json={"code_id": entry.id, "parameter_sets": [{"n": 1}, {"n": 2}]})
+
+    assert response.status_code == 200
+    assert int(response.headers["retry-after"]) >= 1
+    for item in response.json()["results"]:
+        assert item["status_code"] == 429
+        assert item["status"] == "overloaded"
+        assert item["retry_after"] >= 1
+        assert item["id"] is None
+    assert _records(db, user.id) == 0
+    assert quota_counters.usage(user.id, db) == used
@@ -0,0 +1,162 @@
+import os
+
+import pytest
+
+from models.models import BundleFile
+from models.user_levels import get_user_level_config
+from services import bundles, scratch
+from services.bundles import BundleError, MissingBlobsError, blob_hash, bundle_payload, create_bundle
+from services.executor import WorkerSettings, run_code
+from services.scratch import ScratchDir, cache_blob, uncached_blobs
+
+LEVEL = get_user_level_config(2)
+MAIN = b"from helpers.text import shout\nprint(shout('hi'))\n"
+HELPER = b"def shout(text):\n    return text.upper() + '!'\n"
+
+
+@pytest.fixture
+def blob_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(bundles, "BUNDLE_DIR", str(tmp_path / "bundles"))
+    monkeypatch.setattr(scratch, "ARTIFACT_DIR", str(tmp_path / "artifacts"))
+
+
+@pytest.fixture
+def host_cache(tmp_path, monkeypatch):
+    """An empty per-host cache of bundle files"""
+    monkeypatch.setattr(scratch, "_BLOBS_DIR", str(tmp_path / "host-blobs"))
+
+
+@pytest.fixture
+def run_dir():
+    directory = ScratchDir()
+    yield directory
+    directory.remove()
+
+
+def _fetcher(contents: dict):
+    fetched = []
+
+    def fetch(sha256: str) -> bytes:
+        fetched.append(sha256)
+        return contents[sha256]
+    return fetch, fetched
+
+
+def _read(directory: ScratchDir, path: str) -> bytes:
+    with open(os.path.join(directory.path, path), "rb") as f:
+        return f.read()
+
+
+def test_files_are_fetched_once_per_host(host_cache):
+    files = {"main.py": blob_hash(MAIN), "helpers/text.py": blob_hash(HELPER)}
+    fetch, fetched = _fetcher({blob_hash(MAIN): MAIN, blob_hash(HELPER): HELPER})
+
+    for _ in range(2):
+        directory = ScratchDir()
+        try:
+            directory.place_files(files, fetch)
+            assert _read(directory, "helpers/text.py") == HELPER
+        finally:
+            directory.remove()
+
+    assert sorted(fetched) == sorted(files.values())
+    assert uncached_blobs(files.values()) == []
+
+
+def test_tampered_cache_entry_is_fetched_again(host_cache, run_dir):
+    sha256 = blob_hash(HELPER)
+    cache_blob(sha256, HELPER)
+    # Runs share the host's uid, so a snippet could rewrite the cached file
+    path = os.path.join(scratch._BLOBS_DIR, sha256)
+    os.chmod(path, 0o644)
+    with open(path, "wb") as f:
+        f.write(b"import os; os.system('evil')\n")
+
+    assert uncached_blobs([sha256]) == [sha256]
+    fetch, fetched = _fetcher({sha256: HELPER})
+    run_dir.place_files({"helpers.py": sha256}, fetch)
+    assert fetched == [sha256]
+    assert _read(run_dir, "helpers.py") == HELPER
+
+
+def test_runs_get_copies_not_links(host_cache, run_dir):
+    sha256 = blob_hash(HELPER)
+    fetch, _ = _fetcher({sha256: HELPER})
+    run_dir.place_files({"helpers.py": sha256}, fetch)
+
+    with open(os.path.join(run_dir.path, "helpers.py"), "ab") as f:
+        f.write(b"# changed by the run\n")
+    assert os.stat(os.path.join(run_dir.path, "helpers.py")).st_nlink == 1
+    assert uncached_blobs([sha256]) == []
+
+
+def test_cache_rejects_content_not_matching_its_hash(host_cache):
+    with pytest.raises(ValueError):
+        cache_blob(blob_hash(MAIN), HELPER)
+
+
+def test_only_changed_bundle_files_become_artifacts(blob_store, host_cache, run_dir):
+    files = {"main.py": blob_hash(MAIN), "helpers/text.py": blob_hash(HELPER)}
+    fetch, _ = _fetcher({blob_hash(MAIN): MAIN, blob_hash(HELPER): HELPER})
+    run_dir.place_files(files, fetch)
+
+    with open(os.path.join(run_dir.path, "main.py"), "ab") as f:
+        f.write(b"# edited\n")
+    with open(os.path.join(run_dir.path, "result.txt"), "w") as f:
+        f.write("output")
+
+    count, archive = run_dir.collect(LEVEL)
+    assert count == 2
+    assert sorted(entry["name"] for entry in scratch.list_artifacts(archive)) == ["main.py", "result.txt"]
+
+
+def test_create_bundle_asks_for_missing_contents(blob_store, db, make_user):
+    user, _ = make_user()
+    helper = BundleFile(path="helpers/text.py", sha256=blob_hash(HELPER))
+    main = BundleFile(path="main.py", content=MAIN.decode())
+
+    with pytest.raises(MissingBlobsError) as missing:
+        create_bundle(db, user.id, "main.py", [main, helper], LEVEL)
+    assert missing.value.hashes == [blob_hash(HELPER)]
+
+    create_bundle(db, user.id, "helpers/text.py",
+                  [BundleFile(path="helpers/text.py", content=HELPER.decode())], LEVEL)
+    bundle = create_bundle(db, user.id, "main.py", [main, helper], LEVEL)
+    assert bundle.file_count == 2
+    assert create_bundle(db, user.id, "main.py", [main, helper], LEVEL).id == bundle.id
+
+
+def test_hashes_only_stand_for_the_users_own_uploads(blob_store, db, make_user):
+    owner, _ = make_user()
+    other, _ = make_user()
+    create_bundle(db, owner.id, "main.py", [BundleFile(path="main.py", content=MAIN.decode())], LEVEL)
+    sha256 = blob_hash(MAIN)
+
+    assert bundles.missing_blobs(db, owner.id, [sha256]) == []
+    # Neither an existence oracle nor a way to get at the owner's file
+    assert bundles.missing_blobs(db, other.id, [sha256]) == [sha256]
+    with pytest.raises(MissingBlobsError):
+        create_bundle(db, other.id, "main.py", [BundleFile(path="main.py", sha256=sha256)], LEVEL)
+
+
+@pytest.mark.parametrize("path", ["/etc/passwd", "../escape.py", "a//b.py", "a/./b.py", "a\\b.py"])
+def test_create_bundle_rejects_unsafe_paths(blob_store, db, make_user, path):
+    user, _ = make_user()
+    with pytest.raises(BundleError):
+        create_bundle(db, user.id, "main.py",
+                      [BundleFile(path="main.py", content="print(1)"), BundleFile(path=path, content="x = 1")], LEVEL)
+
+
+def test_bundle_runs_with_its_own_modules(blob_store, host_cache, db, make_user):
+    user, _ = make_user()
+    bundle = create_bundle(db, user.id, "main.py", [
+        BundleFile(path="main.py", content=MAIN.decode()),
+        BundleFile(path="helpers/__init__.py", content=""),
+        BundleFile(path="helpers/text.py", content=HELPER.decode()),
+    ], LEVEL)
+
+    result = run_code(MAIN.decode(), None, LEVEL, workers=WorkerSettings(pool_size=0),
+                      bundle=bundle_payload(bundle))
+    assert result.status == "success", result.stderr
+    assert result.stdout.strip() == "HI!"
+    assert result.artifact_count == 0
@@ -0,0 +1,125 @@
+import threading
+import time
+
+import pytest
+
+from models.database import CodeExecution, CodeLibrary
+from routers import external_api
+from services import webhooks
+from services import idempotency as idempotency_module
+from services.idempotency import IdempotencyConflictError, IdempotencyStore
+from services.record_writer import record_writer
+
+KEY = (1, "execute", "retry-1")
+
+
+def test_completed_response_is_replayed():
+    store = IdempotencyStore(10, 60)
+    entry, replay = store.claim(KEY, "body", 1)
+    assert entry is not None and replay is None
+    store.complete(entry, {"id": 7})
+
+    assert store.claim(KEY, "body", 1) == (None, {"id": 7})
+
+
+def test_key_reused_for_another_request_conflicts():
+    store = IdempotencyStore(10, 60)
+    store.complete(store.claim(KEY, "body", 1)[0], {"id": 7})
+
+    with pytest.raises(IdempotencyConflictError) as conflict:
+        store.claim(KEY, "other body", 1)
+    assert conflict.value.status_code == 422
+
+
+def test_retry_during_first_attempt_shares_its_response():
+    store = IdempotencyStore(10, 60)
+    entry, _ = store.claim(KEY, "body", 1)
+    replays = []
+    retry = threading.Thread(target=lambda: replays.append(store.claim(KEY, "body", 5)))
+    retry.start()
+
+    store.complete(entry, {"id": 7})
+    retry.join(5)
+    assert replays == [(None, {"id": 7})]
+
+
+def test_retry_gives_up_waiting_with_409():
+    store = IdempotencyStore(10, 60)
+    store.claim(KEY, "body", 1)
+
+    with pytest.raises(IdempotencyConflictError) as conflict:
+        store.claim(KEY, "body", 0.05)
+    assert conflict.value.status_code == 409
+
+
+def test_abandoned_key_runs_again():
+    store = IdempotencyStore(10, 60)
+    store.abandon(store.claim(KEY, "body", 1)[0])
+
+    entry, replay = store.claim(KEY, "body", 1)
+    assert entry is not None and replay is None
+
+
+def test_keys_expire_and_are_bounded(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(idempotency_module.time, "monotonic", lambda: now[0])
+    store = IdempotencyStore(2, 60)
+    store.complete(store.claim(KEY, "body", 1)[0], {"id": 7})
+    now[0] += 61
+    assert store.claim(KEY, "body", 1)[0] is not None
+
+    store.claim((1, "execute", "retry-2"), "body", 1)
+    store.claim((1, "execute", "retry-3"), "body", 1)
+    assert len(store) == 2
+
+
+def test_retried_api_call_runs_once(client, db, make_user):
+    user, api_key = make_user()
+    entry = CodeLibrary(user_id=user.id, title="once", description="", code="print('ran')", conda_env="base")
+    db.add(entry)
+    db.commit()
+
+    def call():
+        return client.post("/api/v1/execute", params={"api_key": api_key}, json={"code_id": entry.id},
+                           headers={"Idempotency-Key": "retry-once"})
+
+    first, second = call(), call()
+    assert first.status_code == second.status_code == 200
+    assert second.headers["idempotent-replayed"] == "true"
+    assert second.json()["id"] == first.json()["id"]
+    record_writer.flush()
+    db.expire_all()
+    assert db.query(CodeExecution).filter(CodeExecution.user_id == user.id).count() == 1
+
+
+def test_replayed_callback_request_shows_the_jobs_progress(client, db, make_user, monkeypatch):
+    monkeypatch.setattr(webhooks, "_allowed_hosts", webhooks.HostRules("127.0.0.1"))
+    monkeypatch.setattr(external_api.webhook_dispatcher, "send", lambda *args, **kwargs: "delivery")
+    user, api_key = make_user()
+    entry = CodeLibrary(user_id=user.id, title="job", description="", code="print('done')", conda_env="base")
+    db.add(entry)
+    db.commit()
+
+    def call():
+        return client.post("/api/v1/execute", params={"api_key": api_key},
+                           json={"code_id": entry.id, "callback_url": "http://127.0.0.1:9/hook"},
+                           headers={"Idempotency-Key": "job-once"})
+
+    accepted = call()
+    assert accepted.status_code == 202
+    assert accepted.json()["status"] == "queued"
+    execution_id = accepted.json()["id"]
+
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        state = client.get(f"/api/v1/executions/{execution_id}", params={"api_key": api_key}).json()
+        if state["status"] not in ("queued", "running"):
+            break
+        time.sleep(0.05)
+
+    replay = call()
+    assert replay.status_code == 202
+    assert replay.headers["idempotent-replayed"] == "true"
+    assert replay.json()["id"] == execution_id
+    assert replay.json()["status"] == "success"
+    assert "done" in replay.json()["result"]
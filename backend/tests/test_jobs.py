@@ -0,0 +1,118 @@
+import time
+
+import pytest
+
+from models.database import CodeExecution
+from models.user_levels import get_user_level_config
+from services.executor import WorkerSettings
+from services.jobs import ACTIVE_JOB_STATUSES, JobScheduler
+from services.scheduler import execution_scheduler
+
+CLIENT_INFO = {"ip_address": "127.0.0.1", "user_agent": "pytest"}
+USER_ID = 1
+USER_LEVEL = 4
+
+
+@pytest.fixture
+def jobs():
+    scheduler = JobScheduler(1, 10)
+    yield scheduler
+    scheduler.shutdown()
+
+
+@pytest.fixture
+def one_slot():
+    """Leave a single execution slot, held by another user until released"""
+    slots = execution_scheduler.slots
+    execution_scheduler.resize(1)
+    ticket = execution_scheduler.submit(999, USER_LEVEL)
+    assert execution_scheduler.wait(ticket)
+    yield ticket
+    execution_scheduler.release(ticket)
+    execution_scheduler.resize(slots)
+
+
+def _queued_execution(db, code: str) -> int:
+    execution = CodeExecution(user_id=USER_ID, code=code, result="", status="queued", execution_time=0)
+    db.add(execution)
+    db.commit()
+    return execution.id
+
+
+def _submit(jobs, execution_id: int, code: str):
+    jobs.submit(execution_id, code, None, get_user_level_config(USER_LEVEL), WorkerSettings(pool_size=0),
+                USER_ID, USER_LEVEL, CLIENT_INFO)
+
+
+def _status(db, execution_id: int) -> CodeExecution:
+    db.expire_all()
+    return db.get(CodeExecution, execution_id)
+
+
+def _wait_until(db, execution_id: int, done, timeout: float = 30) -> CodeExecution:
+    deadline = time.monotonic() + timeout
+    while True:
+        execution = _status(db, execution_id)
+        if done(execution.status):
+            return execution
+        assert time.monotonic() < deadline, f"execution still {execution.status}"
+        time.sleep(0.05)
+
+
+def _wait_running(db, execution_id: int) -> CodeExecution:
+    return _wait_until(db, execution_id, lambda status: status == "running")
+
+
+def _wait_finished(db, execution_id: int) -> CodeExecution:
+    return _wait_until(db, execution_id, lambda status: status not in ACTIVE_JOB_STATUSES)
+
+
+def test_job_runs_and_records_result(jobs, db):
+    execution_id = _queued_execution(db, "print('from a job')")
+    _submit(jobs, execution_id, "print('from a job')")
+
+    execution = _wait_finished(db, execution_id)
+    assert execution.status == "success"
+    assert execution.result.strip() == "from a job"
+
+
+def test_cancel_running_job(jobs, db):
+    code = "import time\ntime.sleep(60)"
+    execution_id = _queued_execution(db, code)
+    _submit(jobs, execution_id, code)
+    _wait_running(db, execution_id)
+
+    started = time.monotonic()
+    assert jobs.cancel(execution_id) == "cancelling"
+    execution = _wait_finished(db, execution_id)
+    assert execution.status == "cancelled"
+    assert time.monotonic() - started < 10
+
+
+def test_cancel_job_waiting_for_slot(jobs, db, one_slot):
+    execution_id = _queued_execution(db, "print('never')")
+    _submit(jobs, execution_id, "print('never')")
+    # Picked up by the job thread, which now waits for the scheduler
+    time.sleep(0.2)
+    assert _status(db, execution_id).status == "queued"
+    assert execution_scheduler.stats()["queued"] == 1
+
+    assert jobs.cancel(execution_id) == "cancelling"
+    execution = _wait_finished(db, execution_id)
+    assert execution.status == "cancelled"
+    assert execution_scheduler.stats()["queued"] == 0
+
+
+def test_cancel_job_still_in_queue(jobs, db):
+    code = "import time\ntime.sleep(60)"
+    running_id = _queued_execution(db, code)
+    _submit(jobs, running_id, code)
+    _wait_running(db, running_id)
+    # The only job thread is busy, so this one stays in the job queue
+    queued_id = _queued_execution(db, "print('never')")
+    _submit(jobs, queued_id, "print('never')")
+
+    assert jobs.cancel(queued_id) == "cancelled"
+    assert jobs.cancel(queued_id) is None
+    assert jobs.cancel(running_id) == "cancelling"
+    assert _wait_finished(db, running_id).status == "cancelled"
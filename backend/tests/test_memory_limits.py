@@ -0,0 +1,26 @@
+import pytest
+
+from models.user_levels import get_user_level_config
+from services.executor import WARM_WORKERS_SUPPORTED, WorkerSettings, run_code
+
+# The lowest level has the tightest memory ceiling
+LEVEL = get_user_level_config(1)
+PATHS = [
+    pytest.param(WorkerSettings(pool_size=1), id="warm",
+                 marks=pytest.mark.skipif(not WARM_WORKERS_SUPPORTED, reason="warm workers need fork")),
+    pytest.param(WorkerSettings(pool_size=0), id="cold"),
+]
+
+
+@pytest.mark.parametrize("workers", PATHS)
+def test_numpy_imports_at_the_lowest_level(workers):
+    pytest.importorskip("numpy")
+    result = run_code("import numpy\nprint(numpy.arange(10).sum())", None, LEVEL, workers=workers)
+    assert result.status == "success", result.stderr
+    assert result.stdout.strip() == "45"
+
+
+@pytest.mark.parametrize("workers", PATHS)
+def test_allocations_beyond_the_level_still_fail(workers):
+    result = run_code(f"data = bytearray({LEVEL['max_memory'] * 2} * 1024 * 1024)", None, LEVEL, workers=workers)
+    assert result.status == "memory_exceeded", result.stderr
@@ -0,0 +1,32 @@
+from models.user_levels import get_user_level_config
+from services import executor, metrics
+from services.executor import WorkerSettings, run_code
+
+LEVEL = dict(get_user_level_config(2), max_execution_time=1)
+
+SPAWN_AND_HANG = """
+import subprocess, time
+subprocess.Popen(["sleep", "30"])
+time.sleep(30)
+"""
+
+
+def _leaked() -> int:
+    return metrics.snapshot()["counters"].get("leaked_processes", 0)
+
+
+def test_timed_out_cold_run_counts_its_leftovers_once(monkeypatch):
+    finished = []
+    finish = executor.finish_process_group
+
+    def counting_finish(pgid):
+        finished.append(pgid)
+        return finish(pgid)
+
+    monkeypatch.setattr(executor, "finish_process_group", counting_finish)
+    before = _leaked()
+    result = run_code(SPAWN_AND_HANG, None, LEVEL, workers=WorkerSettings(pool_size=0))
+
+    assert result.status == "timeout"
+    assert len(finished) == 1
+    assert _leaked() - before == 1
@@ -0,0 +1,62 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from models.database import CodeExecution
+from services import quota as quota_module
+from services.quota import QuotaCounters
+
+
+class _Tomorrow(date):
+    @classmethod
+    def today(cls):
+        return date.today() + timedelta(days=1)
+
+
+@pytest.fixture
+def user_id(make_user):
+    return make_user()[0].id
+
+
+def _execution(db, user_id: int, api_call: bool = False, created_at=None):
+    db.add(CodeExecution(user_id=user_id, code="print(1)", result="1", status="success", execution_time=1,
+                         is_api_call=api_call, created_at=created_at or datetime.utcnow()))
+    db.commit()
+
+
+def test_seeded_from_todays_records(db, user_id):
+    _execution(db, user_id)
+    _execution(db, user_id, api_call=True)
+    _execution(db, user_id, created_at=datetime.utcnow() - timedelta(days=2))
+
+    assert QuotaCounters().usage(user_id, db) == (2, 1)
+
+
+def test_recorded_runs_count_without_querying_again(db, user_id):
+    counters = QuotaCounters()
+    assert counters.usage(user_id, db) == (0, 0)
+    counters.record(user_id)
+    counters.record(user_id, api_call=True)
+    # Not seen by the counters, which no longer look at the table
+    _execution(db, user_id)
+
+    assert counters.usage(user_id, db) == (2, 1)
+    counters.record(user_id, api_call=True, amount=-1)
+    assert counters.usage(user_id, db) == (1, 0)
+
+
+def test_records_before_seeding_are_left_to_the_query(db, user_id):
+    counters = QuotaCounters()
+    counters.record(user_id)
+    _execution(db, user_id)
+
+    assert counters.usage(user_id, db) == (1, 0)
+
+
+def test_counters_start_over_at_day_rollover(db, user_id, monkeypatch):
+    counters = QuotaCounters()
+    counters.usage(user_id, db)
+    counters.record(user_id)
+
+    monkeypatch.setattr(quota_module, "date", _Tomorrow)
+    assert counters.usage(user_id, db) == (0, 0)
@@ -0,0 +1,73 @@
+import pytest
+
+from models.user_levels import USER_LEVELS
+from services import rate_limit as rate_limit_module
+from services.rate_limit import RateLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_burst_then_rejected_with_retry_after(clock):
+    limiter = RateLimiter(10)
+    for remaining in (2, 1, 0):
+        status = limiter.acquire(("api", 1), burst=3, per_minute=60)
+        assert status.allowed and status.remaining == remaining
+
+    status = limiter.acquire(("api", 1), burst=3, per_minute=60)
+    assert not status.allowed
+    assert status.retry_after == 1
+    assert status.headers()["Retry-After"] == "1"
+    assert status.headers()["RateLimit-Policy"] == "3;w=3"
+
+
+def test_bucket_refills_at_the_sustained_rate(clock):
+    limiter = RateLimiter(10)
+    for _ in range(3):
+        limiter.acquire(("api", 1), burst=3, per_minute=30)
+    assert not limiter.acquire(("api", 1), burst=3, per_minute=30).allowed
+
+    clock[0] += 2  # one token every two seconds
+    assert limiter.acquire(("api", 1), burst=3, per_minute=30).allowed
+    assert not limiter.acquire(("api", 1), burst=3, per_minute=30).allowed
+
+    clock[0] += 600  # never beyond the burst
+    assert limiter.acquire(("api", 1), burst=3, per_minute=30).remaining == 2
+
+
+def test_cost_takes_several_tokens_at_once(clock):
+    limiter = RateLimiter(10)
+    status = limiter.acquire(("api", 1), burst=5, per_minute=60, cost=6)
+    assert not status.allowed and status.remaining == 5
+    assert limiter.acquire(("api", 1), burst=5, per_minute=60, cost=5).allowed
+
+
+def test_users_and_scopes_have_separate_buckets(clock):
+    limiter = RateLimiter(10)
+    assert limiter.acquire(("api", 1), burst=1, per_minute=1).allowed
+    assert limiter.acquire(("api", 2), burst=1, per_minute=1).allowed
+    assert limiter.acquire(("execute", 1), burst=1, per_minute=1).allowed
+    assert not limiter.acquire(("api", 1), burst=1, per_minute=1).allowed
+
+
+def test_least_recently_used_buckets_are_dropped(clock):
+    limiter = RateLimiter(2)
+    for user_id in (1, 2, 3):
+        limiter.acquire(("api", user_id), burst=1, per_minute=1)
+    assert len(limiter) == 2
+    # The first bucket was forgotten, so it starts full again
+    assert limiter.acquire(("api", 1), burst=1, per_minute=1).allowed
+
+
+def test_route_answers_429_with_rate_limit_headers(client, make_user, monkeypatch):
+    monkeypatch.setitem(USER_LEVELS[1], "rate_burst", 2)
+    _, api_key = make_user(user_level=1)
+
+    statuses = [client.get("/api/v1/codes", params={"api_key": api_key}) for _ in range(3)]
+    assert [response.status_code for response in statuses] == [200, 200, 429]
+    assert statuses[1].headers["ratelimit-remaining"] == "0"
+    assert int(statuses[2].headers["retry-after"]) >= 1
@@ -0,0 +1,94 @@
+import dataclasses
+
+from services import result_cache as result_cache_module
+from services.executor import ExecutionResult
+from services.result_cache import ResultCache
+from services.runners import RemoteAgent, RunnerRegistry
+
+
+def _result(stdout: str = "42\n", status: str = "success") -> ExecutionResult:
+    return ExecutionResult(status=status, stdout=stdout, stderr="", returncode=0, execution_time=5)
+
+
+def test_key_covers_code_level_revision_and_parameters():
+    key = ResultCache.key_for("print(1)", None, "r1", 2)
+    assert key == ResultCache.key_for("print(1)", "base", "r1", 2)
+    assert key != ResultCache.key_for("print(2)", None, "r1", 2)
+    assert key != ResultCache.key_for("print(1)", None, "r1", 3)
+    assert key != ResultCache.key_for("print(1)", None, "pip-installed-something", 2)
+    with_params = ResultCache.key_for("print(1)", None, "r1", 2, {"a": 1, "b": 2})
+    assert with_params != key
+    assert with_params == ResultCache.key_for("print(1)", None, "r1", 2, {"b": 2, "a": 1})
+
+
+def test_revision_comes_from_the_agents_that_may_run_it():
+    current = RemoteAgent("runner-a", 1)
+    current.healthy = True
+    current.environments = {"base", "ml"}
+    current.revisions = {"base": "r1", "ml": "r7"}
+    outdated = RemoteAgent("runner-b", 1)
+    outdated.healthy = True
+    outdated.environments = {"base"}
+    registry = RunnerRegistry([current, outdated])
+
+    assert registry.environment_revision("ml") == "r7"
+    # An agent that reports no revision makes the result uncacheable
+    assert registry.environment_revision(None) is None
+    assert registry.environment_revision("missing") is None
+
+
+def test_only_successful_results_are_stored():
+    cache = ResultCache(10, 1024)
+    cache.put("failed", _result(status="error"))
+    cache.put("ok", _result())
+    assert cache.get("failed") is None
+    assert cache.get("ok").stdout == "42\n"
+
+
+def test_results_with_files_are_not_stored():
+    cache = ResultCache(10, 1024)
+    # Every record owns (and eventually deletes) its spill file and artifacts
+    cache.put("spilled", dataclasses.replace(_result(), output_path="/data/outputs/1.txt"))
+    cache.put("artifacts", dataclasses.replace(_result(), artifact_count=1, artifacts_path="/data/artifacts/1.zip"))
+    assert cache.get("spilled") is None
+    assert cache.get("artifacts") is None
+
+
+def test_hits_are_copies():
+    cache = ResultCache(10, 1024)
+    cache.put("key", _result())
+    cache.get("key").stdout = "changed"
+    assert cache.get("key").stdout == "42\n"
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(result_cache_module.time, "monotonic", lambda: now[0])
+    cache = ResultCache(10, 1024)
+    cache.put("key", _result(), ttl=60)
+    now[0] += 59
+    assert cache.get("key") is not None
+    now[0] += 2
+    assert cache.get("key") is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ResultCache(2, 1024)
+    cache.put("a", _result())
+    cache.put("b", _result())
+    cache.get("a")
+    cache.put("c", _result())
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_size_budget_evicts_and_skips_oversized_results():
+    cache = ResultCache(10, 10)
+    cache.put("a", _result("x" * 6))
+    cache.put("b", _result("y" * 6))
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    cache.put("huge", _result("z" * 11))
+    assert cache.get("huge") is None
+    assert cache.get("b") is not None
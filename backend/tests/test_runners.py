@@ -0,0 +1,25 @@
+from services import runners
+from services.runners import EmbeddedAgent, RemoteAgent, check_token, parse_agents
+
+
+def test_unset_token_admits_nobody(monkeypatch):
+    monkeypatch.setattr(runners, "RUNNER_AGENT_TOKEN", "")
+    assert not check_token("")
+    assert not check_token(None)
+
+
+def test_token_must_match(monkeypatch):
+    monkeypatch.setattr(runners, "RUNNER_AGENT_TOKEN", "s3cret")
+    assert check_token("s3cret")
+    assert not check_token("")
+    assert not check_token("s3cre")
+
+
+def test_remote_agents_need_a_token(monkeypatch):
+    monkeypatch.setattr(runners, "RUNNER_AGENT_TOKEN", "")
+    assert [type(agent) for agent in parse_agents("local,runner-a:8765")] == [EmbeddedAgent]
+
+    monkeypatch.setattr(runners, "RUNNER_AGENT_TOKEN", "s3cret")
+    agents = parse_agents("local,runner-a:8765")
+    assert [type(agent) for agent in agents] == [EmbeddedAgent, RemoteAgent]
+    assert agents[1].name == "runner-a:8765"
@@ -0,0 +1,126 @@
+import threading
+import time
+
+import pytest
+
+from services.scheduler import ExecutionOverloadedError, ExecutionScheduler
+
+
+def _scheduler(slots: int = 1, queue_limit: int = 100, max_wait: float = 5,
+               max_blocked: int = 100) -> ExecutionScheduler:
+    return ExecutionScheduler(slots, queue_limit, max_wait, max_blocked)
+
+
+def _grant_order(scheduler: ExecutionScheduler, holder, tickets: list, count: int) -> list:
+    """Release the running ticket `count` times and note which queued ticket got the slot"""
+    order = []
+    running = holder
+    for _ in range(count):
+        scheduler.release(running)
+        running = next(ticket for ticket in tickets if ticket.granted and ticket not in order)
+        order.append(running)
+    return order
+
+
+def test_lanes_share_slots_by_level_weight():
+    scheduler = _scheduler()
+    holder = scheduler.submit(1000, 4)
+    basic = [scheduler.submit(user_id, 1) for user_id in range(1, 5) for _ in range(2)]
+    premium = [scheduler.submit(100 + user_id, 4) for user_id in range(1, 9) for _ in range(2)]
+
+    order = _grant_order(scheduler, holder, basic + premium, 9)
+    # Weights 1 and 8: the premium lane gets eight of every nine slots
+    assert sum(ticket in premium for ticket in order) == 8
+    assert sum(ticket in basic for ticket in order) == 1
+
+
+def test_users_in_a_lane_take_turns():
+    scheduler = _scheduler()
+    holder = scheduler.submit(1000, 3)
+    first = [scheduler.submit(1, 2) for _ in range(3)]
+    second = [scheduler.submit(2, 2)]
+
+    order = _grant_order(scheduler, holder, first + second, 4)
+    assert order == [first[0], second[0], first[1], first[2]]
+
+
+def test_user_never_exceeds_max_concurrent_runs():
+    scheduler = _scheduler(slots=4)
+    own = [scheduler.submit(1, 1) for _ in range(2)]
+    other = scheduler.submit(2, 1)
+
+    # Level 1 allows one run per user, even with slots to spare
+    assert [ticket.granted for ticket in own] == [True, False]
+    assert other.granted
+    scheduler.release(own[0])
+    assert own[1].granted
+
+
+def test_queue_limits_reject_with_retry_after():
+    scheduler = _scheduler(queue_limit=3)
+    scheduler.submit(1000, 4)
+    scheduler.submit(1, 1)
+    scheduler.submit(1, 1)
+    # Level 1 queues at most two runs per user
+    with pytest.raises(ExecutionOverloadedError) as per_user:
+        scheduler.submit(1, 1)
+    assert per_user.value.retry_after >= 1
+
+    scheduler.submit(2, 1)
+    with pytest.raises(ExecutionOverloadedError):
+        scheduler.submit(3, 1)
+    assert scheduler.stats()["queued"] == 3
+
+
+def test_withdrawn_ticket_leaves_the_queue():
+    scheduler = _scheduler()
+    holder = scheduler.submit(1000, 4)
+    ticket = scheduler.submit(1, 2)
+    outcome = []
+    waiter = threading.Thread(target=lambda: outcome.append(scheduler.wait(ticket)))
+    waiter.start()
+
+    scheduler.withdraw(ticket)
+    waiter.join(5)
+    assert outcome == [False]
+    assert scheduler.stats()["queued"] == 0
+    scheduler.release(holder)
+    assert not ticket.granted
+    assert scheduler.stats()["running"] == 0
+
+
+def test_wait_times_out_as_overload():
+    scheduler = _scheduler(max_wait=0.05)
+    scheduler.submit(1000, 4)
+    ticket = scheduler.submit(1, 2)
+
+    with pytest.raises(ExecutionOverloadedError):
+        scheduler.wait(ticket)
+    assert scheduler.stats()["queued"] == 0
+
+
+def test_blocking_waiters_are_capped():
+    scheduler = _scheduler(max_blocked=1)
+    holder = scheduler.submit(1000, 4)
+    entered = threading.Event()
+
+    def blocked_caller():
+        with scheduler.slot(1, 2):
+            entered.set()
+
+    waiter = threading.Thread(target=blocked_caller)
+    waiter.start()
+    while scheduler.stats()["blocked"] < 1:
+        time.sleep(0.01)
+
+    # A second caller would tie up another request thread: rejected instead
+    with pytest.raises(ExecutionOverloadedError) as overloaded:
+        with scheduler.slot(2, 2):
+            pass
+    assert overloaded.value.retry_after >= 1
+    assert scheduler.stats()["queued"] == 1
+
+    scheduler.release(holder)
+    waiter.join(5)
+    assert entered.is_set()
+    assert scheduler.stats() == {"slots": 1, "running": 0, "queued": 0, "blocked": 0, "lanes": {2: 0, 4: 0}}
@@ -0,0 +1,196 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from services import webhooks
+from services.webhooks import HostRules, WebhookDispatcher, sign_payload, validate_callback_url
+
+SECRET = "api-key-used-as-secret"
+
+
+class _Receiver:
+    """Local stand-in for a webhook receiver, answering with queued statuses"""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests: list[dict] = []
+        self.received = threading.Condition()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                with receiver.received:
+                    receiver.requests.append({"headers": dict(self.headers), "body": body})
+                    status = receiver.statuses.pop(0) if receiver.statuses else 200
+                    receiver.received.notify_all()
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/hook"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def wait_for(self, count: int, timeout: float = 10) -> list[dict]:
+        with self.received:
+            assert self.received.wait_for(lambda: len(self.requests) >= count, timeout)
+            return list(self.requests)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def allow_loopback(monkeypatch):
+    monkeypatch.setattr(webhooks, "_allowed_hosts", HostRules("127.0.0.1"))
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = WebhookDispatcher(1, 10)
+    yield dispatcher
+    dispatcher.shutdown()
+
+
+def _verify(request: dict) -> dict:
+    """What a receiver does: check the signature over `<t>.<body>`"""
+    fields = dict(part.split("=", 1) for part in request["headers"]["X-CodeRunner-Signature"].split(","))
+    expected = hmac.new(SECRET.encode(), fields["t"].encode() + b"." + request["body"], hashlib.sha256).hexdigest()
+    assert hmac.compare_digest(fields["v1"], expected)
+    assert abs(int(fields["t"]) - time.time()) < 60
+    return json.loads(request["body"])
+
+
+def test_signature_covers_timestamp_and_body():
+    signature = sign_payload(SECRET, 1700000000, b'{"id":1}')
+    assert signature == hmac.new(SECRET.encode(), b'1700000000.{"id":1}', hashlib.sha256).hexdigest()
+    assert signature != sign_payload(SECRET, 1700000001, b'{"id":1}')
+    assert signature != sign_payload("other key", 1700000000, b'{"id":1}')
+
+
+def test_delivery_is_signed(allow_loopback, dispatcher):
+    receiver = _Receiver()
+    try:
+        delivery_id = dispatcher.send(receiver.url, {"id": 1, "status": "success"}, SECRET)
+        request = receiver.wait_for(1)[0]
+    finally:
+        receiver.close()
+
+    assert _verify(request) == {"id": 1, "status": "success"}
+    assert request["headers"]["X-CodeRunner-Event"] == "execution.completed"
+    assert request["headers"]["X-CodeRunner-Delivery"] == delivery_id
+
+
+def test_failed_delivery_is_retried(allow_loopback, dispatcher, monkeypatch):
+    monkeypatch.setattr(webhooks, "WEBHOOK_RETRY_BASE", 0.05)
+    receiver = _Receiver(statuses=[503, 500])
+    try:
+        dispatcher.send(receiver.url, {"id": 2}, SECRET)
+        requests = receiver.wait_for(3)
+    finally:
+        receiver.close()
+
+    assert [_verify(request) for request in requests] == [{"id": 2}] * 3
+    assert len({request["headers"]["X-CodeRunner-Delivery"] for request in requests}) == 1
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1:8000/hook",
+    "http://localhost/hook",
+    "http://10.0.0.5/hook",
+    "http://192.168.1.1/hook",
+    "http://169.254.169.254/latest/meta-data",
+    "http://[::1]/hook",
+    "http://[::ffff:127.0.0.1]/hook",
+    "ftp://example.com/hook",
+])
+def test_non_public_callbacks_are_refused(url):
+    with pytest.raises(ValueError):
+        validate_callback_url(url)
+
+
+def test_allowed_and_denied_hosts(monkeypatch):
+    monkeypatch.setattr(webhooks, "_allowed_hosts", HostRules("localhost, 10.0.0.0/8"))
+    monkeypatch.setattr(webhooks, "_denied_hosts", HostRules("93.184.215.0/24"))
+
+    assert validate_callback_url("http://localhost:9000/hook")
+    assert validate_callback_url("http://10.1.2.3/hook")
+    with pytest.raises(ValueError):
+        validate_callback_url("http://192.168.1.1/hook")
+    with pytest.raises(ValueError):
+        validate_callback_url("http://93.184.215.14/hook")
+    assert validate_callback_url("http://93.184.216.34/hook")
+
+
+def test_refused_host_is_checked_again_at_delivery(dispatcher):
+    receiver = _Receiver()
+    try:
+        dispatcher.send(receiver.url, {"id": 3}, SECRET)
+        deadline = time.monotonic() + 5
+        while dispatcher.pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert dispatcher.pending == 0
+        assert receiver.requests == []
+    finally:
+        receiver.close()
+
+
+def test_delivery_connects_to_the_checked_address(dispatcher, monkeypatch):
+    monkeypatch.setattr(webhooks, "_allowed_hosts", HostRules("hooks.example"))
+    real_getaddrinfo = webhooks.socket.getaddrinfo
+    answers = []
+
+    def rebinding_getaddrinfo(host, *args, **kwargs):
+        if host != "hooks.example":
+            return real_getaddrinfo(host, *args, **kwargs)
+        answers.append(host)
+        if len(answers) > 1:
+            # A second lookup would be answered by the attacker's DNS
+            raise webhooks.socket.gaierror("rebound")
+        return real_getaddrinfo("127.0.0.1", *args, **kwargs)
+
+    monkeypatch.setattr(webhooks.socket, "getaddrinfo", rebinding_getaddrinfo)
+    receiver = _Receiver()
+    port = receiver.server.server_address[1]
+    try:
+        dispatcher.send(f"http://hooks.example:{port}/hook", {"id": 4}, SECRET)
+        request = receiver.wait_for(1)[0]
+    finally:
+        receiver.close()
+
+    assert request["headers"]["Host"] == f"hooks.example:{port}"
+    assert answers == ["hooks.example"]
+
+
+def test_sender_survives_unexpected_errors(allow_loopback, dispatcher, monkeypatch):
+    attempt = dispatcher._attempt
+    calls = []
+
+    def flaky_attempt(delivery):
+        calls.append(delivery.id)
+        if len(calls) == 1:
+            raise KeyError("bug")
+        return attempt(delivery)
+
+    monkeypatch.setattr(dispatcher, "_attempt", flaky_attempt)
+    receiver = _Receiver()
+    try:
+        dispatcher.send(receiver.url, {"id": 5}, SECRET)
+        dispatcher.send(receiver.url, {"id": 6}, SECRET)
+        assert _verify(receiver.wait_for(1)[0]) == {"id": 6}
+    finally:
+        receiver.close()
+    deadline = time.monotonic() + 5
+    while dispatcher.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert dispatcher.pending == 0
@@ -0,0 +1,67 @@
+import pytest
+
+from models.user_levels import get_user_level_config
+from services.executor import WARM_WORKERS_SUPPORTED, WorkerSettings, run_code
+
+LEVEL = get_user_level_config(2)
+WARM = WorkerSettings(pool_size=1)
+
+pytestmark = pytest.mark.skipif(not WARM_WORKERS_SUPPORTED, reason="warm workers need fork")
+
+OPEN_FDS = """
+import os
+open_fds = []
+for fd in range(3, 256):
+    try:
+        os.fstat(fd)
+        open_fds.append(fd)
+    except OSError:
+        pass
+print(len(open_fds))
+"""
+
+HIJACK = """
+import json, os
+for fd in range(3, 256):
+    try:
+        os.write(fd, json.dumps({"type": "exit", "status": "success", "returncode": 0}).encode() + b"\\n")
+    except OSError:
+        pass
+"""
+
+
+def test_snippet_sees_only_its_status_pipe():
+    result = run_code(OPEN_FDS, None, LEVEL, workers=WARM)
+    assert result.status == "success", result.stderr
+    # The exit status pipe; the worker's request channel must not be there
+    assert result.stdout.strip() == "1"
+
+
+def test_snippet_cannot_answer_for_the_next_run():
+    run_code(HIJACK, None, LEVEL, workers=WARM)
+
+    result = run_code("print('the real output')", None, LEVEL, workers=WARM)
+    assert result.status == "success", result.stderr
+    assert result.stdout.strip() == "the real output"
+
+
+FIND_SECRET = """
+import gc, sys
+secret = "victim-" + "secret"
+cached = getattr(sys.modules["__main__"], "_compiled", {})
+in_cache = any(secret in source for _, source in cached)
+in_memory = any(
+    isinstance(obj, dict) and obj is not globals() and any(isinstance(value, str) and secret in value for value in obj.values())
+    for obj in gc.get_objects()
+)
+print(in_cache, in_memory)
+"""
+
+
+def test_snippet_cannot_read_earlier_sources():
+    victim = run_code('API_TOKEN = "victim-secret-abc"\nprint("ok")', None, LEVEL, workers=WARM)
+    assert victim.status == "success", victim.stderr
+
+    result = run_code(FIND_SECRET, None, LEVEL, workers=WARM)
+    assert result.status == "success", result.stderr
+    assert result.stdout.strip() == "False False"
@@ -5,6 +5,29 @@ from sqlalchemy.orm import Session
 from models.database import SystemLog
 
 
+def system_log_entry(
+    user_id: int = None,
+    action: str = "",
+    resource_type: str = "",
+    resource_id: int = None,
+    details: dict = None,
+    ip_address: str = None,
+    user_agent: str = None,
+    status: str = "success"
+) -> SystemLog:
+    """Build a system event without writing it, e.g. for the record writer"""
+    return SystemLog(
+        user_id=user_id,
+        action=action,
+        resource_type=resource_type,
+        resource_id=resource_id,
+        details=json.dumps(details) if details else None,
+        ip_address=ip_address,
+        user_agent=user_agent,
+        status=status
+    )
+
+
 def log_system_event(
     db: Session,
     user_id: int = None,
@@ -18,15 +41,8 @@ def log_system_event(
 ):
     """Log a system event"""
     try:
-        log_entry = SystemLog(
-            user_id=user_id,
-            action=action,
-            resource_type=resource_type,
-            resource_id=resource_id,
-            details=json.dumps(details) if details else None,
-            ip_address=ip_address,
-            user_agent=user_agent,
-            status=status
+        log_entry = system_log_entry(
+            user_id, action, resource_type, resource_id, details, ip_address, user_agent, status
         )
         db.add(log_entry)
         db.commit()